@@ -1,9 +1,18 @@
 #! /usr/bin/env python3
 
+from __future__ import annotations
+
 import argparse
+import atexit
+import gzip
+import hashlib
+import hmac
+import ipaddress
+import json
 import logging
 import os
 import os.path
+import queue
 import re
 import shlex
 import shutil
@@ -11,31 +20,39 @@ import signal
 import subprocess
 import sys
 import tempfile
+import threading
+import time
 
-from collections.abc import Callable, Sequence
+from collections import deque
+from collections.abc import Callable, Iterable, Iterator, Sequence
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from contextlib import contextmanager, suppress
 from functools import partial, reduce
-from logging.handlers import RotatingFileHandler
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
 from operator import iconcat
-from pathlib import Path, PurePath
-from pygit2 import (
-    GitError,
-    Repository,
-    Worktree,
-)
-from rich.console import Console, Group
-from rich.live import Live
-from rich.panel import Panel
-from rich.progress import (
-    BarColumn,
-    MofNCompleteColumn,
-    Progress,
-    SpinnerColumn,
-    TextColumn,
-    TimeElapsedColumn,
-    TimeRemainingColumn,
-)
-from rich.text import Text
-from typing import NamedTuple, Optional
+from pathlib import Path
+from typing import TYPE_CHECKING, Any, NamedTuple, Optional
+
+
+# `rich` and `pygit2` take longer to import than most invocations of `--list` take to run: they are
+# imported by the functions that need them.
+if TYPE_CHECKING:
+    from pygit2 import Repository, Worktree
+
+
+# Build logs of past runs are kept for that many days, and within that size.
+BUILD_LOGS_RETENTION_DAYS = 14
+BUILD_LOGS_RETENTION_BYTES = 256 * 1024 * 1024
+
+# Compression level of the build logs: they are written as the compiles run, so favour speed.
+BUILD_LOGS_COMPRESSLEVEL = 3
+
+
+def open_log(log_file: Path, mode: str = "r"):
+    """Open a build log as text, (de)compressing it on the fly if it is gzipped."""
+    if log_file.suffix == ".gz":
+        return gzip.open(log_file, f"{mode}t", compresslevel=BUILD_LOGS_COMPRESSLEVEL, encoding="utf-8", errors="replace")
+    return log_file.open(mode, encoding="utf-8", errors="replace")
 
 
 class SecureRotatingFileHandler(RotatingFileHandler):
@@ -48,11 +65,25 @@ class SecureRotatingFileHandler(RotatingFileHandler):
             os.umask(old_umask)
 
 
+def app_dir(xdg_variable: str, *default: str) -> str:
+    xdg_home = os.environ.get(xdg_variable, os.path.join(os.path.expanduser("~"), *default))
+    return os.path.join(xdg_home, "bastardkb-qmk")
+
+
+def make_private_dir(path: str) -> None:
+    # Explicitly remove symlinks to prevent arbitrary permission modification via os.chmod
+    if os.path.islink(path):
+        os.unlink(path)
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    # Ensure correct permissions if directory already existed.
+    os.chmod(path, 0o700)
+
+
 class Firmware(NamedTuple):
     keyboard: str
     keymap: str
     keymap_alias: Optional[str] = None
-    env_vars: Sequence[str] = []
+    env_vars: Sequence[str] = ()
 
     @property
     def output_filename(self) -> str:
@@ -101,6 +132,17 @@ ALL_MCUS: Sequence[str] = (
     *ARM_MCUS,
 )
 
+
+TOOLCHAIN_COMPILERS: dict[str, str] = {
+    "avr": "avr-gcc",
+    "arm": "arm-none-eabi-gcc",
+}
+
+
+def firmware_architecture(firmware: Firmware) -> str:
+    return "avr" if firmware.keyboard.endswith(AVR_MCUS) else "arm"
+
+
 ALL_FIRMWARES: Sequence[FirmwareList] = (
     # All firmwares built on the `bkb-master` branch, ie. the branch tracking
     # `qmk/qmk_firmware:master`.
@@ -183,20 +225,31 @@ ALL_FIRMWARES: Sequence[FirmwareList] = (
 
 
 class Reporter(object):
-    def __init__(self, verbose: bool):
+    """Report to the console and to the application log, without blocking the caller on their I/O.
+
+    Log records are written to the log file by a `QueueListener`, and console messages are printed
+    by a writer thread, which coalesces the queued messages into as few redraws of the live display
+    as possible.  `flush()` waits for the queued messages to be printed.
+    """
+
+    # Minimum interval between two live status updates of a firmware, in seconds.
+    TARGET_STATUS_INTERVAL = 0.1
+
+    def __init__(
+        self,
+        verbose: bool,
+        log_retention_days: float = BUILD_LOGS_RETENTION_DAYS,
+        log_retention_bytes: int = BUILD_LOGS_RETENTION_BYTES,
+    ):
+        from rich.console import Console
+
         self.console = Console()
         self.logging = logging.getLogger()
         self.verbose = verbose
 
         # Logging setup.
-        xdg_state_home = os.environ.get("XDG_STATE_HOME", os.path.join(os.path.expanduser("~"), ".local", "state"))
-        self.app_log_dir = os.path.join(xdg_state_home, "bastardkb-qmk")
-        # Explicitly remove symlinks to prevent arbitrary permission modification via os.chmod
-        if os.path.islink(self.app_log_dir):
-            os.unlink(self.app_log_dir)
-        os.makedirs(self.app_log_dir, mode=0o700, exist_ok=True)
-        # Ensure correct permissions if directory already existed.
-        os.chmod(self.app_log_dir, 0o700)
+        self.app_log_dir = app_dir("XDG_STATE_HOME", ".local", "state")
+        make_private_dir(self.app_log_dir)
 
         log_file = os.path.join(self.app_log_dir, "bastardkb_build_releases.log")
 
@@ -209,19 +262,107 @@ class Reporter(object):
         )
 
         logging_file_handler.setFormatter(logging.Formatter(fmt="%(asctime)s %(levelname)s %(message)s"))
-        self.logging.addHandler(logging_file_handler)
+        self._log_queue: queue.SimpleQueue = queue.SimpleQueue()
+        self._log_handler = QueueHandler(self._log_queue)
+        self._log_listener = QueueListener(self._log_queue, logging_file_handler, respect_handler_level=True)
+        self._log_listener.start()
+        self.logging.addHandler(self._log_handler)
         self.logging.setLevel(level=logging.DEBUG)
 
-        self.log_dir = tempfile.mkdtemp()
+        # Console writer.
+        self._closed = False
+        self._console_queue: queue.SimpleQueue = queue.SimpleQueue()
+        threading.Thread(target=self._console_writer, name="console-writer", daemon=True).start()
+        atexit.register(self.close)
+
+        # Build logs, one directory per run.
+        build_logs_dir = os.path.join(self.app_log_dir, "build-logs")
+        make_private_dir(build_logs_dir)
+        self.log_dir = os.path.join(build_logs_dir, f"{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}")
+        make_private_dir(self.log_dir)
+        self.prune_build_logs(build_logs_dir, log_retention_days, log_retention_bytes)
         self.debug(f"Saving build logs in: {self.log_dir}")
         self.debug(f"Saving application logs in: {self.app_log_dir}")
 
         # Progress status.
         self._progress_status = lambda _: None
+        self._target_status = lambda firmware, message: None
+        self._target_status_times: dict[Firmware, float] = {}
+
+    def _console_writer(self) -> None:
+        while True:
+            items = [self._console_queue.get()]
+            with suppress(queue.Empty):
+                while len(items) < 256:
+                    items.append(self._console_queue.get_nowait())
+            messages = []
+            for item in items:
+                if isinstance(item, threading.Event) or item[1]:
+                    if messages:
+                        self._console_print(*messages, sep="\n")
+                        messages = []
+                    if isinstance(item, threading.Event):
+                        item.set()
+                    else:
+                        self._console_print(*item[0], **item[1])
+                else:
+                    messages.extend(item[0])
+            if messages:
+                self._console_print(*messages, sep="\n")
 
-    def log_file(self, basename: str) -> Path:
+    def _console_print(self, *objects, **kwargs) -> None:
+        try:
+            self.console.print(*objects, **kwargs)
+        # On a broken pipe, rich redirects the output to /dev/null and raises SystemExit: keep the
+        # writer thread running, for `flush()`.
+        except (Exception, SystemExit):
+            self.logging.exception("failed to print to the console")
+
+    def _print(self, *objects, **kwargs) -> None:
+        if self._closed:
+            self._console_print(*objects, **kwargs)
+        else:
+            self._console_queue.put((objects, kwargs))
+
+    def flush(self) -> None:
+        """Wait for the queued console messages to be printed."""
+        if not self._closed:
+            printed = threading.Event()
+            self._console_queue.put(printed)
+            printed.wait()
+
+    def close(self) -> None:
+        """Flush the console messages and the log records, and write the next ones synchronously."""
+        if self._closed:
+            return
+        self.flush()
+        self._closed = True
+        self.logging.removeHandler(self._log_handler)
+        self._log_listener.stop()
+        for handler in self._log_listener.handlers:
+            self.logging.addHandler(handler)
+
+    def log_file(self, basename: str, compressed: bool = True) -> Path:
+        """Return the path of a build log of this run, gzip-compressed unless `compressed` is False."""
         sanitized_basename = basename.replace("/", "_").replace("\\", "_")
-        return Path(self.log_dir, f"{sanitized_basename}.log")
+        return Path(self.log_dir, f"{sanitized_basename}.log{'.gz' if compressed else ''}")
+
+    def prune_build_logs(self, build_logs_dir: str, retention_days: float, retention_bytes: int) -> None:
+        """Remove the build logs of the runs older than `retention_days`, then the oldest past `retention_bytes`."""
+        runs = []
+        expiry = time.time() - retention_days * 24 * 3600
+        for run_dir in Path(build_logs_dir).iterdir():
+            if str(run_dir) == self.log_dir or run_dir.is_symlink() or not run_dir.is_dir():
+                continue
+            try:
+                if run_dir.stat().st_mtime < expiry:
+                    self.debug(f"expire: {run_dir}")
+                    shutil.rmtree(run_dir, ignore_errors=True)
+                    continue
+            except OSError:
+                continue
+            runs.append(run_dir)
+        evict_least_recently_used(self, runs, retention_bytes)
 
     def set_progress_status(self, progress_status: Callable[[str], None]) -> None:
         self._progress_status = progress_status
@@ -230,25 +371,46 @@ class Reporter(object):
         self._progress_status(message)
         self.logging.info(message)
 
+    def set_target_status(self, target_status: Callable[[Firmware, Optional[str]], None]) -> None:
+        self._target_status = target_status
+
+    def target_status(self, firmware: Firmware, message: Optional[str]) -> None:
+        """Update the live status of a firmware being compiled, or clear it when `message` is None.
+
+        Updates are coalesced to one per `TARGET_STATUS_INTERVAL`, the display can't show more.
+        """
+        if message is None:
+            self._target_status_times.pop(firmware, None)
+        else:
+            now = time.monotonic()
+            if now - self._target_status_times.get(firmware, -self.TARGET_STATUS_INTERVAL) < self.TARGET_STATUS_INTERVAL:
+                return
+            self._target_status_times[firmware] = now
+        self._target_status(firmware, message)
+
     def newline(self):
-        self.console.print("")
+        self._print("")
 
     def debug(self, message) -> None:
         self.logging.debug(message)
 
     def info(self, message, **kwargs) -> None:
-        self.console.print(message, **kwargs)
+        self._print(message, **kwargs)
         self.logging.info(message)
 
     def warn(self, message, **kwargs) -> None:
-        self.console.print(message, **kwargs)
+        self._print(message, **kwargs)
         self.logging.warning(message)
 
     def error(self, message) -> None:
-        self.console.print(message)
+        self._print(message)
         self.logging.error(message)
 
     def fatal(self, message: str, title: str = "Error") -> None:
+        from rich.panel import Panel
+        from rich.text import Text
+
+        self.flush()
         self.console.print(
             Panel(
                 Text(message, justify="center"), title=f"[bold red]{title}[/bold red]", border_style="red", padding=(1, 2)
@@ -257,6 +419,10 @@ class Reporter(object):
         self.logging.error(f"{title}: {message}")
 
     def print_summary(self, success_count: int, total_count: int, failed_firmwares: Optional[Sequence[Firmware]] = None, is_dry_run: bool = False) -> None:
+        from rich.panel import Panel
+        from rich.text import Text
+
+        self.flush()
         failed_count = total_count - success_count
 
         log_info = Text(f"\n\nLogs saved in: {self.app_log_dir}", style="dim")
@@ -295,106 +461,1895 @@ class Reporter(object):
         self.logging.info(f"Done: built={success_count}, failed={failed_count}")
 
 
+# Bump to invalidate every cached artifact, eg. when the fingerprint inputs change.
+BUILD_CACHE_VERSION = 1
+
+# Paths of a QMK tree that every firmware depends on.  The `lib` tree holds the gitlinks of the
+# submodules, so its id also covers the submodule commits.
+QMK_CORE_PATHS: Sequence[str] = (
+    "Makefile",
+    "paths.mk",
+    "builddefs",
+    "data",
+    "drivers",
+    "lib",
+    "layouts",
+    "platforms",
+    "quantum",
+    "tmk_core",
+    "util",
+)
+
+# Files at the top of a keyboard directory that mark it as a keyboard (rather than a directory of
+# shared sources).
+QMK_KEYBOARD_MARKERS: Sequence[str] = ("info.json", "keyboard.json", "rules.mk")
+
+
+def _tree_entry(tree, path: str):
+    try:
+        return tree[path]
+    except KeyError:
+        return None
+
+
+def _is_keyboard_tree(entry, depth: int = 3) -> bool:
+    """Whether a tree entry is a keyboard directory, or a directory of keyboards (eg. `skeletyl/v2`)."""
+    if entry.type_str != "tree":
+        return False
+    if any(_tree_entry(entry, marker) is not None for marker in QMK_KEYBOARD_MARKERS):
+        return True
+    return depth > 0 and any(_is_keyboard_tree(child, depth - 1) for child in entry if child.name != "keymaps")
+
+
+def firmware_fingerprint(
+    tree, firmware: Firmware, toolchain_version: str, core_paths: Sequence[str] = QMK_CORE_PATHS
+) -> str:
+    """Hash the inputs of a firmware build from the git tree of its worktree.
+
+    Only the directories relevant to the firmware are considered: the `core_paths` of QMK, the
+    keyboard directory itself, the files and keymap directories of its parent directories, and the
+    userspace of the keymap.  Sibling keyboards are ignored, so that a change to one board does not
+    invalidate the cached artifacts of the others.
+    """
+    digest = hashlib.sha256()
+
+    def update(*values: str) -> None:
+        for value in values:
+            digest.update(value.encode())
+            digest.update(b"\0")
+
+    update(f"v{BUILD_CACHE_VERSION}", firmware.keyboard, firmware.keymap, firmware.output_filename)
+    update(*firmware.env_vars)
+    update(toolchain_version)
+    for path in (*core_paths, f"users/{firmware.keymap}"):
+        entry = _tree_entry(tree, path)
+        update(path, str(entry.id) if entry is not None else "-")
+
+    keyboard_path = f"keyboards/bastardkb/{firmware.keyboard}"
+    parts = keyboard_path.split("/")
+    for depth in range(2, len(parts)):
+        parent_path = "/".join(parts[:depth])
+        parent = _tree_entry(tree, parent_path)
+        if parent is None:
+            continue
+        for entry in parent:
+            if entry.name == parts[depth]:
+                continue
+            if entry.type_str == "tree":
+                if entry.name == "keymaps":
+                    keymap = _tree_entry(entry, firmware.keymap)
+                    update(f"{parent_path}/keymaps/{firmware.keymap}", str(keymap.id) if keymap is not None else "-")
+                    continue
+                if _is_keyboard_tree(entry):
+                    continue
+            update(f"{parent_path}/{entry.name}", str(entry.id))
+    keyboard = _tree_entry(tree, keyboard_path)
+    update(keyboard_path, str(keyboard.id) if keyboard is not None else "-")
+    return digest.hexdigest()
+
+
+# Paths of the QMK core read by the generators of the config headers, rules and keymap sources:
+# their schemas and mappings, and the generators themselves.
+QMK_GENERATOR_PATHS: Sequence[str] = ("data", "lib/python")
+
+
+def fingerprint_covers(firmware: Firmware, path: str) -> bool:
+    return (
+        path.split("/", 1)[0] in QMK_CORE_PATHS
+        or path.startswith("keyboards/bastardkb/")
+        or path.startswith(f"users/{firmware.keymap}/")
+    )
+
+
+# Paths of the QMK core that are only built for one architecture.
+ARCHITECTURE_PATHS: dict[str, Sequence[str]] = {
+    "avr": ("platforms/avr", "lib/lufa", "tmk_core/protocol/lufa"),
+    "arm": ("platforms/chibios", "lib/chibios", "lib/chibios-contrib", "lib/pico-sdk", "tmk_core/protocol/chibios"),
+}
+
+
+def _path_within(path: str, directory: str) -> bool:
+    return path == directory or path.startswith(f"{directory}/")
+
+
+def sparse_checkout_paths(tree, firmwares: Sequence[Firmware]) -> Sequence[str]:
+    """Return the directories of a QMK tree that the firmwares need, for a cone mode sparse checkout.
+
+    The files at the top of the tree and of the parents of these directories (eg. `Makefile` and
+    `paths.mk`) are always part of the checkout.
+    """
+    paths = {path for path in QMK_CORE_PATHS if getattr(_tree_entry(tree, path), "type_str", None) == "tree"}
+    for firmware in firmwares:
+        paths.update(("keyboards/bastardkb", f"users/{firmware.keymap}"))
+    return sorted(paths)
+
+
+def sparse_checkout_cone(repository) -> Optional[Sequence[str]]:
+    """Return the directories of the cone mode sparse checkout of a worktree, or None if it has none."""
+    try:
+        if not (repository.config.get_bool("core.sparseCheckout") and repository.config.get_bool("core.sparseCheckoutCone")):
+            return None
+        with open(os.path.join(repository.path, "info", "sparse-checkout")) as fd:
+            patterns = fd.read().split()
+    except (KeyError, OSError):
+        return None
+    # Directories are recursive unless a pattern excludes their subdirectories.
+    return sorted(
+        pattern.strip("/")
+        for pattern in patterns
+        if pattern.startswith("/") and pattern.endswith("/") and f"!{pattern}*/" not in patterns
+    )
+
+
+def in_sparse_checkout(path: str, cone: Sequence[str]) -> bool:
+    parent = path.rpartition("/")[0]
+    return (
+        not parent
+        or any(_path_within(path, directory) for directory in cone)
+        or any(_path_within(directory, parent) for directory in cone)
+    )
+
+
+def worktree_changes(repository) -> set[str]:
+    """Return the paths of a worktree with uncommitted changes.
+
+    libgit2 does not support sparse checkouts, and reports the files left out of one as deleted.
+    """
+    from pygit2 import GIT_STATUS_CURRENT, GIT_STATUS_IGNORED, GIT_STATUS_WT_DELETED
+
+    cone = sparse_checkout_cone(repository)
+    return {
+        path
+        for path, flags in repository.status().items()
+        if flags not in (GIT_STATUS_CURRENT, GIT_STATUS_IGNORED)
+        and not (cone is not None and flags == GIT_STATUS_WT_DELETED and not in_sparse_checkout(path, cone))
+    }
+
+
+def firmware_affected_by(trees: Sequence, firmware: Firmware, path: str) -> bool:
+    """Whether a change to `path` can affect the build of `firmware`.
+
+    Follows the inputs hashed by `firmware_fingerprint`, except that architecture-specific parts of
+    the core only affect the firmwares of that architecture.  `trees` (eg. both sides of a diff) are
+    used to tell sibling keyboards apart from directories of shared sources.
+    """
+    for architecture, architecture_paths in ARCHITECTURE_PATHS.items():
+        if any(_path_within(path, architecture_path) for architecture_path in architecture_paths):
+            return architecture == firmware_architecture(firmware)
+    if path.split("/", 1)[0] in QMK_CORE_PATHS or _path_within(path, f"users/{firmware.keymap}"):
+        return True
+
+    keyboard_path = f"keyboards/bastardkb/{firmware.keyboard}"
+    if _path_within(path, keyboard_path):
+        return True
+    parts = keyboard_path.split("/")
+    path_parts = path.split("/")
+    for depth in range(2, len(parts)):
+        if path_parts[:depth] != parts[:depth]:
+            return False
+        if len(path_parts) == depth + 1:
+            # A file of a parent directory, eg. `keyboards/bastardkb/skeletyl/config.h`.
+            return True
+        name = path_parts[depth]
+        if name == parts[depth]:
+            continue
+        if name == "keymaps":
+            return path_parts[depth + 1] == firmware.keymap
+        subtree_path = "/".join(path_parts[: depth + 1])
+        return not any(
+            subtree is not None and _is_keyboard_tree(subtree)
+            for subtree in (_tree_entry(tree, subtree_path) for tree in trees)
+        )
+    return False
+
+
+def stale_submodules(repository_path: str) -> Sequence[str]:
+    """Return the submodules whose checkout does not match the gitlink recorded in HEAD.
+
+    Submodules are checked recursively: a submodule is also stale if any of its own submodules is.
+    """
+    from pygit2 import GitError, Repository
+
+    repository = Repository(repository_path)
+    tree = repository[repository.head.target].tree
+    stale_paths = []
+    for path in repository.listall_submodules():
+        gitlink = _tree_entry(tree, path)
+        if gitlink is None:
+            continue
+        submodule_path = os.path.join(repository_path, path)
+        # Uninitialized submodules are empty directories, in which pygit2 would find the superproject.
+        if not os.path.exists(os.path.join(submodule_path, ".git")):
+            stale_paths.append(path)
+            continue
+        try:
+            submodule = Repository(submodule_path)
+            if submodule.head.target != gitlink.id or stale_submodules(submodule_path):
+                stale_paths.append(path)
+        except GitError:
+            stale_paths.append(path)
+    return stale_paths
+
+
+class BuildCache(object):
+    """A local, size-bounded cache of firmware artifacts keyed by build fingerprint.
+
+    Each entry is a directory holding a single artifact.  The modification time of the entry
+    records its last use, and the least recently used entries are evicted once the cache grows
+    past `max_bytes`.
+    """
+
+    def __init__(self, reporter: Reporter, cache_dir: Path, max_bytes: int):
+        self.reporter = reporter
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        # Running estimate of the cache size, so that a full scan only happens past `max_bytes`.
+        self._size: Optional[int] = None
+        make_private_dir(str(cache_dir))
+
+    def _entry(self, fingerprint: str) -> Path:
+        return self.cache_dir / fingerprint[:2] / fingerprint
+
+    def lookup(self, fingerprint: str) -> Optional[Path]:
+        """Return the artifact cached for `fingerprint`, recording its use."""
+        entry = self._entry(fingerprint)
+        try:
+            artifact = next(f for f in entry.iterdir() if f.is_file() and not f.is_symlink())
+            os.utime(entry)
+        except (OSError, StopIteration):
+            return None
+        return artifact
+
+    def restore(self, fingerprint: str, destination_dir: Path) -> Optional[Path]:
+        artifact = self.lookup(fingerprint)
+        try:
+            if artifact is None:
+                raise FileNotFoundError(fingerprint)
+            target = destination_dir / artifact.name
+            # Explicitly remove pre-existing symlinks/files to prevent arbitrary file overwrite attacks
+            if target.exists() or target.is_symlink():
+                target.unlink()
+            shutil.copyfile(artifact, target)
+        except OSError:
+            self.reporter.debug(f"cache miss: {fingerprint}")
+            return None
+        self.reporter.debug(f"cache hit: {fingerprint} -> {target}")
+        return target
+
+    def prefetch(self, fingerprints: Iterable[str]) -> None:
+        """Nothing to do: local lookups are cheap enough to be done by `restore`."""
+
+    def store(self, fingerprint: str, artifact: Path) -> None:
+        entry = self._entry(fingerprint)
+        try:
+            entry.parent.mkdir(mode=0o700, exist_ok=True)
+            staging = Path(tempfile.mkdtemp(dir=entry.parent))
+            shutil.copyfile(artifact, staging / artifact.name)
+            try:
+                staging.rename(entry)
+            except OSError:
+                # Stored concurrently by another run.
+                shutil.rmtree(staging, ignore_errors=True)
+                return
+            size = artifact.stat().st_size
+        except OSError:
+            self.reporter.logging.exception(f"failed to store {artifact} in the build cache")
+            return
+        self.reporter.debug(f"cache store: {fingerprint} <- {artifact}")
+        if self._size is None:
+            self.evict()
+        else:
+            self._size += size
+            if self._size > self.max_bytes:
+                self.evict()
+
+    def evict(self) -> None:
+        entries = [entry for bucket in self.cache_dir.iterdir() if bucket.is_dir() for entry in bucket.iterdir()]
+        self._size = evict_least_recently_used(self.reporter, entries, self.max_bytes)
+
+
+# Protocol of the build cache server: `GET` and `PUT /artifacts/<fingerprint>`, with the name and
+# the SHA-256 of the artifact in headers.  A shared token, if set in the environment of the server
+# and of the clients, is required as a bearer token.
+REMOTE_CACHE_NAME_HEADER = "X-Artifact-Name"
+REMOTE_CACHE_SHA256_HEADER = "X-Artifact-SHA256"
+REMOTE_CACHE_TOKEN_ENV = "BKB_CACHE_TOKEN"
+REMOTE_CACHE_MAX_ARTIFACT_BYTES = 16 * 1024 * 1024
+FINGERPRINT_PATTERN = re.compile(r"[0-9a-f]{64}")
+
+# Requests to the cache server in flight at once.
+REMOTE_CACHE_CONNECTIONS = 4
+
+
+def valid_artifact_name(name: str) -> bool:
+    return bool(name) and not name.startswith(".") and "/" not in name and "\\" not in name
+
+
+def parse_address(value: str) -> tuple[str, int]:
+    host, _, port = value.rpartition(":")
+    if not port.isdigit() or not 0 <= int(port) <= 65535:
+        raise argparse.ArgumentTypeError(f"invalid address '{value}', expected [HOST:]PORT")
+    return host or "127.0.0.1", int(port)
+
+
+def parse_cache_url(value: str) -> str:
+    if not re.match(r"https?://[^/]", value):
+        raise argparse.ArgumentTypeError(f"invalid cache URL '{value}', expected http(s)://HOST[:PORT]")
+    return value.rstrip("/")
+
+
+def is_loopback_host(host: str) -> bool:
+    if host == "localhost":
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
+
+
+def make_cache_server(reporter: Reporter, address: tuple[str, int], cache: BuildCache, token: Optional[str] = None):
+    """Create an HTTP server sharing `cache` between build runners.
+
+    Requests are served concurrently; stores are serialized, so that the eviction of the cache sees
+    them all.  Without a token, the server only listens on the loopback interface: anyone who can
+    reach it can replace the cached firmwares.
+    """
+    if not token and not is_loopback_host(address[0]):
+        raise ValueError(f"{REMOTE_CACHE_TOKEN_ENV} must be set to serve the build cache on {address[0]}")
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    store_lock = threading.Lock()
+
+    # Defined here, as http.server is only imported when serving.
+    class CacheRequestHandler(BaseHTTPRequestHandler):
+        def _fingerprint(self) -> Optional[str]:
+            prefix, _, fingerprint = self.path.rpartition("/")
+            if prefix != "/artifacts" or not FINGERPRINT_PATTERN.fullmatch(fingerprint):
+                self.send_error(404)
+                return None
+            if token and not hmac.compare_digest(self.headers.get("Authorization", ""), f"Bearer {token}"):
+                self.send_error(401)
+                return None
+            return fingerprint
+
+        def do_GET(self) -> None:
+            fingerprint = self._fingerprint()
+            if fingerprint is None:
+                return
+            artifact = cache.lookup(fingerprint)
+            try:
+                data = artifact.read_bytes() if artifact is not None else None
+            except OSError:
+                data = None
+            if data is None:
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", "application/octet-stream")
+            self.send_header("Content-Length", str(len(data)))
+            self.send_header(REMOTE_CACHE_NAME_HEADER, artifact.name)
+            self.send_header(REMOTE_CACHE_SHA256_HEADER, hashlib.sha256(data).hexdigest())
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_PUT(self) -> None:
+            fingerprint = self._fingerprint()
+            if fingerprint is None:
+                return
+            name = self.headers.get(REMOTE_CACHE_NAME_HEADER, "")
+            try:
+                length = int(self.headers.get("Content-Length", ""))
+            except ValueError:
+                self.send_error(411)
+                return
+            if not valid_artifact_name(name):
+                self.send_error(400, "Invalid artifact name")
+                return
+            if not 0 < length <= REMOTE_CACHE_MAX_ARTIFACT_BYTES:
+                self.send_error(413)
+                return
+            data = self.rfile.read(length)
+            if hashlib.sha256(data).hexdigest() != self.headers.get(REMOTE_CACHE_SHA256_HEADER):
+                self.send_error(400, "SHA-256 mismatch")
+                return
+            with tempfile.TemporaryDirectory() as staging:
+                artifact = Path(staging, name)
+                artifact.write_bytes(data)
+                with store_lock:
+                    cache.store(fingerprint, artifact)
+            self.send_response(204)
+            self.end_headers()
+
+        def log_message(self, format: str, *args) -> None:
+            reporter.debug(f"cache server: {self.address_string()} {format % args}")
+
+    server = ThreadingHTTPServer(address, CacheRequestHandler)
+    server.daemon_threads = True
+    return server
+
+
+class RemoteBuildCache(object):
+    """A build cache shared between build runners through a cache server, in front of a `local` one.
+
+    Artifacts are checked against their SHA-256 on both ends.  A cache server that cannot be reached
+    in `timeout` seconds is not used for the rest of the run: the firmwares are compiled locally.
+    Requests run on a few threads of their own, so that a slow server does not hold up the
+    scheduling of the compiles: uploads in the background, and lookups batched by `prefetch`.
+    """
+
+    def __init__(self, reporter: Reporter, local: BuildCache, url: str, timeout: float, token: Optional[str] = None):
+        self.reporter = reporter
+        self.local = local
+        self.url = url
+        self.timeout = timeout
+        self.token = token
+        self.available = True
+        self.hits = 0
+        self.stores = 0
+        self._lock = threading.Lock()
+        self._pool = ThreadPoolExecutor(max_workers=REMOTE_CACHE_CONNECTIONS, thread_name_prefix="remote-cache")
+        self._lookups: dict[str, Future] = {}
+
+    def _request(self, method: str, fingerprint: str, data: Optional[bytes] = None, headers: Optional[dict[str, str]] = None):
+        from urllib.request import Request, urlopen
+
+        request = Request(f"{self.url}/artifacts/{fingerprint}", data=data, headers=headers or {}, method=method)
+        if self.token:
+            request.add_header("Authorization", f"Bearer {self.token}")
+        return urlopen(request, timeout=self.timeout)
+
+    def _failed(self, method: str, fingerprint: str, error: Exception) -> None:
+        from urllib.error import HTTPError
+
+        if isinstance(error, HTTPError) and error.code not in (401, 403):
+            self.reporter.debug(f"remote cache: {method} {fingerprint}: {error}")
+            return
+        with self._lock:
+            if not self.available:
+                return
+            self.available = False
+        self.reporter.warn(f"Remote build cache disabled, compiling locally: {error}")
+
+    def _download(self, fingerprint: str) -> Optional[tuple[str, Optional[str], bytes]]:
+        from urllib.error import HTTPError, URLError
+
+        if not self.available:
+            return None
+        try:
+            with self._request("GET", fingerprint) as response:
+                name = response.headers.get(REMOTE_CACHE_NAME_HEADER, "")
+                sha256 = response.headers.get(REMOTE_CACHE_SHA256_HEADER)
+                data = response.read(REMOTE_CACHE_MAX_ARTIFACT_BYTES + 1)
+        except (URLError, OSError) as e:
+            if not (isinstance(e, HTTPError) and e.code == 404):
+                self._failed("GET", fingerprint, e)
+            return None
+        return name, sha256, data
+
+    def _upload(self, fingerprint: str, name: str, data: bytes) -> None:
+        from urllib.error import URLError
+
+        if not self.available:
+            return
+        headers = {
+            "Content-Type": "application/octet-stream",
+            REMOTE_CACHE_NAME_HEADER: name,
+            REMOTE_CACHE_SHA256_HEADER: hashlib.sha256(data).hexdigest(),
+        }
+        try:
+            with self._request("PUT", fingerprint, data, headers):
+                with self._lock:
+                    self.stores += 1
+        except (URLError, OSError) as e:
+            self._failed("PUT", fingerprint, e)
+
+    def prefetch(self, fingerprints: Iterable[str]) -> None:
+        """Start looking up the artifacts missing from the local cache, for `restore` to pick up."""
+        if not self.available:
+            return
+        for fingerprint in fingerprints:
+            if fingerprint not in self._lookups and self.local.lookup(fingerprint) is None:
+                self._lookups[fingerprint] = self._pool.submit(self._download, fingerprint)
+
+    def restore(self, fingerprint: str, destination_dir: Path) -> Optional[Path]:
+        restored = self.local.restore(fingerprint, destination_dir)
+        lookup = self._lookups.pop(fingerprint, None)
+        if restored is not None or not self.available:
+            return restored
+        downloaded = (lookup or self._pool.submit(self._download, fingerprint)).result()
+        if downloaded is None:
+            return None
+        name, sha256, data = downloaded
+        if not valid_artifact_name(name) or hashlib.sha256(data).hexdigest() != sha256:
+            self.reporter.warn(f"Ignoring a corrupted artifact from the remote build cache: {fingerprint}")
+            return None
+        target = destination_dir / name
+        try:
+            # Explicitly remove pre-existing symlinks/files to prevent arbitrary file overwrite attacks
+            if target.exists() or target.is_symlink():
+                target.unlink()
+            target.write_bytes(data)
+        except OSError:
+            self.reporter.logging.exception(f"failed to restore {target} from the remote build cache")
+            return None
+        self.local.store(fingerprint, target)
+        self.hits += 1
+        self.reporter.debug(f"remote cache hit: {fingerprint} -> {target}")
+        return target
+
+    def store(self, fingerprint: str, artifact: Path) -> None:
+        self.local.store(fingerprint, artifact)
+        if not self.available:
+            return
+        try:
+            data = artifact.read_bytes()
+        except OSError:
+            self.reporter.logging.exception(f"failed to read {artifact} for the remote build cache")
+            return
+        self._pool.submit(self._upload, fingerprint, artifact.name, data)
+
+    def close(self, cancel: bool = False) -> None:
+        """Wait for the requests in flight, and with `cancel`, drop the queued ones."""
+        self._pool.shutdown(wait=True, cancel_futures=cancel)
+
+
+def directory_size(path: Path) -> int:
+    size = 0
+    for dirpath, _, filenames in os.walk(path):
+        for filename in filenames:
+            try:
+                size += os.lstat(os.path.join(dirpath, filename)).st_size
+            except OSError:
+                continue
+    return size
+
+
+def evict_least_recently_used(reporter: Reporter, entries: Sequence[Path], max_bytes: int) -> int:
+    """Remove the least recently used (oldest mtime) `entries` until they fit in `max_bytes`.
+
+    Returns the size of the remaining entries.
+    """
+    sized_entries = []
+    for entry in entries:
+        try:
+            sized_entries.append((entry.stat().st_mtime, directory_size(entry), entry))
+        except OSError:
+            continue
+    total_bytes = sum(size for _, size, _ in sized_entries)
+    for _, size, entry in sorted(sized_entries):
+        if total_bytes <= max_bytes:
+            break
+        reporter.debug(f"evict: {entry}")
+        shutil.rmtree(entry, ignore_errors=True)
+        total_bytes -= size
+    return total_bytes
+
+
+class BuildDirectories(object):
+    """Persistent QMK build directories (`BUILD_DIR`), isolated per firmware or per compile slot.
+
+    With the "target" layout, each firmware gets its own build directory, so that its objects stay
+    valid from one release to the next whatever else gets compiled in between.  With the "slot"
+    layout, each concurrent compile slot of a worktree gets its own build directory, which bounds
+    the disk usage at the cost of fewer incremental rebuilds.  The "worktree" layout is QMK's
+    default: a single `.build` directory shared by all the firmwares of a worktree.
+
+    Build directories are stored under `root/<worktree>/`, and the least recently used ones are
+    removed once they grow past `max_bytes`.
+    """
+
+    LAYOUTS = ("target", "slot", "worktree")
+
+    def __init__(self, reporter: Reporter, root: Path, layout: str, max_bytes: int):
+        self.reporter = reporter
+        self.root = root
+        self.layout = layout
+        self.max_bytes = max_bytes
+        if layout != "worktree":
+            make_private_dir(str(root))
+
+    def path(self, firmware: Firmware, worktree: Worktree, slot: int) -> Optional[Path]:
+        if self.layout == "worktree":
+            return None
+        worktree_name = worktree.name.replace("/", "_").replace("\\", "_")
+        if self.layout == "slot":
+            return self.root / worktree_name / f"slot-{slot}"
+        env_digest = hashlib.sha256("\0".join(firmware.env_vars).encode()).hexdigest()[:8]
+        return self.root / worktree_name / f"{firmware.output_filename}-{env_digest}"
+
+    def conflict_key(self, firmware: Firmware, worktree: Worktree) -> Optional[tuple[str, ...]]:
+        if self.layout == "slot":
+            # Slots own their build directory: the scheduler never runs two compiles in one slot.
+            return None
+        if self.layout == "target":
+            return (str(self.path(firmware, worktree, 0)),)
+        return (str(worktree.path), firmware.output_filename)
+
+    def acquire(self, firmware: Firmware, worktree: Worktree, slot: int) -> Optional[Path]:
+        build_dir = self.path(firmware, worktree, slot)
+        if build_dir is not None:
+            if build_dir.is_symlink():
+                build_dir.unlink()
+            build_dir.mkdir(mode=0o700, parents=True, exist_ok=True)
+            # Record the use of the directory for the LRU cleanup.
+            os.utime(build_dir)
+        return build_dir
+
+    def prune(self) -> None:
+        if self.layout == "worktree" or not self.root.is_dir():
+            return
+        entries = [entry for worktree_dir in self.root.iterdir() if worktree_dir.is_dir() for entry in worktree_dir.iterdir()]
+        evict_least_recently_used(self.reporter, entries, self.max_bytes)
+
+    def clean(self) -> None:
+        if self.layout == "worktree":
+            return
+        shutil.rmtree(self.root, ignore_errors=True)
+        make_private_dir(str(self.root))
+
+
+# The tmpfs holding the in-memory build directories, and the space a build directory of each
+# architecture takes (objects, dependency files and intermediate ELFs).
+TMPFS_ROOT = Path("/dev/shm")
+TMPFS_BUILD_DIR_ESTIMATES: dict[str, int] = {
+    "avr": 16 * 1024 * 1024,
+    "arm": 64 * 1024 * 1024,
+}
+
+
+class TmpfsBuildDirectories(BuildDirectories):
+    """Build directories in memory, falling back to the `disk` ones when the tmpfs runs out of space.
+
+    QMK copies the firmware itself to the worktree, so nothing is copied back out of the tmpfs.
+    Unless `persist` is set, the build directories are removed once the build is done; otherwise
+    they are kept in the tmpfs, with the same paths, for the incremental builds of the next runs.
+    """
+
+    def __init__(
+        self, reporter: Reporter, root: Path, layout: str, max_bytes: int, disk: BuildDirectories, persist: bool
+    ):
+        super().__init__(reporter, root, layout, max_bytes)
+        self.disk = disk
+        self.persist = persist
+
+    @classmethod
+    def open(
+        cls,
+        reporter: Reporter,
+        disk: BuildDirectories,
+        firmwares: Sequence[FirmwareList],
+        slots: int,
+        memory_reserve_kib: int,
+        persist: bool,
+        tmpfs_root: Path = TMPFS_ROOT,
+    ) -> Optional[TmpfsBuildDirectories]:
+        """Open build directories in `tmpfs_root` if it, and the memory, have room for `firmwares`."""
+        if disk.layout == "worktree":
+            reporter.warn("Building in tmpfs needs isolated build directories, building on disk")
+            return None
+        needed = 0
+        for _, configurations in firmwares:
+            estimates = sorted((TMPFS_BUILD_DIR_ESTIMATES[firmware_architecture(f)] for f in configurations), reverse=True)
+            needed += sum(estimates[:slots] if disk.layout == "slot" else estimates)
+        root = tmpfs_root / f"bastardkb-qmk-{os.getuid()}"
+        try:
+            usage = shutil.disk_usage(tmpfs_root)
+            make_private_dir(str(root))
+            # Another user may have created the directory first.
+            if root.stat().st_uid != os.getuid():
+                raise PermissionError(f"{root} is not owned by the current user")
+        except OSError as e:
+            reporter.warn(f"Cannot build in tmpfs, building on disk: {e}")
+            return None
+        available = usage.free + (directory_size(root / "build") if persist else 0)
+        available_memory_kib = read_available_memory_kib()
+        if available_memory_kib is not None:
+            available = min(available, (available_memory_kib - memory_reserve_kib) * 1024)
+        if needed > available:
+            reporter.warn(
+                f"Not enough memory to build in tmpfs ({needed // (1024 * 1024)} MiB needed,"
+                f" {max(0, available) // (1024 * 1024)} MiB available), building on disk"
+            )
+            return None
+        reporter.debug(f"building in tmpfs: {root} ({needed // (1024 * 1024)} MiB estimated)")
+        return cls(reporter, root / "build", disk.layout, min(disk.max_bytes, available), disk, persist)
+
+    def acquire(self, firmware: Firmware, worktree: Worktree, slot: int) -> Optional[Path]:
+        build_dir = self.path(firmware, worktree, slot)
+        try:
+            free = shutil.disk_usage(self.root).free
+        except OSError:
+            free = 0
+        # A build directory in use grows in place: only new ones need the room.
+        if not build_dir.is_dir() and free < TMPFS_BUILD_DIR_ESTIMATES[firmware_architecture(firmware)]:
+            self.reporter.debug(f"tmpfs full, building {firmware} on disk")
+            return self.disk.acquire(firmware, worktree, slot)
+        return super().acquire(firmware, worktree, slot)
+
+    def prune(self) -> None:
+        if self.persist:
+            super().prune()
+        else:
+            shutil.rmtree(self.root, ignore_errors=True)
+        self.disk.prune()
+
+
+class ChildUsage(NamedTuple):
+    user_time: float
+    system_time: float
+    max_rss_kib: int
+
+    @classmethod
+    def from_rusage(cls, rusage) -> "ChildUsage":
+        # ru_maxrss is reported in bytes on macOS, and in KiB everywhere else.
+        max_rss_kib = rusage.ru_maxrss // 1024 if sys.platform == "darwin" else rusage.ru_maxrss
+        return cls(rusage.ru_utime, rusage.ru_stime, max_rss_kib)
+
+
+class CompletedRun(subprocess.CompletedProcess):
+    def __init__(self, args, returncode: int, usage: Optional[ChildUsage] = None, timed_out: bool = False):
+        super().__init__(args, returncode)
+        self.usage = usage
+        self.timed_out = timed_out
+
+
+def firmware_key(firmware: Firmware) -> str:
+    return f"{firmware}:{firmware.output_filename}:{','.join(firmware.env_vars)}"
+
+
+class BuildReport(object):
+    """Collect the timings of every build phase, and the resource usage of every compile.
+
+    Phases are either global (eg. a submodule update, with the branch as detail) or attached to a
+    firmware.  The report is written as JSON next to the artifacts, to track regressions between
+    releases and find the slowest targets.
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        self._lock = threading.Lock()
+        self._phases: list[dict[str, Any]] = []
+        self._targets: dict[str, dict[str, Any]] = {}
+        self._summary: dict[str, Any] = {}
+
+    def _target(self, firmware: Firmware) -> dict[str, Any]:
+        key = firmware_key(firmware)
+        if key not in self._targets:
+            self._targets[key] = {
+                "key": key,
+                "firmware": str(firmware),
+                "keyboard": firmware.keyboard,
+                "keymap": firmware.keymap,
+                "env_vars": list(firmware.env_vars),
+                "output_filename": firmware.output_filename,
+                "architecture": firmware_architecture(firmware),
+                "phases": {},
+            }
+        return self._targets[key]
+
+    @contextmanager
+    def phase(self, name: str, firmware: Optional[Firmware] = None, **details):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_phase(name, time.perf_counter() - started, firmware, **details)
+
+    def add_phase(self, name: str, duration: float, firmware: Optional[Firmware] = None, **details) -> None:
+        with self._lock:
+            if firmware is None:
+                self._phases.append({"name": name, "duration": round(duration, 6), **details})
+            else:
+                phases = self._target(firmware)["phases"]
+                phases[name] = round(phases.get(name, 0.0) + duration, 6)
+
+    def record_target(self, firmware: Firmware, usage: Optional[ChildUsage] = None, **fields) -> None:
+        with self._lock:
+            target = self._target(firmware)
+            target.update(fields)
+            if usage is not None:
+                target["usage"] = usage._asdict()
+
+    def target_fields(self, firmware: Firmware) -> dict[str, Any]:
+        with self._lock:
+            return dict(self._targets.get(firmware_key(firmware), {}))
+
+    def record_summary(self, **fields) -> None:
+        with self._lock:
+            self._summary.update(fields)
+
+    def to_json(self) -> dict[str, Any]:
+        with self._lock:
+            targets = sorted(self._targets.values(), key=lambda target: -sum(target["phases"].values()))
+            return {
+                "started": self.started,
+                "duration": round(time.time() - self.started, 6),
+                **self._summary,
+                "phases": list(self._phases),
+                "targets": targets,
+            }
+
+    def write(self, path: Path) -> None:
+        staging = path.with_name(f".{path.name}.tmp")
+        staging.write_text(json.dumps(self.to_json(), indent=2))
+        staging.replace(path)
+
+
+# Compile time estimates of the firmwares without history, in seconds.  ARM builds (ChibiOS) take
+# a few times longer than AVR ones.
+ARCHITECTURE_COMPILE_ESTIMATES: dict[str, float] = {
+    "avr": 15.0,
+    "arm": 40.0,
+}
+
+
+class DurationHistory(object):
+    """The compile durations of the firmwares over past runs, to estimate the cost of each compile.
+
+    Durations are smoothed with an exponential moving average.  Firmwares without history are
+    estimated from the average of their architecture, or from `ARCHITECTURE_COMPILE_ESTIMATES`.
+    """
+
+    VERSION = 1
+    SMOOTHING = 0.5
+
+    def __init__(self, path: Path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._durations: dict[str, dict[str, Any]] = {}
+        try:
+            history = json.loads(path.read_text())
+            if history.get("version") == self.VERSION:
+                self._durations = history["firmwares"]
+        except (OSError, ValueError, KeyError, AttributeError):
+            pass
+        self._architecture_estimates = dict(ARCHITECTURE_COMPILE_ESTIMATES)
+        for architecture in ARCHITECTURE_COMPILE_ESTIMATES:
+            durations = [
+                entry["duration"] for entry in self._durations.values() if entry.get("architecture") == architecture
+            ]
+            if durations:
+                self._architecture_estimates[architecture] = sum(durations) / len(durations)
+
+    def estimate(self, firmware: Firmware) -> float:
+        entry = self._durations.get(firmware_key(firmware))
+        if entry is not None:
+            return entry["duration"]
+        return self._architecture_estimates[firmware_architecture(firmware)]
+
+    def record(self, firmware: Firmware, duration: float) -> None:
+        self.record_key(firmware_key(firmware), firmware_architecture(firmware), duration)
+
+    def record_key(self, key: str, architecture: str, duration: float) -> None:
+        with self._lock:
+            previous = self._durations.get(key)
+            if previous is not None:
+                duration = self.SMOOTHING * duration + (1 - self.SMOOTHING) * previous["duration"]
+            self._durations[key] = {"duration": round(duration, 3), "architecture": architecture}
+
+    def save(self) -> None:
+        with self._lock:
+            make_private_dir(str(self.path.parent))
+            staging = self.path.with_name(f".{self.path.name}.tmp")
+            if staging.is_symlink():
+                staging.unlink()
+            staging.write_text(json.dumps({"version": self.VERSION, "firmwares": self._durations}))
+            staging.replace(self.path)
+
+
+class BuildJournal(object):
+    """Record the firmwares built into the output directory, to resume an interrupted build.
+
+    Each entry holds the fingerprint of the inputs of a firmware and the name and digest of its
+    artifact.  The journal is rewritten atomically after every firmware, so that it survives a
+    crash or an interruption at any point.
+    """
+
+    FILENAME = ".build-journal.json"
+
+    def __init__(self, output_dir: Path, resume: bool):
+        self.output_dir = output_dir
+        self.path = output_dir / self.FILENAME
+        self._lock = threading.Lock()
+        self._entries: dict[str, dict[str, str]] = {}
+        if resume:
+            try:
+                journal = json.loads(self.path.read_text())
+                if journal.get("version") == BUILD_CACHE_VERSION:
+                    self._entries = journal["firmwares"]
+            except (OSError, ValueError, KeyError, AttributeError):
+                pass
+        self._write()
+
+    def _write(self) -> None:
+        staging = self.path.with_name(f".{self.path.name}.tmp")
+        if staging.is_symlink():
+            staging.unlink()
+        staging.write_text(json.dumps({"version": BUILD_CACHE_VERSION, "firmwares": self._entries}))
+        staging.replace(self.path)
+
+    def lookup(self, firmware: Firmware, fingerprint: Optional[str]) -> Optional[Path]:
+        """Return the artifact of `firmware` if it was built from the same inputs, and is unchanged."""
+        entry = self._entries.get(firmware_key(firmware))
+        if fingerprint is None or entry is None or entry.get("fingerprint") != fingerprint:
+            return None
+        artifact = self.output_dir / Path(entry["artifact"]).name
+        try:
+            if artifact.is_symlink() or hashlib.sha256(artifact.read_bytes()).hexdigest() != entry["sha256"]:
+                return None
+        except OSError:
+            return None
+        return artifact
+
+    def record(self, firmware: Firmware, fingerprint: Optional[str], artifact_name: str) -> None:
+        if fingerprint is None:
+            return
+        try:
+            digest = hashlib.sha256((self.output_dir / artifact_name).read_bytes()).hexdigest()
+        except OSError:
+            return
+        with self._lock:
+            self._entries[firmware_key(firmware)] = {
+                "fingerprint": fingerprint,
+                "artifact": artifact_name,
+                "sha256": digest,
+            }
+            self._write()
+
+
+def firmware_filename_pattern(firmware: Firmware) -> re.Pattern:
+    return re.compile(
+        f"Copying (?P<filename>{re.escape(firmware.output_filename)}\\.[a-z0-9]+) to qmk_firmware folder"
+    )
+
+
+class LogScanner(object):
+    """Scan the output of `qmk compile` line by line, as it is produced.
+
+    Detects the artifact copied to the QMK folder, collects the compiler warnings and errors, and
+    forwards the build steps (eg. "Compiling: quantum/quantum.c") to `on_step`.
+    """
+
+    DIAGNOSTIC_PATTERN = re.compile(r"(?:^|\s)(?P<level>warning|error):\s|^make(?:\[\d+\])?: \*\*\*")
+    STEP_PATTERN = re.compile(r"^(?P<step>(?:Compiling|Linking|Creating|Generating|Copying|Size after)\b[^\[]*)")
+    MAX_DIAGNOSTICS = 100
+
+    def __init__(self, firmware: Firmware, on_step: Callable[[str], None] = lambda _: None):
+        self.firmware_filename: Optional[Path] = None
+        self.warnings: list[str] = []
+        self.errors: list[str] = []
+        self.duration = 0.0
+        self._artifact_pattern = firmware_filename_pattern(firmware)
+        self._on_step = on_step
+
+    def feed(self, line: str) -> None:
+        started = time.perf_counter()
+        try:
+            self._scan(line)
+        finally:
+            self.duration += time.perf_counter() - started
+
+    def _scan(self, line: str) -> None:
+        match = self._artifact_pattern.match(line)
+        if match:
+            self.firmware_filename = Path(match.group("filename"))
+        match = self.DIAGNOSTIC_PATTERN.search(line)
+        if match:
+            diagnostics = self.warnings if match.group("level") == "warning" else self.errors
+            if len(diagnostics) < self.MAX_DIAGNOSTICS:
+                diagnostics.append(line.rstrip())
+            return
+        match = self.STEP_PATTERN.match(line)
+        if match:
+            self._on_step(match.group("step").strip())
+
+
+class CcacheStats(NamedTuple):
+    hits: int = 0
+    misses: int = 0
+
+    @property
+    def hit_rate(self) -> Optional[float]:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else None
+
+    def merge(self, other: "CcacheStats") -> "CcacheStats":
+        return CcacheStats(self.hits + other.hits, self.misses + other.misses)
+
+
+CCACHE_HIT_COUNTERS = ("direct_cache_hit", "preprocessed_cache_hit")
+CCACHE_MISS_COUNTERS = ("cache_miss",)
+
+
+def read_ccache_stats_log(stats_log: Path) -> CcacheStats:
+    """Count the hits and misses recorded in a ccache stats log (`CCACHE_STATSLOG`).
+
+    Each compilation appends a `# <source file>` comment followed by the counters it incremented.
+    """
+    hits = misses = 0
+    try:
+        with stats_log.open() as fd:
+            for line in fd:
+                counter = line.strip()
+                if counter in CCACHE_HIT_COUNTERS:
+                    hits += 1
+                elif counter in CCACHE_MISS_COUNTERS:
+                    misses += 1
+    except FileNotFoundError:
+        pass
+    return CcacheStats(hits, misses)
+
+
+class Ccache(object):
+    """A ccache directory shared by every branch and run, bounded to `max_size`.
+
+    Concurrent compiles share the cache, so their statistics are collected from a stats log per
+    target rather than from the global counters, which are only zeroed once per run.
+    """
+
+    def __init__(self, reporter: Reporter, cache_dir: Path, max_size: str):
+        self.reporter = reporter
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        make_private_dir(str(cache_dir))
+
+    def env(self, stats_log: Optional[Path] = None) -> dict[str, str]:
+        env = {**os.environ, "CCACHE_DIR": str(self.cache_dir), "CCACHE_MAXSIZE": self.max_size}
+        if stats_log is not None:
+            env["CCACHE_STATSLOG"] = str(stats_log)
+        return env
+
+    def _ccache(self, *argv: str) -> Optional[str]:
+        try:
+            return subprocess.run(
+                ("ccache", *argv), env=self.env(), capture_output=True, text=True, check=True
+            ).stdout
+        except (OSError, subprocess.CalledProcessError) as e:
+            self.reporter.debug(f"ccache {' '.join(argv)} failed: {e}")
+            return None
+
+    def configure(self) -> None:
+        self._ccache("--max-size", self.max_size)
+        self._ccache("--zero-stats")
+
+    def cache_size(self) -> Optional[int]:
+        """Return the size of the cache in KiB, from `ccache --print-stats`."""
+        for line in (self._ccache("--print-stats") or "").splitlines():
+            key, _, value = line.partition("\t")
+            if key == "cache_size_kibibyte" and value.isdigit():
+                return int(value)
+        return None
+
+
+# The qmk commands that generate a file (given with --output) from the keyboard, the keymap and
+# `QMK_GENERATOR_PATHS` only.  Others, eg. `generate-version-h`, also depend on the time or on the
+# state of the repository.
+CACHED_QMK_COMMANDS: Sequence[str] = (
+    "generate-config-h",
+    "generate-keyboard-c",
+    "generate-keyboard-h",
+    "generate-keymap-h",
+    "generate-rules-mk",
+    "json2c",
+)
+
+# First argument of this script to run it in place of `qmk` (see `qmk_shim`), and its environment.
+QMK_SHIM_COMMAND = "qmk-shim"
+QMK_SHIM_QMK = "BKB_QMK"
+QMK_SHIM_CACHE_DIR = "BKB_GENERATED_CACHE_DIR"
+QMK_SHIM_FINGERPRINT = "BKB_GENERATOR_FINGERPRINT"
+
+# Maximum size of the cache of generated files.
+GENERATED_CACHE_BYTES = 64 * 1024 * 1024
+
+
+def _qmk_output_index(argv: Sequence[str]) -> Optional[int]:
+    for index, arg in enumerate(argv[:-1]):
+        if arg in ("-o", "--output"):
+            return index + 1
+    return None
+
+
+def qmk_shim(argv: Sequence[str]) -> int:
+    """Run `qmk`, serving the files it generates from a cache keyed by the inputs of the generators.
+
+    The makefiles of QMK regenerate the config headers, rules and keymap sources of a firmware
+    whenever their inputs are newer, eg. after a checkout.  A generated file whose content is
+    unchanged is left untouched, timestamp included, so that it does not trigger the rebuild of
+    everything that includes it.
+    """
+    qmk = os.environ.get(QMK_SHIM_QMK) or "qmk"
+    cache_dir = os.environ.get(QMK_SHIM_CACHE_DIR)
+    fingerprint = os.environ.get(QMK_SHIM_FINGERPRINT)
+    output_index = _qmk_output_index(argv)
+    if not (cache_dir and fingerprint and argv and argv[0] in CACHED_QMK_COMMANDS and output_index is not None):
+        os.execvp(qmk, (qmk, *argv))
+    output = Path(argv[output_index])
+
+    def with_output(path: str) -> tuple[str, ...]:
+        return (*argv[:output_index], path, *argv[output_index + 1 :])
+
+    digest = hashlib.sha256(fingerprint.encode())
+    for arg in with_output(output.name):
+        digest.update(b"\0")
+        digest.update(arg.encode())
+    entry = Path(cache_dir, digest.hexdigest()[:2], digest.hexdigest())
+    try:
+        content = (entry / output.name).read_bytes()
+        os.utime(entry)
+    except OSError:
+        try:
+            entry.parent.mkdir(mode=0o700, parents=True, exist_ok=True)
+            staging = Path(tempfile.mkdtemp(dir=entry.parent))
+        except OSError:
+            os.execvp(qmk, (qmk, *argv))
+        try:
+            returncode = subprocess.run((qmk, *with_output(str(staging / output.name)))).returncode
+            if returncode != 0:
+                return returncode
+            content = (staging / output.name).read_bytes()
+            with suppress(OSError):
+                # Stored concurrently by another compile otherwise.
+                staging.rename(entry)
+        finally:
+            shutil.rmtree(staging, ignore_errors=True)
+
+    with suppress(OSError):
+        if not output.is_symlink() and output.read_bytes() == content:
+            return 0
+    output.parent.mkdir(parents=True, exist_ok=True)
+    # Explicitly remove pre-existing symlinks/files to prevent arbitrary file overwrite attacks
+    if output.exists() or output.is_symlink():
+        output.unlink()
+    output.write_bytes(content)
+    return 0
+
+
+# The bare repository shared by the submodules of every worktree for their objects, in the bare
+# repository of the worktrees.
+SUBMODULE_OBJECTS_STORE = "bkb-submodule-objects.git"
+
+
 class QmkCompletedProcess(object):
-    def __init__(self, completed_process: subprocess.CompletedProcess, log_file: Path):
+    def __init__(
+        self,
+        completed_process: subprocess.CompletedProcess,
+        log_file: Path,
+        scanner: LogScanner,
+        duration: float,
+        ccache_stats: Optional[CcacheStats] = None,
+    ):
         self._completed_process = completed_process
         self.log_file = log_file
+        self.scanner = scanner
+        self.duration = duration
+        self.ccache_stats = ccache_stats
+
+    @property
+    def usage(self) -> Optional[ChildUsage]:
+        return getattr(self._completed_process, "usage", None)
 
     @property
     def returncode(self) -> int:
         return self._completed_process.returncode
 
+    @property
+    def timed_out(self) -> bool:
+        return getattr(self._completed_process, "timed_out", False)
+
+    @property
+    def firmware_filename(self) -> Optional[Path]:
+        return self.scanner.firmware_filename
+
+
+# Seconds a terminated child has to exit (eg. for make to delete its partial targets) before it is killed.
+PROCESS_KILL_GRACE = 1.0
+
 
 class Executor(object):
-    def __init__(self, reporter: Reporter, repository: Repository, dry_run: bool, parallel: int):
+    def __init__(
+        self,
+        reporter: Reporter,
+        repository: Repository,
+        dry_run: bool,
+        parallel: int,
+        concurrency: int = 1,
+        ccache: Optional[Ccache] = None,
+        use_ccache: bool = True,
+        generated_cache: Optional[Path] = None,
+        timeout: Optional[float] = None,
+    ):
         self.dry_run = dry_run
         self.parallel = parallel
+        self.concurrency = max(1, concurrency)
         self.reporter = reporter
         self.repository = repository
+        self.ccache = ccache
+        self.use_ccache = use_ccache
+        self.generated_cache = generated_cache
+        self.timeout = timeout
+        # `qmk_shim` stands in for qmk in the makefiles, to serve the generated files from the cache.
+        self.qmk_shim_command = (sys.executable, os.path.abspath(__file__), QMK_SHIM_COMMAND)
+        self.qmk_path = shutil.which("qmk") or "qmk"
+        self.report = BuildReport()
+        self._toolchain_versions: dict[str, str] = {}
+        self._worktree_trees: dict[str, tuple] = {}
+        self._worktree_trees_lock = threading.Lock()
+        # The children run in their own process group, so that their whole tree can be signalled.
+        self._processes: set[subprocess.Popen] = set()
+        self._processes_lock = threading.Lock()
+        self._cancelled = False
+
+    def make_jobs(self, slots: int) -> int:
+        return max(1, self.parallel // max(1, slots))
+
+    def git_ensure_worktree(self, branch: str, update_submodules: bool, firmwares: Sequence[Firmware] = ()) -> Worktree:
+        """Return the worktree of the branch, creating it with a sparse checkout of what the firmwares need."""
+        from pygit2 import GitError
 
-    def git_ensure_worktree(self, branch: str, update_submodules: bool) -> Worktree:
         self.reporter.progress_status(f"Checking out [bright_magenta]{branch}[/bright_magenta]…")
+        worktree_name = branch.replace("/", "_").replace("\\", "_")
         try:
-            worktree = self.repository.lookup_worktree(branch)
-            if worktree is None:
-                raise GitError
+            with self.report.phase("worktree_lookup", branch=branch):
+                worktree = self.repository.lookup_worktree(worktree_name)
         except GitError:
-            self.reporter.fatal(f"Worktree does not exist: {branch}", title="Git Error")
-            sys.exit(1)
+            worktree = None
+        if worktree is None:
+            if self.dry_run:
+                self.reporter.fatal(f"Worktree does not exist: {branch}", title="Git Error")
+                sys.exit(1)
+            with self.report.phase("worktree_create", branch=branch):
+                worktree = self.git_create_worktree(branch, worktree_name, firmwares)
+        elif not self.dry_run and firmwares:
+            with self.report.phase("worktree_sparse_checkout", branch=branch):
+                self.git_extend_sparse_checkout(worktree, firmwares)
         if not self.dry_run:
-            # TODO: checkout worktree if it does not exist.
-            # self.repository.checkout(branch_ref)
             if update_submodules:
-                self.reporter.progress_status(
-                    f"([bright_magenta]{worktree.name}[/bright_magenta]) Updating submodules…"
-                )
-                # TODO: use pygit2 to update submodules.
-                completed_process = self._run(
-                    (
-                        "git",
-                        "submodule",
-                        "update",
-                        "--init",
-                        "--recursive",
-                        "--jobs",
-                        str(self.parallel),
-                    ),
-                    log_file=self.reporter.log_file(f"git-submodule-update-{worktree.name}"),
-                    cwd=worktree.path,
-                )
-                if completed_process.returncode != 0:
-                    self.reporter.fatal(f"Failed to update submodules for {worktree.name}", title="Submodule Error")
-                    sys.exit(1)
+                self.git_update_submodules(worktree)
         else:
             self.reporter.progress_status(f"([bright_magenta]{worktree.name}[/bright_magenta]) Updating submodules…")
         return worktree
 
-    def qmk_compile(self, firmware: Firmware, worktree: Worktree) -> QmkCompletedProcess:
+    def git_create_worktree(self, branch: str, worktree_name: str, firmwares: Sequence[Firmware]) -> Worktree:
+        """Create the worktree of the branch, next to the others, with a sparse checkout.
+
+        libgit2 cannot check out part of a tree, so the branch is resolved with pygit2 (and a local
+        branch created off its remote-tracking one if needed), and checked out with git.
+        """
+        self.reporter.progress_status(f"([bright_magenta]{branch}[/bright_magenta]) Creating worktree…")
+        local_branch = self.repository.branches.local.get(branch)
+        if local_branch is None:
+            remote_branch = next(
+                (
+                    self.repository.branches.remote[name]
+                    for name in sorted(self.repository.branches.remote)
+                    if name.split("/", 1)[-1] == branch
+                ),
+                None,
+            )
+            if remote_branch is None:
+                self.reporter.fatal(f"Branch does not exist: {branch}", title="Git Error")
+                sys.exit(1)
+            local_branch = self.repository.branches.local.create(branch, remote_branch.peel())
+            local_branch.upstream = remote_branch
+        path = Path(self.repository.path if self.repository.is_bare else Path(self.repository.workdir).parent, worktree_name)
+        if path.is_symlink() or path.exists():
+            self.reporter.fatal(f"Cannot create the worktree of {branch}: {path} already exists", title="Git Error")
+            sys.exit(1)
+        tree = local_branch.peel().tree
+        for step, argv, cwd in (
+            ("worktree-add", ("git", "worktree", "add", "--quiet", "--no-checkout", str(path), branch), self.repository.workdir or self.repository.path),
+            ("sparse-checkout", ("git", "sparse-checkout", "set", "--cone", "--", *sparse_checkout_paths(tree, firmwares)), path),
+            ("checkout", ("git", "checkout", "--quiet"), path),
+        ):
+            completed_process = self._run(argv, log_file=self.reporter.log_file(f"git-{step}-{worktree_name}"), cwd=cwd)
+            if completed_process.returncode != 0:
+                self._git_failed(f"Failed to create the worktree of {branch}", title="Git Error")
+        self.reporter.info(f"  Created worktree [magenta]{worktree_name}[/] ({path})")
+        return self.repository.lookup_worktree(worktree_name)
+
+    def git_extend_sparse_checkout(self, worktree: Worktree, firmwares: Sequence[Firmware]) -> None:
+        """Add the directories the firmwares need to the sparse checkout of the worktree, if it has one."""
+        from pygit2 import GitError, Repository
+
+        try:
+            worktree_repository = Repository(worktree.path)
+            cone = sparse_checkout_cone(worktree_repository)
+            if cone is None:
+                return
+            tree = worktree_repository[worktree_repository.head.target].tree
+        except GitError:
+            self.reporter.logging.exception(f"failed to read the sparse checkout of {worktree.name}")
+            return
+        missing_paths = [
+            path for path in sparse_checkout_paths(tree, firmwares) if not any(_path_within(path, directory) for directory in cone)
+        ]
+        if not missing_paths:
+            return
+        self.reporter.progress_status(f"([bright_magenta]{worktree.name}[/bright_magenta]) Extending sparse checkout…")
+        completed_process = self._run(
+            ("git", "sparse-checkout", "add", "--", *missing_paths),
+            log_file=self.reporter.log_file(f"git-sparse-checkout-{worktree.name}"),
+            cwd=worktree.path,
+        )
+        if completed_process.returncode != 0:
+            self._git_failed(f"Failed to extend the sparse checkout of {worktree.name}", title="Git Error")
+
+    def git_update_submodules(self, worktree: Worktree) -> None:
+        with self.report.phase("submodule_check", branch=worktree.name):
+            stale_paths = self._stale_submodules(worktree)
+        if stale_paths is not None and not stale_paths:
+            self.reporter.debug(f"({worktree.name}) submodules up to date")
+            return
+        self.reporter.progress_status(f"([bright_magenta]{worktree.name}[/bright_magenta]) Updating submodules…")
+        objects_store = self.submodule_objects_store()
+        with self.report.phase("submodule_update", branch=worktree.name):
+            completed_process = self._run(
+                (
+                    "git",
+                    "submodule",
+                    "update",
+                    "--init",
+                    "--recursive",
+                    "--jobs",
+                    str(self.parallel),
+                    # New clones borrow the objects of the store, and only fetch the missing ones.
+                    *(("--reference", str(objects_store)) if objects_store is not None else ()),
+                    *(("--", *stale_paths) if stale_paths else ()),
+                ),
+                log_file=self.reporter.log_file(f"git-submodule-update-{worktree.name}"),
+                cwd=worktree.path,
+            )
+        if completed_process.returncode != 0:
+            self._git_failed(f"Failed to update submodules for {worktree.name}", title="Submodule Error")
+        if objects_store is not None:
+            with self.report.phase("submodule_share", branch=worktree.name):
+                self.share_submodule_objects(worktree, objects_store)
+
+    def _git_failed(self, message: str, title: str) -> None:
+        # The git commands terminated by `cancel` fail as well: the build is already being interrupted.
+        if not self._cancelled:
+            self.reporter.fatal(message, title=title)
+        sys.exit(1)
+
+    def submodule_objects_store(self) -> Optional[Path]:
+        """Return the object store shared by the submodules of every worktree, creating it if needed.
+
+        The store is a bare repository next to the worktrees of the bare repository.  Submodules
+        cloned with it as reference keep borrowing its objects (through git alternates), so it is
+        never garbage collected.
+        """
+        from pygit2 import GitError, init_repository
+
+        store = Path(self.repository.path, SUBMODULE_OBJECTS_STORE)
+        if store.is_symlink():
+            self.reporter.warn(f"Not sharing the submodule objects: {store} is a symlink")
+            return None
+        if not (store / "objects").is_dir():
+            try:
+                store_repository = init_repository(str(store), bare=True)
+                store_repository.config["gc.auto"] = 0
+                store_repository.config["gc.pruneExpire"] = "never"
+            except (GitError, OSError):
+                self.reporter.logging.exception(f"failed to create {store}")
+                return None
+        return store
+
+    def share_submodule_objects(self, worktree: Worktree, objects_store: Path) -> None:
+        """Fetch the objects of the submodules of the worktree, nested ones included, into the store."""
+        from pygit2 import GitError, Repository
+
+        try:
+            modules_dir = Path(Repository(worktree.path).path, "modules")
+        except GitError:
+            self.reporter.logging.exception(f"failed to open the worktree {worktree.name}")
+            return
+        module_dirs = sorted(
+            Path(dirpath)
+            for dirpath, dirnames, _ in os.walk(modules_dir)
+            if "objects" in dirnames and os.path.isfile(os.path.join(dirpath, "HEAD"))
+        )
+        for module_dir in module_dirs:
+            # Refs keep the objects of every worktree reachable in the store.
+            namespace = hashlib.sha256(f"{worktree.name}\0{module_dir.relative_to(modules_dir)}".encode()).hexdigest()[:16]
+            completed_process = self._run(
+                (
+                    "git",
+                    "--git-dir",
+                    str(objects_store),
+                    "fetch",
+                    "--quiet",
+                    "--no-tags",
+                    "--no-write-fetch-head",
+                    str(module_dir),
+                    f"+HEAD:refs/bkb/{namespace}/HEAD",
+                    f"+refs/remotes/*:refs/bkb/{namespace}/remotes/*",
+                ),
+                log_file=self.reporter.log_file(f"git-share-submodule-{worktree.name}-{namespace}"),
+            )
+            if completed_process.returncode != 0:
+                self.reporter.warn(f"({worktree.name}) Failed to share the objects of {module_dir.relative_to(modules_dir)}")
+
+    def _stale_submodules(self, worktree: Worktree) -> Optional[Sequence[str]]:
+        """Return the submodules of the worktree to update, or None if they could not be checked."""
+        from pygit2 import GitError
+
+        try:
+            return stale_submodules(worktree.path)
+        except (GitError, OSError):
+            self.reporter.logging.exception(f"failed to check the submodules of {worktree.name}")
+            return None
+
+    def toolchain_version(self, architecture: str) -> str:
+        if architecture not in self._toolchain_versions:
+            versions = []
+            for argv in ((TOOLCHAIN_COMPILERS[architecture], "--version"), ("qmk", "--version")):
+                try:
+                    output = subprocess.run(argv, capture_output=True, text=True).stdout
+                    versions.append(output.strip().partition("\n")[0])
+                except OSError:
+                    versions.append(f"{argv[0]}: not found")
+            self._toolchain_versions[architecture] = "; ".join(versions)
+            self.reporter.debug(f"toolchain ({architecture}): {self._toolchain_versions[architecture]}")
+        return self._toolchain_versions[architecture]
+
+    def _worktree_tree(self, firmware: Firmware, worktree: Worktree):
+        """The tree of a worktree, or None if its uncommitted changes may affect the firmware."""
+        from pygit2 import GitError, Repository
+
+        key = str(worktree.path)
+        with self._worktree_trees_lock:
+            if key not in self._worktree_trees:
+                try:
+                    worktree_repository = Repository(worktree.path)
+                    tree = worktree_repository[worktree_repository.head.target].tree
+                    # Uncommitted changes are not part of the tree ids, so don't cache what they cover.
+                    dirty_paths = tuple(worktree_changes(worktree_repository))
+                except GitError:
+                    self.reporter.logging.exception(f"failed to read the tree of {worktree.name}")
+                    tree, dirty_paths = None, ()
+                self._worktree_trees[key] = (tree, dirty_paths)
+            tree, dirty_paths = self._worktree_trees[key]
+        if tree is None or any(fingerprint_covers(firmware, path) for path in dirty_paths):
+            return None
+        return tree
+
+    def build_fingerprint(self, firmware: Firmware, worktree: Worktree) -> Optional[str]:
+        if self.dry_run:
+            return None
+        tree = self._worktree_tree(firmware, worktree)
+        if tree is None:
+            return None
+        return firmware_fingerprint(tree, firmware, self.toolchain_version(firmware_architecture(firmware)))
+
+    def generator_fingerprint(self, firmware: Firmware, worktree: Worktree) -> Optional[str]:
+        """Hash the inputs of the files generated by the makefiles of QMK for a firmware."""
+        if self.dry_run or self.generated_cache is None:
+            return None
+        tree = self._worktree_tree(firmware, worktree)
+        if tree is None:
+            return None
+        return firmware_fingerprint(tree, firmware, "", core_paths=QMK_GENERATOR_PATHS)
+
+    def changed_paths(self, worktree: Worktree, since: str) -> tuple[Sequence, set[str]]:
+        """Return the trees of `since` and of the worktree, and the paths changed in between.
+
+        Uncommitted changes of the worktree count as changed paths.
+        """
+        from pygit2 import GitError, Repository, Tree
+
+        try:
+            worktree_repository = Repository(worktree.path)
+            head_tree = worktree_repository[worktree_repository.head.target].tree
+            since_tree = worktree_repository.revparse_single(since).peel(Tree)
+        except (GitError, KeyError, ValueError):
+            self.reporter.fatal(
+                f"Could not resolve revision '{since}' in the {worktree.name} worktree.",
+                title="Git Error",
+            )
+            sys.exit(1)
+        paths = set()
+        for delta in since_tree.diff_to_tree(head_tree).deltas:
+            paths.update((delta.old_file.path, delta.new_file.path))
+        paths.update(worktree_changes(worktree_repository))
+        return (since_tree, head_tree), paths
+
+    def qmk_compile(
+        self,
+        firmware: Firmware,
+        worktree: Worktree,
+        parallel: Optional[int] = None,
+        build_dir: Optional[Path] = None,
+    ) -> QmkCompletedProcess:
         self.reporter.progress_status(f"Compiling [bold white]{firmware}[/bold white]")
+        variables = (
+            f"TARGET={firmware.output_filename}",
+            *(("USE_CCACHE=yes",) if self.use_ccache else ()),
+            *((f"BUILD_DIR={build_dir}",) if build_dir is not None else ()),
+        )
+        generator_fingerprint = self.generator_fingerprint(firmware, worktree)
+        if generator_fingerprint is not None:
+            variables += (f"QMK_BIN={shlex.join(self.qmk_shim_command)}",)
         argv = (
             "qmk",
             "compile",
             # Optimization: do not use --clean to enable incremental builds and ccache
             "--parallel",
-            str(self.parallel),
+            str(parallel or self.parallel),
             "--keyboard",
             f"bastardkb/{firmware.keyboard}",
             "--keymap",
             firmware.keymap,
-            "--env",
-            f"TARGET={firmware.output_filename}",
-            "--env",
-            "USE_CCACHE=yes",
+            *reduce(iconcat, (("--env", variable) for variable in variables), []),
             *reduce(iconcat, (("-e", env_var) for env_var in firmware.env_vars), []),
         )
-        log_file = self.reporter.log_file(f"qmk-compile-{firmware.output_filename}")
-        return QmkCompletedProcess(self._run(argv, log_file=log_file, cwd=worktree.path), log_file)
+        # Firmwares sharing an output filename (eg. the tinyuf2 variants) may compile concurrently.
+        target_name = "-".join((firmware.output_filename, *firmware.env_vars))
+        log_file = self.reporter.log_file(f"qmk-compile-{target_name}")
+        scanner = LogScanner(firmware, on_step=partial(self.reporter.target_status, firmware))
+        kwargs = {}
+        stats_log = None
+        if self.use_ccache and self.ccache is not None:
+            # ccache appends to its stats log, which can't be compressed.
+            stats_log = self.reporter.log_file(f"ccache-stats-{target_name}", compressed=False)
+            if stats_log.exists() or stats_log.is_symlink():
+                stats_log.unlink()
+            kwargs["env"] = self.ccache.env(stats_log)
+        if generator_fingerprint is not None:
+            kwargs["env"] = {
+                **kwargs.get("env", os.environ),
+                QMK_SHIM_QMK: self.qmk_path,
+                QMK_SHIM_CACHE_DIR: str(self.generated_cache),
+                QMK_SHIM_FINGERPRINT: generator_fingerprint,
+            }
+        started = time.perf_counter()
+        try:
+            completed_process = self._run(
+                argv, log_file=log_file, scanner=scanner, timeout=self.timeout, cwd=worktree.path, **kwargs
+            )
+        finally:
+            self.reporter.target_status(firmware, None)
+        duration = time.perf_counter() - started
+        ccache_stats = read_ccache_stats_log(stats_log) if stats_log is not None and not self.dry_run else None
+        return QmkCompletedProcess(completed_process, log_file, scanner, duration, ccache_stats)
 
     def _run(
         self,
         argv: Sequence[str],
         log_file: Path,
+        scanner: Optional[LogScanner] = None,
+        timeout: Optional[float] = None,
         **kwargs,
     ) -> subprocess.CompletedProcess:
         self.reporter.debug(f"exec: {shlex.join(argv)}")
         self.reporter.debug(f"output: {log_file}")
         if not self.dry_run:
-            with log_file.open("w") as fd:
-                kwargs["stdout"] = fd
-                kwargs["stderr"] = fd
-                return subprocess.run(argv, **kwargs)
+            with self._processes_lock:
+                if self._cancelled:
+                    return CompletedRun(argv, -signal.SIGTERM)
+                fd = open_log(log_file, "w")
+                try:
+                    process = subprocess.Popen(
+                        argv,
+                        stdout=subprocess.PIPE,
+                        stderr=subprocess.STDOUT,
+                        text=True,
+                        errors="replace",
+                        start_new_session=True,
+                        **kwargs,
+                    )
+                except BaseException:
+                    fd.close()
+                    raise
+                self._processes.add(process)
+            timer, timed_out = None, threading.Event()
+            if timeout:
+
+                def time_out() -> None:
+                    timed_out.set()
+                    self._terminate(process)
+
+                timer = threading.Timer(timeout, time_out)
+                timer.daemon = True
+                timer.start()
+            try:
+                # Stream the output through a single pass that both writes the log and scans it.
+                with fd, process:
+                    try:
+                        for line in process.stdout:
+                            fd.write(line)
+                            if scanner is not None:
+                                scanner.feed(line)
+                        # Wait for the child to exit, but leave it a zombie, so that the id of its
+                        # process group can't be reused while it may still be signalled.
+                        os.waitid(os.P_PID, process.pid, os.WEXITED | os.WNOWAIT)
+                    finally:
+                        with self._processes_lock:
+                            self._processes.discard(process)
+                    # Reap the child ourselves to collect the resource usage of its whole process tree.
+                    _, status, rusage = os.wait4(process.pid, 0)
+                    process.returncode = os.waitstatus_to_exitcode(status)
+            finally:
+                if timer is not None:
+                    timer.cancel()
+            return CompletedRun(argv, process.returncode, ChildUsage.from_rusage(rusage), timed_out=timed_out.is_set())
         return subprocess.CompletedProcess(args=argv, returncode=0)
 
+    def _signal_process_group(self, process: subprocess.Popen, signum: int) -> None:
+        with self._processes_lock:
+            # Children are only reaped once out of `_processes`: the id of their process group is still theirs.
+            if process in self._processes:
+                with suppress(ProcessLookupError, PermissionError):
+                    os.killpg(process.pid, signum)
+
+    def _terminate(self, process: subprocess.Popen) -> None:
+        """Terminate the process group of a child, killing it if it still runs after `PROCESS_KILL_GRACE`."""
+        self._signal_process_group(process, signal.SIGTERM)
+        timer = threading.Timer(PROCESS_KILL_GRACE, self._signal_process_group, (process, signal.SIGKILL))
+        timer.daemon = True
+        timer.start()
+
+    def cancel(self) -> None:
+        """Terminate the running children, and refuse to start new ones."""
+        with self._processes_lock:
+            self._cancelled = True
+            processes = tuple(self._processes)
+        for process in processes:
+            self._terminate(process)
+
+
+class CompileJob(NamedTuple):
+    firmware: Firmware
+    worktree: Worktree
+    fingerprint: Optional[str] = None
+
+    @property
+    def conflict_key(self) -> tuple[str, str]:
+        # Firmwares sharing an output filename (eg. the `BOOTLOADER=tinyuf2` variants of the
+        # Blackpill builds) share their `.build/obj_<TARGET>` directory in the worktree, and
+        # must never be compiled at the same time.
+        return (str(self.worktree.path), self.firmware.output_filename)
+
+
+def default_concurrency(parallel: int) -> int:
+    # Keep a few make jobs per firmware: compilation scales with -j, but the code generation and
+    # link steps of each firmware are serial.
+    return max(1, parallel // 4)
+
+
+def compile_slots(concurrency: int, target_count: int) -> int:
+    if target_count <= 1:
+        return 1
+    return max(1, min(concurrency, target_count))
+
+
+class SystemLoad(NamedTuple):
+    load_average: Optional[float]
+    available_memory_kib: Optional[int]
+    compiles_rss_kib: int
+
+
+def read_available_memory_kib() -> Optional[int]:
+    try:
+        with open("/proc/meminfo") as fd:
+            for line in fd:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1])
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+def read_system_load(pid: Optional[int] = None) -> SystemLoad:
+    """Read the load of the machine from `/proc`, and the RSS of the descendants of `pid`.
+
+    The values that cannot be read (eg. outside of Linux) are None.
+    """
+    load_average = None
+    try:
+        fields = Path("/proc/loadavg").read_text().split()
+        # The 1-minute average lags behind: bound it by the number of currently runnable tasks.
+        load_average = min(float(fields[0]), float(fields[3].split("/")[0]))
+    except (OSError, ValueError, IndexError):
+        pass
+
+    available_memory_kib = read_available_memory_kib()
+
+    children: dict[int, list[int]] = {}
+    rss_pages: dict[int, int] = {}
+    try:
+        proc_entries = [entry for entry in os.listdir("/proc") if entry.isdigit()]
+    except OSError:
+        proc_entries = []
+    for entry in proc_entries:
+        try:
+            with open(f"/proc/{entry}/stat") as fd:
+                # The command name may hold spaces and parentheses: the fields start after the last ')'.
+                fields = fd.read().rpartition(")")[2].split()
+            children.setdefault(int(fields[1]), []).append(int(entry))
+            rss_pages[int(entry)] = int(fields[21])
+        except (OSError, ValueError, IndexError):
+            continue
+    compiles_rss_pages = 0
+    descendants = list(children.get(os.getpid() if pid is None else pid, ()))
+    while descendants:
+        descendant = descendants.pop()
+        compiles_rss_pages += rss_pages.get(descendant, 0)
+        descendants.extend(children.get(descendant, ()))
+    return SystemLoad(load_average, available_memory_kib, compiles_rss_pages * (os.sysconf("SC_PAGE_SIZE") // 1024))
+
+
+class AdmissionController(object):
+    """Decide whether to start another compile, and with what make `-j`, from the load of the machine.
+
+    The make jobs of the running compiles and of the other processes of the machine must fit within
+    `max_load`, and the expected memory use of the new jobs within the available memory, minus
+    `memory_reserve_kib`.  The memory use of a make job is the largest seen in the RSS of the running
+    compiles, and at least `DEFAULT_JOB_RSS_KIB`.  A compile is always admitted when none is running,
+    so that the build progresses.
+    """
+
+    POLL_INTERVAL = 1.0
+    DEFAULT_JOB_RSS_KIB = 256 * 1024
+
+    def __init__(
+        self,
+        reporter: Reporter,
+        max_load: float,
+        memory_reserve_kib: int,
+        read_load: Callable[[], SystemLoad] = read_system_load,
+    ):
+        self.reporter = reporter
+        self.max_load = max_load
+        self.memory_reserve_kib = memory_reserve_kib
+        self.read_load = read_load
+        self.job_rss_kib = self.DEFAULT_JOB_RSS_KIB
+        self.throttled = 0
+        self.reduced_jobs = 0
+
+    def admit(self, running: int, running_jobs: int, make_jobs: int) -> Optional[int]:
+        load = self.read_load()
+        jobs = make_jobs
+        if load.load_average is not None:
+            # The load average includes the running compiles: only count the others once.
+            other_load = max(0.0, load.load_average - running_jobs)
+            jobs = min(jobs, round(self.max_load - other_load - running_jobs))
+        if load.available_memory_kib is not None:
+            if running_jobs:
+                self.job_rss_kib = max(self.job_rss_kib, load.compiles_rss_kib // running_jobs)
+            jobs = min(jobs, (load.available_memory_kib - self.memory_reserve_kib) // self.job_rss_kib)
+        if jobs >= 1 or running == 0:
+            jobs = max(1, jobs)
+            if jobs < make_jobs:
+                self.reduced_jobs += 1
+                self.reporter.debug(f"admission: -j {jobs} instead of {make_jobs} ({load})")
+            return jobs
+        self.throttled += 1
+        self.reporter.debug(f"admission: waiting, {running} compiles running ({load})")
+        return None
+
+
+class CompileScheduler(object):
+    """Run `Executor.qmk_compile` calls concurrently within the executor's job budget.
+
+    The `--parallel` budget is split between `slots` concurrent compiles, each of which is passed
+    an equal share as its make `-j`.  With `build_dirs`, each compile is given its own `BUILD_DIR`.
+    With `admission`, compiles only start, and with a smaller `-j`, as the load of the machine allows.
+    Completed compiles are yielded back in completion order so that all reporting happens on the
+    calling thread.
+    """
+
+    def __init__(
+        self,
+        executor: Executor,
+        slots: int,
+        build_dirs: Optional[BuildDirectories] = None,
+        admission: Optional[AdmissionController] = None,
+    ):
+        self.executor = executor
+        self.slots = max(1, slots)
+        self.make_jobs = executor.make_jobs(self.slots)
+        self.build_dirs = build_dirs
+        self.admission = admission
+        self._pending: deque[CompileJob] = deque()
+        self._running: dict[Future, CompileJob] = {}
+        self._running_slots: dict[Future, int] = {}
+        self._running_make_jobs: dict[Future, int] = {}
+        self._free_slots = list(range(self.slots - 1, -1, -1))
+        self._pool = ThreadPoolExecutor(max_workers=self.slots, thread_name_prefix="qmk-compile")
+
+    def __enter__(self) -> "CompileScheduler":
+        return self
+
+    def __exit__(self, exc_type, *exc_info) -> None:
+        if exc_type is not None:
+            # Don't wait for the running compiles of an interrupted build to complete.
+            self._pending.clear()
+            self.executor.cancel()
+        self._pool.shutdown(wait=True, cancel_futures=True)
+
+    def submit(self, job: CompileJob) -> None:
+        self._pending.append(job)
+
+    def completed(self, until: Optional[Future] = None) -> Iterator[tuple[CompileJob, QmkCompletedProcess]]:
+        """Yield compiles as they complete, until all are done or the `until` future is."""
+        while self._pending or self._running:
+            if until is not None and until.done():
+                return
+            throttled = self._dispatch()
+            waiting = set(self._running)
+            if until is not None:
+                waiting.add(until)
+            # While throttled, poll the load of the machine for room to start more compiles.
+            timeout = self.admission.POLL_INTERVAL if throttled else None
+            done, _ = wait(waiting, timeout=timeout, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future in self._running:
+                    self._free_slots.append(self._running_slots.pop(future))
+                    del self._running_make_jobs[future]
+                    yield self._running.pop(future), future.result()
+
+    def _conflict_key(self, job: CompileJob) -> Optional[tuple[str, ...]]:
+        if self.build_dirs is None:
+            return job.conflict_key
+        return self.build_dirs.conflict_key(job.firmware, job.worktree)
+
+    def _dispatch(self) -> bool:
+        """Start the pending compiles that can run, and return whether the admission held any back."""
+        busy = {self._conflict_key(job) for job in self._running.values()}
+        for job in tuple(self._pending):
+            if len(self._running) >= self.slots:
+                break
+            conflict_key = self._conflict_key(job)
+            if conflict_key is not None and conflict_key in busy:
+                continue
+            make_jobs = self.make_jobs
+            if self.admission is not None:
+                make_jobs = self.admission.admit(
+                    len(self._running), sum(self._running_make_jobs.values()), self.make_jobs
+                )
+                if make_jobs is None:
+                    return True
+            self._pending.remove(job)
+            busy.add(conflict_key)
+            slot = self._free_slots.pop()
+            kwargs = {}
+            if self.build_dirs is not None:
+                kwargs["build_dir"] = self.build_dirs.acquire(job.firmware, job.worktree, slot)
+            future = self._pool.submit(self.executor.qmk_compile, job.firmware, job.worktree, make_jobs, **kwargs)
+            self._running[future] = job
+            self._running_slots[future] = slot
+            self._running_make_jobs[future] = make_jobs
+        return False
+
 
 def total_firmware_count_reduce_callback(acc: int, firmware_list: FirmwareList) -> int:
     return acc + len(firmware_list.configurations)
 
 
 def read_firmware_filename_from_logs(firmware: Firmware, log_file: Path) -> Path:
-    pattern = re.compile(
-        f"Copying (?P<filename>{re.escape(firmware.output_filename)}\\.[a-z0-9]+) to qmk_firmware folder"
-    )
-    with log_file.open() as fd:
+    pattern = firmware_filename_pattern(firmware)
+    with open_log(log_file) as fd:
         for line in fd:
             match = pattern.match(line)
             if match:
@@ -417,61 +2372,477 @@ def apply_filter(
     )
 
 
+def list_firmwares(firmwares: Sequence[FirmwareList], as_json: bool = False) -> None:
+    """Print the firmwares to build, one tab-separated line per firmware, or as a JSON array."""
+    entries = [
+        {
+            "branch": branch,
+            "keyboard": firmware.keyboard,
+            "keymap": firmware.keymap,
+            "keymap_alias": firmware.keymap_alias,
+            "env_vars": list(firmware.env_vars),
+            "output_filename": firmware.output_filename,
+        }
+        for branch, configurations in firmwares
+        for firmware in configurations
+    ]
+    if as_json:
+        print(json.dumps(entries, indent=2))
+        return
+    for entry in entries:
+        print(
+            "\t".join(
+                (
+                    entry["branch"],
+                    entry["keyboard"],
+                    entry["keymap"],
+                    entry["keymap_alias"] or "-",
+                    " ".join(entry["env_vars"]) or "-",
+                    entry["output_filename"],
+                )
+            )
+        )
+
+
+class Shard(NamedTuple):
+    index: int
+    count: int
+
+    def __str__(self) -> str:
+        return f"{self.index}/{self.count}"
+
+
+def parse_shard(value: str) -> Shard:
+    match = re.fullmatch(r"(\d+)/(\d+)", value)
+    if match is None or not 1 <= int(match[1]) <= int(match[2]):
+        raise argparse.ArgumentTypeError(f"invalid shard '{value}', expected i/N with 1 <= i <= N")
+    return Shard(int(match[1]), int(match[2]))
+
+
+def shard_plan(firmwares: Sequence[FirmwareList], count: int, estimate: Callable[[Firmware], float]) -> dict[str, int]:
+    """Assign each firmware to one of `count` shards (1-based), balancing their estimated cost.
+
+    Firmwares are assigned greedily, most expensive first, to the least loaded shard.  Ties are
+    broken by name, so that every shard computes the same plan from the same compile durations.
+    """
+    costs = sorted(
+        (
+            (-estimate(firmware), f"{branch}:{firmware_key(firmware)}")
+            for branch, configurations in firmwares
+            for firmware in configurations
+        )
+    )
+    loads = [0.0] * count
+    plan = {}
+    for negative_cost, key in costs:
+        shard = min(range(count), key=lambda index: (loads[index], index))
+        loads[shard] -= negative_cost
+        plan[key] = shard + 1
+    return plan
+
+
+def shard_plan_digest(plan: dict[str, int]) -> str:
+    return hashlib.sha256(json.dumps(sorted(plan.items())).encode()).hexdigest()
+
+
+def apply_shard(firmwares: Sequence[FirmwareList], shard: Shard, plan: dict[str, int]) -> Sequence[FirmwareList]:
+    return tuple(
+        filter(
+            lambda firmware_list: len(firmware_list.configurations),
+            tuple(
+                FirmwareList(
+                    branch,
+                    tuple(
+                        firmware
+                        for firmware in configurations
+                        if plan[f"{branch}:{firmware_key(firmware)}"] == shard.index
+                    ),
+                )
+                for branch, configurations in firmwares
+            ),
+        )
+    )
+
+
+# Statuses of the firmwares that made it to the output directory.
+BUILT_STATUSES = ("ok", "cached", "resumed")
+
+
+def shard_manifest_name(shard: Shard) -> str:
+    return f"shard-{shard.index}-of-{shard.count}.json"
+
+
+def write_manifest(path: Path, manifest: dict) -> None:
+    """Write a manifest through a staging file, so that an interrupted write never leaves it truncated."""
+    staging = path.with_name(f".{path.name}.tmp")
+    if staging.is_symlink():
+        staging.unlink()
+    staging.write_text(json.dumps(manifest, indent=2))
+    staging.replace(path)
+
+
+def write_shard_manifest(
+    report: BuildReport, output_dir: Path, shard: Shard, plan: dict[str, int], firmwares: Sequence[FirmwareList]
+) -> Path:
+    """Write the partial manifest of a shard: the plan it was cut from, and the firmwares it built."""
+    entries = []
+    for branch, configurations in firmwares:
+        for firmware in configurations:
+            target = report.target_fields(firmware)
+            entries.append(
+                {
+                    "branch": branch,
+                    "firmware": str(firmware),
+                    "key": f"{branch}:{firmware_key(firmware)}",
+                    "status": target.get("status", "not built"),
+                    "artifact": target.get("artifact"),
+                }
+            )
+    manifest = {
+        "version": 1,
+        "shard": shard.index,
+        "count": shard.count,
+        "plan": shard_plan_digest(plan),
+        "total": len(plan),
+        "firmwares": entries,
+    }
+    path = output_dir / shard_manifest_name(shard)
+    write_manifest(path, manifest)
+    return path
+
+
+def merge_shards(
+    reporter: Reporter, shard_dirs: Sequence[Path], output_dir: Path, history: Optional[DurationHistory] = None
+) -> bool:
+    """Combine the artifacts and manifests of shard output directories into a single release.
+
+    The compile durations of the shard build reports are recorded into `history`, since the shards
+    themselves leave it untouched.  Returns whether every firmware of the plan was built.
+    """
+    manifests = []
+    for shard_dir in shard_dirs:
+        for manifest_file in sorted(shard_dir.glob("shard-*-of-*.json")):
+            if manifest_file.is_symlink():
+                continue
+            try:
+                manifest = json.loads(manifest_file.read_text())
+                if not isinstance(manifest, dict):
+                    raise ValueError("not a JSON object")
+                for key in ("shard", "count", "total"):
+                    if type(manifest.get(key)) is not int:
+                        raise ValueError(f"'{key}' is missing or not an integer")
+                manifests.append((shard_dir, manifest))
+            except (OSError, ValueError) as e:
+                reporter.fatal(f"Could not read the shard manifest {manifest_file}:\n\n{e}", title="Merge Error")
+                sys.exit(1)
+    plans = {(manifest.get("plan"), manifest.get("count"), manifest.get("total")) for _, manifest in manifests}
+    indexes = sorted(manifest.get("shard") for _, manifest in manifests)
+    if len(plans) != 1 or indexes != list(range(1, next(iter(plans))[1] + 1)):
+        reporter.fatal(
+            f"The shard manifests found in {', '.join(map(str, shard_dirs))} do not make up a complete build.\n\n"
+            "Every shard must be built from the same firmwares and compile durations, and merged exactly once.",
+            title="Merge Error",
+        )
+        sys.exit(1)
+    _, _, total_count = next(iter(plans))
+
+    reporter.info(f"Merging {len(manifests)} shards into {output_dir}")
+    entries = []
+    failed_firmwares = []
+    for shard_dir, manifest in manifests:
+        for entry in manifest["firmwares"]:
+            entries.append(entry)
+            if entry["status"] not in BUILT_STATUSES or not entry.get("artifact"):
+                failed_firmwares.append(entry["firmware"])
+                continue
+            # Manifests are untrusted input: never follow a path out of the shard directory.
+            src = shard_dir / Path(entry["artifact"]).name
+            dst = output_dir / src.name
+            if not src.is_file() or src.is_symlink():
+                reporter.error(f"    [not bold white]{entry['firmware']}[/] [red]missing artifact[/]")
+                failed_firmwares.append(entry["firmware"])
+                continue
+            if src.resolve() != dst.resolve():
+                # Explicitly remove pre-existing symlinks/files to prevent arbitrary file overwrite attacks
+                if dst.exists() or dst.is_symlink():
+                    dst.unlink()
+                shutil.copyfile(src, dst)
+        if history is not None:
+            try:
+                shard_report = json.loads((shard_dir / "build-report.json").read_text())
+                for target in shard_report["targets"]:
+                    if target.get("status") == "ok" and "qmk_compile" in target["phases"]:
+                        history.record_key(target["key"], target["architecture"], target["phases"]["qmk_compile"])
+            except (OSError, ValueError, KeyError, TypeError):
+                reporter.logging.exception(f"failed to read the compile durations of {shard_dir}")
+        for via_json in shard_dir.glob("*.via.json"):
+            dst = output_dir / via_json.name
+            if via_json.is_file() and not via_json.is_symlink() and via_json.resolve() != dst.resolve():
+                if dst.exists() or dst.is_symlink():
+                    dst.unlink()
+                shutil.copyfile(via_json, dst)
+
+    failed_count = len(failed_firmwares) + total_count - len(entries)
+    manifest_file = output_dir / "manifest.json"
+    write_manifest(manifest_file, {"version": 1, "total": total_count, "failed": failed_firmwares, "firmwares": entries})
+    reporter.info(f"Manifest saved in: {manifest_file}")
+    if history is not None:
+        try:
+            history.save()
+        except OSError:
+            reporter.logging.exception("failed to save the compile durations")
+    reporter.print_summary(total_count - failed_count, total_count, failed_firmwares)
+    return failed_count == 0
+
+
+def select_changed_firmwares(
+    executor: Executor,
+    reporter: Reporter,
+    firmwares: Sequence[FirmwareList],
+    since: str,
+) -> Sequence[FirmwareList]:
+    """Keep the firmwares affected by the changes made to their branch since the `since` revision."""
+    selected = []
+    for branch, configurations in firmwares:
+        worktree = executor.git_ensure_worktree(branch, update_submodules=False, firmwares=configurations)
+        with executor.report.phase("change_impact", branch=branch):
+            trees, paths = executor.changed_paths(worktree, since)
+            affected = tuple(
+                firmware
+                for firmware in configurations
+                if any(firmware_affected_by(trees, firmware, path) for path in paths)
+            )
+        reporter.info(
+            f"  [magenta]{branch}[/]: {len(paths)} paths changed since {since},"
+            f" affecting {len(affected)} of {len(configurations)} firmwares"
+        )
+        if affected:
+            selected.append(FirmwareList(branch, affected))
+    return tuple(selected)
+
+
+# Redraws of the live display are bounded to this rate, however often the progress gets updated.
+LIVE_REFRESH_PER_SECOND = 4
+
+
+@contextmanager
+def worktree_preparer() -> Iterator[ThreadPoolExecutor]:
+    """A thread preparing worktrees in the background, whose queued preparations are dropped once the build stops."""
+    preparer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="git-worktree")
+    try:
+        yield preparer
+    finally:
+        preparer.shutdown(wait=True, cancel_futures=True)
+
+
 def build(
     executor: Executor,
     reporter: Reporter,
     firmwares: Sequence[FirmwareList],
     on_firmware_compiled: Callable[[Path], None],
+    cache: Optional[BuildCache] = None,
+    build_dirs: Optional[BuildDirectories] = None,
+    journal: Optional[BuildJournal] = None,
+    history: Optional[DurationHistory] = None,
+    admission: Optional[AdmissionController] = None,
 ) -> None:
+    from rich.console import Group
+    from rich.live import Live
+    from rich.progress import BarColumn, Progress, SpinnerColumn, TextColumn, TimeElapsedColumn, TimeRemainingColumn
+    from rich.text import Text
+
     empty_status = Progress(TextColumn(""))
     overall_status = Progress(SpinnerColumn(), TextColumn("{task.description}"))
+    targets_status = Progress(TextColumn("    [dim]{task.fields[firmware]}[/] {task.description}"))
     overall_progress = Progress(
-        MofNCompleteColumn(),
+        TextColumn("[progress.download]{task.fields[done]}/{task.fields[count]}"),
         BarColumn(complete_style="blue"),
         TextColumn("[magenta]{task.percentage:>5.1f}%"),
         TimeElapsedColumn(),
         TimeRemainingColumn(),
         console=reporter.console,
     )
-    progress_group = Group(empty_status, overall_status, overall_progress)
+    progress_group = Group(empty_status, overall_status, targets_status, overall_progress)
 
+    report = executor.report
     total_firmware_count = reduce(total_firmware_count_reduce_callback, firmwares, 0)
     built_firmware_count = 0
     failed_firmwares = []
+    ccache_totals: Optional[CcacheStats] = None
     newline_task = empty_status.add_task("")
     overall_status_task = overall_status.add_task("Preparing…")
-    overall_progress_task = overall_progress.add_task("", total=total_firmware_count)
+    # The progress (and its ETA) is weighted by the estimated cost of each compile.  The firmwares
+    # that end up not being compiled (cached, resumed) are taken out of the total instead.
+    # Estimates are taken once: the history gets updated as the firmwares compile.
+    estimates = {
+        firmware: history.estimate(firmware) if history else 1.0
+        for _, configurations in firmwares
+        for firmware in configurations
+    }
+    estimate = estimates.__getitem__
+    progress_total = sum(estimates.values())
+    progress_done = 0
+    overall_progress_task = overall_progress.add_task("", total=progress_total, done=0, count=total_firmware_count)
+
+    def advance_progress(firmware: Firmware, compiled: bool) -> None:
+        nonlocal progress_total, progress_done
+        progress_done += 1
+        if compiled:
+            overall_progress.update(overall_progress_task, advance=estimate(firmware), done=progress_done)
+        else:
+            progress_total -= estimate(firmware)
+            overall_progress.update(overall_progress_task, total=progress_total, done=progress_done)
+        if progress_done == total_firmware_count:
+            # End at 100%, even when none of the firmwares had to be compiled.
+            overall_progress.update(overall_progress_task, total=1.0, completed=1.0)
+
     reporter.set_progress_status(lambda message: overall_status.update(overall_status_task, description=message))
     reporter.info(f"Preparing to build {total_firmware_count} BastardKB firmwares")
-    with Live(progress_group, console=reporter.console):
-        for branch, configurations in firmwares:
-            # Checkout branch.
-            reporter.info(f"  Building off branch [magenta]{branch}[/] ({len(configurations)} firmwares)")
-            worktree = executor.git_ensure_worktree(branch, update_submodules=True)
 
-            # Build firmwares off that branch.
-            for firmware in configurations:
-                completed_process = executor.qmk_compile(firmware, worktree)
-                if completed_process.returncode == 0:
-                    try:
-                        on_firmware_compiled(
-                            worktree.path / read_firmware_filename_from_logs(firmware, completed_process.log_file)
-                        )
-                        built_firmware_count += 1
-                        reporter.info(f"    [not bold white]{firmware}[/] [green]ok[/]")
-                    except FileNotFoundError:
-                        if executor.dry_run:
-                            built_firmware_count += 1
-                            reporter.info(f"    [not bold white]{firmware}[/] [blue]simulated[/]")
-                        else:
-                            reporter.warn(f"    [not bold white]{firmware}[/] [yellow]ok[/]")
-                            failed_firmwares.append(firmware)
+    # One live status line per firmware being compiled, updated from the compile threads.
+    targets_status_tasks = {}
+    targets_status_lock = threading.Lock()
+
+    def update_target_status(firmware: Firmware, message: Optional[str]) -> None:
+        with targets_status_lock:
+            if message is None:
+                if firmware in targets_status_tasks:
+                    targets_status.remove_task(targets_status_tasks.pop(firmware))
+            elif firmware in targets_status_tasks:
+                targets_status.update(targets_status_tasks[firmware], description=message)
+            else:
+                targets_status_tasks[firmware] = targets_status.add_task(message, firmware=str(firmware))
+
+    reporter.set_target_status(update_target_status)
+
+    def on_compile_completed(job: CompileJob, completed_process: QmkCompletedProcess) -> None:
+        nonlocal built_firmware_count, ccache_totals
+        firmware = job.firmware
+        report.add_phase("qmk_compile", completed_process.duration, firmware)
+        report.add_phase("log_parsing", completed_process.scanner.duration, firmware)
+        report.record_target(
+            firmware,
+            usage=completed_process.usage,
+            log_file=str(completed_process.log_file),
+            warnings=len(completed_process.scanner.warnings),
+            errors=len(completed_process.scanner.errors),
+        )
+        ccache_stats = completed_process.ccache_stats
+        ccache_info = ""
+        if isinstance(ccache_stats, CcacheStats):
+            ccache_totals = ccache_stats.merge(ccache_totals or CcacheStats())
+            report.record_target(firmware, ccache={**ccache_stats._asdict(), "hit_rate": ccache_stats.hit_rate})
+            if ccache_stats.hit_rate is not None:
+                ccache_info = f" [dim](ccache {ccache_stats.hit_rate:.0%} hits)[/]"
+        if completed_process.returncode == 0:
+            if history and not executor.dry_run:
+                history.record(firmware, completed_process.duration)
+            try:
+                firmware_filename = completed_process.firmware_filename
+                if firmware_filename is None:
+                    with report.phase("log_parsing", firmware):
+                        firmware_filename = read_firmware_filename_from_logs(firmware, completed_process.log_file)
+                firmware_path = job.worktree.path / firmware_filename
+                if cache and job.fingerprint:
+                    cache.store(job.fingerprint, firmware_path)
+                with report.phase("copy_firmware_to_output_dir", firmware):
+                    on_firmware_compiled(firmware_path)
+                if journal:
+                    journal.record(firmware, job.fingerprint, firmware_path.name)
+                built_firmware_count += 1
+                report.record_target(firmware, status="ok", artifact=firmware_path.name)
+                warning_count = len(completed_process.scanner.warnings)
+                warnings = f" [yellow]({warning_count} warnings)[/]" if warning_count else ""
+                reporter.info(f"    [not bold white]{firmware}[/] [green]ok[/]{warnings}{ccache_info}")
+            except FileNotFoundError:
+                if executor.dry_run:
+                    built_firmware_count += 1
+                    report.record_target(firmware, status="simulated")
+                    reporter.info(f"    [not bold white]{firmware}[/] [blue]simulated[/]")
                 else:
-                    reporter.error(f"    [not bold white]{firmware}[/] [red]ko[/]")
-                    reporter.error(f"Logs: {completed_process.log_file}")
+                    report.record_target(firmware, status="missing")
+                    reporter.warn(f"    [not bold white]{firmware}[/] [yellow]ok[/]")
                     failed_firmwares.append(firmware)
-                overall_progress.update(overall_progress_task, advance=1)
-            reporter.newline()
+        else:
+            report.record_target(firmware, status="timed_out" if completed_process.timed_out else "failed")
+            reporter.error(f"    [not bold white]{firmware}[/] [red]ko[/]{' (timed out)' if completed_process.timed_out else ''}")
+            for error in completed_process.scanner.errors[:3]:
+                reporter.error(Text(f"      {error}", style="dim"))
+            reporter.error(f"Logs: {completed_process.log_file}")
+            failed_firmwares.append(firmware)
+        advance_progress(firmware, compiled=True)
+
+    slots = compile_slots(executor.concurrency, total_firmware_count)
+    with (
+        Live(progress_group, console=reporter.console, refresh_per_second=LIVE_REFRESH_PER_SECOND),
+        # The scheduler exits first: on an interrupt, it cancels the executor, which terminates the
+        # git commands of the preparer as well.
+        worktree_preparer() as preparer,
+        CompileScheduler(executor, slots, build_dirs, admission) as scheduler,
+    ):
+        # Prepare the worktrees and submodules of the branches in the background, in order, so that
+        # the next branch gets ready while the firmwares of the previous ones are compiling.
+        worktree_futures = [
+            preparer.submit(executor.git_ensure_worktree, branch, update_submodules=True, firmwares=configurations)
+            for branch, configurations in firmwares
+        ]
+        for (branch, configurations), worktree_future in zip(firmwares, worktree_futures):
+            for job, completed_process in scheduler.completed(until=worktree_future):
+                on_compile_completed(job, completed_process)
+            worktree = worktree_future.result()
+            reporter.info(f"  Building off branch [magenta]{branch}[/] ({len(configurations)} firmwares)")
+
+            # Build firmwares off that branch, restoring the unchanged ones from the cache.
+            pending = []
+            for firmware in configurations:
+                fingerprint = executor.build_fingerprint(firmware, worktree) if cache or journal else None
+                resumed_firmware = journal.lookup(firmware, fingerprint) if journal else None
+                if resumed_firmware:
+                    built_firmware_count += 1
+                    report.record_target(firmware, status="resumed", artifact=resumed_firmware.name)
+                    reporter.info(f"    [not bold white]{firmware}[/] [cyan]already built[/]")
+                    advance_progress(firmware, compiled=False)
+                    continue
+                pending.append((firmware, fingerprint))
+            if cache:
+                # Look the firmwares of the branch up all at once, rather than one after the other.
+                cache.prefetch(fingerprint for _, fingerprint in pending if fingerprint)
+            jobs = []
+            for firmware, fingerprint in pending:
+                cached_firmware = None
+                if fingerprint and cache:
+                    with report.phase("cache_restore", firmware):
+                        cached_firmware = cache.restore(fingerprint, Path(worktree.path))
+                if cached_firmware:
+                    with report.phase("copy_firmware_to_output_dir", firmware):
+                        on_firmware_compiled(cached_firmware)
+                    if journal:
+                        journal.record(firmware, fingerprint, cached_firmware.name)
+                    built_firmware_count += 1
+                    report.record_target(firmware, status="cached", artifact=cached_firmware.name)
+                    reporter.info(f"    [not bold white]{firmware}[/] [cyan]cached[/]")
+                    advance_progress(firmware, compiled=False)
+                    continue
+                jobs.append(CompileJob(firmware, worktree, fingerprint))
+            # Longest processing time first, so that the longest compiles don't end up trailing
+            # alone at the end of the build.
+            for job in sorted(jobs, key=lambda job: -estimate(job.firmware)):
+                scheduler.submit(job)
+        for job, completed_process in scheduler.completed():
+            on_compile_completed(job, completed_process)
+        if admission is not None:
+            report.record_summary(admission={"throttled": admission.throttled, "reduced_jobs": admission.reduced_jobs})
+        if ccache_totals is not None:
+            cache_size = executor.ccache.cache_size()
+            report.record_summary(
+                ccache={**ccache_totals._asdict(), "hit_rate": ccache_totals.hit_rate, "cache_size_kib": cache_size}
+            )
+            hit_rate = f"{ccache_totals.hit_rate:.0%}" if ccache_totals.hit_rate is not None else "n/a"
+            size_info = f", {cache_size // 1024} MiB cached" if cache_size is not None else ""
+            reporter.info(
+                f"  ccache: {ccache_totals.hits}/{ccache_totals.hits + ccache_totals.misses} hits ({hit_rate}){size_info}"
+            )
+        reporter.newline()
         overall_status.update(overall_status_task, visible=False)
         empty_status.update(newline_task, visible=False)
         reporter.print_summary(built_firmware_count, total_firmware_count, failed_firmwares, is_dry_run=executor.dry_run)
@@ -516,9 +2887,11 @@ def copy_assets_to_output_dir(executor: Executor, reporter: Reporter, output_dir
         reporter.logging.debug(f"copy: {src} -> {dst}")
 
 
-def sigint_handler(reporter: Reporter, signal, frame):
+def sigint_handler(reporter: Reporter, signal, frame, executor: Optional[Executor] = None):
     del signal, frame
     reporter.progress_status("Interrupted. Exiting…")
+    if executor is not None:
+        executor.cancel()
     sys.exit(1)
 
 
@@ -535,14 +2908,50 @@ def main() -> None:
         "-j",
         "--parallel",
         type=int,
-        help="Parallel option to pass to qmk-compile.",
+        help="Parallel option to pass to qmk-compile, split between the concurrently compiled firmwares.",
         default=os.cpu_count() or 1,
     )
+    parser.add_argument(
+        "-c",
+        "--concurrency",
+        type=int,
+        help="Number of firmwares to compile concurrently (0: a quarter of the --parallel budget).",
+        default=0,
+    )
+    parser.add_argument(
+        "--max-load",
+        type=float,
+        help="Only start compiles, and size their -j, while the load of the machine stays below this (0: the CPU count).",
+        default=0,
+    )
+    parser.add_argument(
+        "--memory-reserve",
+        type=int,
+        help="Memory to leave available to the rest of the machine when starting compiles, in MiB.",
+        default=1024,
+    )
+    parser.add_argument(
+        "--no-admission-control",
+        action="store_true",
+        help="Start compiles regardless of the load and available memory of the machine.",
+    )
     parser.add_argument("-v", "--verbose", action="store_true", help="Enable verbose output.")
+    parser.add_argument(
+        "--log-retention-days",
+        type=float,
+        help="Remove the build logs of the runs older than this.",
+        default=BUILD_LOGS_RETENTION_DAYS,
+    )
+    parser.add_argument(
+        "--log-retention-size",
+        type=int,
+        help="Maximum size of the build logs of the previous runs, in MiB.",
+        default=BUILD_LOGS_RETENTION_BYTES // (1024 * 1024),
+    )
     parser.add_argument(
         "-r",
         "--repository",
-        type=PurePath,
+        type=Path,
         help="The QMK repository checkout to work with.",
         default=Path.cwd(),
     )
@@ -560,8 +2969,216 @@ def main() -> None:
         help="Filter the list of firmwares to build.",
         default=".*",
     )
+    parser.add_argument(
+        "-l",
+        "--list",
+        action="store_true",
+        help="Print the firmwares selected by --filter (and --shard) instead of building them, and exit.",
+    )
+    parser.add_argument(
+        "--json",
+        action="store_true",
+        help="With --list, print the firmwares as JSON.",
+    )
+    parser.add_argument(
+        "--since",
+        type=str,
+        help="Only build the firmwares affected by the changes made to their branch since this revision.",
+        default=None,
+    )
+    parser.add_argument(
+        "--shard",
+        type=parse_shard,
+        help=(
+            "Only build the i-th of N shards of the firmwares, balanced by compile cost, and write a partial"
+            " manifest.  All the shards must use the same --durations file."
+        ),
+        default=None,
+    )
+    parser.add_argument(
+        "--merge-shards",
+        type=Path,
+        nargs="+",
+        metavar="SHARD_DIR",
+        help="Merge the output directories of all the shards of a build into the output directory, and exit.",
+        default=None,
+    )
+    parser.add_argument(
+        "--durations",
+        type=Path,
+        help="The file holding the compile durations of the previous runs.",
+        default=Path(app_dir("XDG_STATE_HOME", ".local", "state"), "durations.json"),
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Skip the firmwares already built into the output directory by an interrupted build of the same sources.",
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="Always compile, instead of restoring unchanged firmwares from the build cache.",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        type=Path,
+        help="The directory holding the build cache.",
+        default=Path(app_dir("XDG_CACHE_HOME", ".cache"), "artifacts"),
+    )
+    parser.add_argument(
+        "--cache-size",
+        type=int,
+        help="Maximum size of the build cache, in MiB.",
+        default=512,
+    )
+    parser.add_argument(
+        "--cache-url",
+        type=parse_cache_url,
+        help=(
+            "The URL of a build cache server shared with other build runners (see --serve-cache), with the"
+            " shared token, if any, in $BKB_CACHE_TOKEN."
+        ),
+        default=None,
+    )
+    parser.add_argument(
+        "--cache-timeout",
+        type=float,
+        help="Compile locally once the build cache server does not answer within this many seconds.",
+        default=5.0,
+    )
+    parser.add_argument(
+        "--timeout",
+        type=float,
+        metavar="SECONDS",
+        help="Abort the compile of a firmware that runs for longer than this many seconds.",
+        default=None,
+    )
+    parser.add_argument(
+        "--serve-cache",
+        type=parse_address,
+        metavar="[HOST:]PORT",
+        help=(
+            "Serve the build cache to other build runners over HTTP, requiring $BKB_CACHE_TOKEN if set."
+            " Serving on another interface than loopback requires the token."
+        ),
+        default=None,
+    )
+    parser.add_argument(
+        "--no-generated-cache",
+        action="store_true",
+        help=(
+            "Let QMK regenerate the config headers, rules and keymap sources of every compile, instead of"
+            " keeping the unchanged ones, and their timestamps, from a cache next to the build cache."
+        ),
+    )
+    parser.add_argument(
+        "--no-ccache",
+        action="store_true",
+        help="Compile without ccache.",
+    )
+    parser.add_argument(
+        "--ccache-dir",
+        type=Path,
+        help="The ccache directory, shared by every branch and run.",
+        default=Path(app_dir("XDG_CACHE_HOME", ".cache"), "ccache"),
+    )
+    parser.add_argument(
+        "--ccache-size",
+        type=str,
+        help="Maximum size of the ccache directory, in ccache's --max-size format.",
+        default="2G",
+    )
+    parser.add_argument(
+        "--build-dirs",
+        choices=BuildDirectories.LAYOUTS,
+        help=(
+            "How to isolate the QMK build directories: one per firmware, one per concurrent compile slot,"
+            " or QMK's single .build directory per worktree."
+        ),
+        default="target",
+    )
+    parser.add_argument(
+        "--build-dir-root",
+        type=Path,
+        help="The directory holding the isolated build directories.",
+        default=Path(app_dir("XDG_CACHE_HOME", ".cache"), "build"),
+    )
+    parser.add_argument(
+        "--build-dir-size",
+        type=int,
+        help="Maximum size of the isolated build directories, in MiB.",
+        default=4096,
+    )
+    parser.add_argument(
+        "--build-in-tmpfs",
+        action="store_true",
+        help="Put the isolated build directories in /dev/shm, if the memory allows for the selected firmwares.",
+    )
+    parser.add_argument(
+        "--tmpfs-persist",
+        action="store_true",
+        help="With --build-in-tmpfs, keep the build directories in /dev/shm for the incremental builds of the next runs.",
+    )
+    parser.add_argument(
+        "--clean-build-dirs",
+        action="store_true",
+        help="Remove the isolated build directories before building.",
+    )
     cmdline_args = parser.parse_args()
-    reporter = Reporter(cmdline_args.verbose)
+    if cmdline_args.json and not cmdline_args.list:
+        parser.error("--json can only be used with --list")
+
+    # Listing the firmwares needs neither the repository nor the build logs.
+    if cmdline_args.list:
+        if cmdline_args.since is not None:
+            parser.error("--since needs the repository, and cannot be combined with --list")
+        try:
+            firmwares = apply_filter(ALL_FIRMWARES, re.compile(cmdline_args.filter))
+        except re.error as e:
+            parser.error(f"invalid filter regular expression '{cmdline_args.filter}': {e}")
+        if cmdline_args.shard is not None:
+            plan = shard_plan(firmwares, cmdline_args.shard.count, DurationHistory(cmdline_args.durations).estimate)
+            firmwares = apply_shard(firmwares, cmdline_args.shard, plan)
+        try:
+            list_firmwares(firmwares, as_json=cmdline_args.json)
+            sys.stdout.flush()
+        except BrokenPipeError:
+            # Eg. `--list | head`: like rich, send the rest of the output (and the flush at exit) to /dev/null.
+            os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+        return
+
+    reporter = Reporter(
+        cmdline_args.verbose,
+        log_retention_days=cmdline_args.log_retention_days,
+        log_retention_bytes=cmdline_args.log_retention_size * 1024 * 1024,
+    )
+
+    # Serving the build cache only needs the cache directory.
+    if cmdline_args.serve_cache is not None:
+        try:
+            server = make_cache_server(
+                reporter,
+                cmdline_args.serve_cache,
+                BuildCache(reporter, cmdline_args.cache_dir, cmdline_args.cache_size * 1024 * 1024),
+                os.environ.get(REMOTE_CACHE_TOKEN_ENV),
+            )
+        except (OSError, ValueError) as e:
+            reporter.fatal(f"Could not serve the build cache: {e}", title="Cache Server Error")
+            sys.exit(1)
+        host, port = server.server_address[:2]
+        reporter.info(f"Serving the build cache {cmdline_args.cache_dir} on http://{host}:{port}")
+        with suppress(KeyboardInterrupt):
+            server.serve_forever()
+        server.server_close()
+        return
+
+    # Merging shards only needs their output directories.
+    if cmdline_args.merge_shards:
+        cmdline_args.output_dir.mkdir(parents=True, exist_ok=True)
+        merged = merge_shards(
+            reporter, cmdline_args.merge_shards, cmdline_args.output_dir, DurationHistory(cmdline_args.durations)
+        )
+        sys.exit(0 if merged else 1)
 
     # Install SIGINT handler.
     signal.signal(signal.SIGINT, partial(sigint_handler, reporter))
@@ -576,6 +3193,8 @@ def main() -> None:
             sys.exit(1)
 
     # Open QMK repository.
+    from pygit2 import GitError, Repository
+
     try:
         repository = Repository(cmdline_args.repository)
     except GitError:
@@ -601,8 +3220,40 @@ def main() -> None:
         )
         sys.exit(1)
 
+    # Set up the shared ccache directory.
+    ccache = None
+    if not cmdline_args.no_ccache and not cmdline_args.dry_run:
+        if shutil.which("ccache") is None:
+            reporter.warn("ccache could not be found, its statistics will not be collected")
+        else:
+            try:
+                ccache = Ccache(reporter, cmdline_args.ccache_dir, cmdline_args.ccache_size)
+                ccache.configure()
+            except OSError as e:
+                reporter.warn(f"Shared ccache directory disabled: {e}")
+                ccache = None
+
+    # Open the cache of the files generated by the makefiles of QMK.
+    generated_cache = None
+    if not cmdline_args.no_generated_cache and not cmdline_args.dry_run:
+        try:
+            generated_cache = BuildCache(reporter, cmdline_args.cache_dir.parent / "generated", GENERATED_CACHE_BYTES)
+        except OSError as e:
+            reporter.warn(f"Cache of generated files disabled: {e}")
+
     # Create the process dispatcher.
-    executor = Executor(reporter, repository, cmdline_args.dry_run, cmdline_args.parallel)
+    executor = Executor(
+        reporter,
+        repository,
+        cmdline_args.dry_run,
+        cmdline_args.parallel,
+        concurrency=cmdline_args.concurrency or default_concurrency(cmdline_args.parallel),
+        ccache=ccache,
+        use_ccache=not cmdline_args.no_ccache,
+        generated_cache=generated_cache.cache_dir if generated_cache is not None else None,
+        timeout=cmdline_args.timeout,
+    )
+    signal.signal(signal.SIGINT, partial(sigint_handler, reporter, executor=executor))
 
     # Parse the filter regex, handling invalid patterns gracefully.
     try:
@@ -614,21 +3265,144 @@ def main() -> None:
         )
         sys.exit(1)
 
+    # Open the build cache.
+    cache = None
+    if not cmdline_args.no_cache and not cmdline_args.dry_run:
+        try:
+            cache = BuildCache(reporter, cmdline_args.cache_dir, cmdline_args.cache_size * 1024 * 1024)
+        except OSError as e:
+            reporter.warn(f"Build cache disabled: {e}")
+        if cache is not None and cmdline_args.cache_url is not None:
+            cache = RemoteBuildCache(
+                reporter,
+                cache,
+                cmdline_args.cache_url,
+                cmdline_args.cache_timeout,
+                os.environ.get(REMOTE_CACHE_TOKEN_ENV),
+            )
+
+    # Set up the build directories.
+    build_dirs = None
+    if not cmdline_args.dry_run:
+        try:
+            build_dirs = BuildDirectories(
+                reporter,
+                cmdline_args.build_dir_root,
+                cmdline_args.build_dirs,
+                cmdline_args.build_dir_size * 1024 * 1024,
+            )
+            if cmdline_args.clean_build_dirs:
+                build_dirs.clean()
+        except OSError as e:
+            reporter.warn(f"Isolated build directories disabled: {e}")
+
+    # Load the compile durations of the previous runs.
+    history = DurationHistory(cmdline_args.durations)
+
+    # Select the firmwares to build.
+    firmwares = apply_filter(ALL_FIRMWARES, filter_regex)
+    if cmdline_args.since is not None:
+        firmwares = select_changed_firmwares(executor, reporter, firmwares, cmdline_args.since)
+    if cmdline_args.shard is not None:
+        plan = shard_plan(firmwares, cmdline_args.shard.count, history.estimate)
+        firmwares = apply_shard(firmwares, cmdline_args.shard, plan)
+        reporter.info(f"Building shard {cmdline_args.shard} (plan {shard_plan_digest(plan)[:12]})")
+
+    # Move the build directories to memory, sized for the selected firmwares.
+    if cmdline_args.build_in_tmpfs and build_dirs is not None:
+        tmpfs_build_dirs = TmpfsBuildDirectories.open(
+            reporter,
+            build_dirs,
+            firmwares,
+            compile_slots(executor.concurrency, reduce(total_firmware_count_reduce_callback, firmwares, 0)),
+            cmdline_args.memory_reserve * 1024,
+            persist=cmdline_args.tmpfs_persist,
+        )
+        if tmpfs_build_dirs is not None:
+            if cmdline_args.clean_build_dirs:
+                tmpfs_build_dirs.clean()
+            build_dirs = tmpfs_build_dirs
+
+    # Open the build journal, to resume an interrupted build.
+    journal = None
+    if not cmdline_args.dry_run:
+        try:
+            journal = BuildJournal(cmdline_args.output_dir, resume=cmdline_args.resume)
+        except OSError as e:
+            reporter.warn(f"Build journal disabled: {e}")
+
+    # Throttle the compiles to the load of the machine.
+    admission = None
+    if not cmdline_args.no_admission_control and not cmdline_args.dry_run:
+        admission = AdmissionController(
+            reporter,
+            cmdline_args.max_load or float(os.cpu_count() or 1),
+            cmdline_args.memory_reserve * 1024,
+        )
+
     # Build the firmwares and copy them to the ouptut directory.
-    build(
-        executor,
-        reporter,
-        apply_filter(ALL_FIRMWARES, filter_regex),
-        partial(
-            copy_firmware_to_output_dir,
+    built = False
+    try:
+        build(
+            executor,
             reporter,
-            cmdline_args.output_dir,
-        ),
-    )
+            firmwares,
+            partial(
+                copy_firmware_to_output_dir,
+                reporter,
+                cmdline_args.output_dir,
+            ),
+            cache=cache,
+            build_dirs=build_dirs,
+            journal=journal,
+            history=history,
+            admission=admission,
+        )
+        built = True
+    finally:
+        if isinstance(cache, RemoteBuildCache):
+            # Finish the uploads, unless the build was interrupted.
+            cache.close(cancel=not built)
+    if isinstance(cache, RemoteBuildCache):
+        executor.report.record_summary(
+            remote_cache={"url": cache.url, "available": cache.available, "hits": cache.hits, "stores": cache.stores}
+        )
+    # The durations are an input of the shard plan: shards leave them to the merge step.
+    if not executor.dry_run and cmdline_args.shard is None:
+        try:
+            history.save()
+        except OSError:
+            reporter.logging.exception("failed to save the compile durations")
+
+    # Keep the build directories, and the generated files, within their size limit.
+    if build_dirs is not None:
+        with executor.report.phase("build_dirs_prune"):
+            build_dirs.prune()
+    if generated_cache is not None:
+        with executor.report.phase("generated_cache_evict"):
+            generated_cache.evict()
 
     # Copy assets.
-    copy_assets_to_output_dir(executor, reporter, cmdline_args.output_dir, cmdline_args.repository)
+    with executor.report.phase("copy_assets_to_output_dir"):
+        copy_assets_to_output_dir(executor, reporter, cmdline_args.output_dir, cmdline_args.repository)
+
+    # Write the partial manifest of the shard, for the merge step.
+    if cmdline_args.shard is not None and not executor.dry_run:
+        manifest_file = write_shard_manifest(executor.report, cmdline_args.output_dir, cmdline_args.shard, plan, firmwares)
+        reporter.info(f"Shard manifest saved in: {manifest_file}")
+
+    # Write the build report next to the artifacts.
+    if not executor.dry_run:
+        report_file = cmdline_args.output_dir / "build-report.json"
+        try:
+            executor.report.write(report_file)
+            reporter.info(f"Build report saved in: {report_file}")
+        except OSError:
+            reporter.logging.exception("failed to write the build report")
 
 
 if __name__ == "__main__":
+    # The makefiles of QMK run this script in place of `qmk`, to cache the files they generate.
+    if sys.argv[1:2] == [QMK_SHIM_COMMAND]:
+        sys.exit(qmk_shim(sys.argv[2:]))
     main()
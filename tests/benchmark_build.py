@@ -0,0 +1,217 @@
+#! /usr/bin/env python3
+"""Benchmark the release orchestrator end to end, against a fake `qmk` toolchain.
+
+Runs `build()` on synthetic `ALL_FIRMWARES`-style matrices, in a local bare repository with a
+worktree, with `tests/fake_qmk.py` standing in for `qmk`.  Each matrix size runs in its own
+interpreter, and reports:
+
+- the wall-clock time and throughput of the whole build,
+- the orchestrator overhead: the wall-clock time not explained by the compiles themselves, once
+  spread over the concurrent compile slots,
+- the CPU time and peak RSS of the orchestrator process (excluding the compiles).
+
+Usage:
+
+    python tests/benchmark_build.py --sizes 10,100,1000,10000 --sleep 0.05
+"""
+
+import argparse
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from functools import partial
+from itertools import islice
+from pathlib import Path
+
+ROOT_DIR = Path(__file__).resolve().parent.parent
+FAKE_QMK = Path(__file__).resolve().parent / "fake_qmk.py"
+
+
+def git(*argv: str, cwd: Path) -> None:
+    subprocess.run(
+        ("git", "-c", "user.name=bench", "-c", "user.email=bench@localhost", *argv),
+        cwd=cwd,
+        check=True,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+
+
+def create_qmk_repository(root: Path, branch: str) -> Path:
+    """Create a bare repository with a `main` and a `branch` worktree, like a release checkout."""
+    source = root / "source"
+    for path, content in (
+        ("Makefile", "all:\n"),
+        ("quantum/quantum.c", "int main(void) { return 0; }\n"),
+        ("keyboards/bastardkb/rules.mk", "BOOTMAGIC_ENABLE = yes\n"),
+        ("via/bench.via.json", "{}\n"),
+    ):
+        (source / path).parent.mkdir(parents=True, exist_ok=True)
+        (source / path).write_text(content)
+    git("init", "--quiet", "--initial-branch=main", cwd=source)
+    git("add", "--all", cwd=source)
+    git("commit", "--quiet", "--message=Initial commit", cwd=source)
+    git("branch", branch, cwd=source)
+
+    repository = root / "qmk_firmware.git"
+    git("clone", "--quiet", "--bare", str(source), str(repository), cwd=root)
+    git("worktree", "add", "--quiet", "main", "main", cwd=repository)
+    git("worktree", "add", "--quiet", branch, branch, cwd=repository)
+    return repository
+
+
+def create_fake_qmk(root: Path) -> Path:
+    bin_dir = root / "bin"
+    bin_dir.mkdir()
+    qmk = bin_dir / "qmk"
+    qmk.write_text(f'#! /bin/sh\nexec "{sys.executable}" "{FAKE_QMK}" "$@"\n')
+    qmk.chmod(0o755)
+    return bin_dir
+
+
+def benchmark_matrix(bkb, size: int, branch: str):
+    """Replicate the keyboard/MCU matrix of `ALL_FIRMWARES` until it holds `size` firmwares."""
+    replicas = (
+        bkb.Firmware(keyboard=f"{keyboard}_{replica}/{mcu}", keymap="via", keymap_alias="stock")
+        for replica in range(size)
+        for keyboard in bkb.ALL_BASTARD_KEYBOARDS
+        for mcu in bkb.ALL_MCUS
+    )
+    return (bkb.FirmwareList(branch=branch, configurations=tuple(islice(replicas, size))),)
+
+
+def run_worker(args: argparse.Namespace) -> None:
+    sys.path.insert(0, str(ROOT_DIR))
+    import bastardkb_build_releases as bkb
+    from pygit2 import Repository
+
+    root = Path(args.work_dir)
+    repository_path = create_qmk_repository(root, args.branch)
+    os.environ["PATH"] = f"{create_fake_qmk(root)}{os.pathsep}{os.environ['PATH']}"
+    os.environ["XDG_STATE_HOME"] = str(root / "state")
+    os.environ["XDG_CACHE_HOME"] = str(root / "cache")
+    os.environ["FAKE_QMK_SLEEP"] = str(args.sleep)
+    os.environ["FAKE_QMK_CPU"] = str(args.cpu)
+    os.environ["FAKE_QMK_LINES"] = str(args.lines)
+    output_dir = root / "output"
+    output_dir.mkdir()
+
+    reporter = bkb.Reporter(verbose=False)
+    executor = bkb.Executor(
+        reporter,
+        Repository(str(repository_path)),
+        dry_run=False,
+        parallel=args.parallel,
+        concurrency=args.concurrency or bkb.default_concurrency(args.parallel),
+    )
+    cache = None
+    if args.cache:
+        cache = bkb.BuildCache(reporter, root / "cache" / "artifacts", 1024 * 1024 * 1024)
+    firmwares = benchmark_matrix(bkb, args.size, args.branch)
+
+    usage_before = resource.getrusage(resource.RUSAGE_SELF)
+    started = time.perf_counter()
+    bkb.build(executor, reporter, firmwares, partial(bkb.copy_firmware_to_output_dir, reporter, output_dir), cache=cache)
+    wall = time.perf_counter() - started
+    usage_after = resource.getrusage(resource.RUSAGE_SELF)
+
+    report = executor.report.to_json()
+    compile_time = sum(target["phases"].get("qmk_compile", 0.0) for target in report["targets"])
+    slots = bkb.compile_slots(executor.concurrency, args.size)
+    result = {
+        "size": args.size,
+        "slots": slots,
+        "wall": wall,
+        "throughput": args.size / wall,
+        "compile_time": compile_time,
+        "overhead": max(0.0, wall - compile_time / slots),
+        "orchestrator_cpu": (usage_after.ru_utime - usage_before.ru_utime)
+        + (usage_after.ru_stime - usage_before.ru_stime),
+        "peak_rss_mib": usage_after.ru_maxrss / (1024 * 1024 if sys.platform == "darwin" else 1024),
+        "artifacts": sum(1 for f in output_dir.iterdir() if f.suffix in (".hex", ".bin", ".uf2")),
+    }
+    if cache is not None:
+        started = time.perf_counter()
+        bkb.build(executor, reporter, firmwares, partial(bkb.copy_firmware_to_output_dir, reporter, output_dir), cache=cache)
+        result["cached_wall"] = time.perf_counter() - started
+    Path(args.result_file).write_text(json.dumps(result))
+
+
+def run_benchmark(args: argparse.Namespace, size: int) -> dict:
+    work_dir = tempfile.mkdtemp(prefix=f"bkb-bench-{size}-")
+    result_file = Path(work_dir, "result.json")
+    try:
+        subprocess.run(
+            (
+                sys.executable,
+                __file__,
+                "--worker",
+                "--size",
+                str(size),
+                "--work-dir",
+                work_dir,
+                "--result-file",
+                str(result_file),
+                "--sleep",
+                str(args.sleep),
+                "--cpu",
+                str(args.cpu),
+                "--lines",
+                str(args.lines),
+                "--parallel",
+                str(args.parallel),
+                "--concurrency",
+                str(args.concurrency),
+                *(("--cache",) if args.cache else ()),
+            ),
+            check=True,
+            stdout=subprocess.DEVNULL,
+            stderr=None if args.verbose else subprocess.DEVNULL,
+        )
+        return json.loads(result_file.read_text())
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmark the BastardKB release orchestrator.")
+    parser.add_argument("--sizes", type=str, default="10,100,1000,10000", help="Comma-separated matrix sizes.")
+    parser.add_argument("--sleep", type=float, default=0.0, help="Seconds each fake compile sleeps.")
+    parser.add_argument("--cpu", type=float, default=0.0, help="Seconds of CPU each fake compile burns.")
+    parser.add_argument("--lines", type=int, default=20, help="Lines of output of each fake compile.")
+    parser.add_argument("-j", "--parallel", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("-c", "--concurrency", type=int, default=0)
+    parser.add_argument("--cache", action="store_true", help="Also measure a fully cached rebuild.")
+    parser.add_argument("--json", action="store_true", help="Print the results as JSON.")
+    parser.add_argument("-v", "--verbose", action="store_true")
+    parser.add_argument("--branch", type=str, default="bkb-master", help=argparse.SUPPRESS)
+    parser.add_argument("--worker", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--size", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--work-dir", type=str, help=argparse.SUPPRESS)
+    parser.add_argument("--result-file", type=str, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        run_worker(args)
+        return
+
+    results = [run_benchmark(args, int(size)) for size in args.sizes.split(",")]
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    columns = ("size", "slots", "wall", "throughput", "overhead", "orchestrator_cpu", "peak_rss_mib")
+    if args.cache:
+        columns += ("cached_wall",)
+    print("  ".join(f"{column:>16}" for column in columns))
+    for result in results:
+        print("  ".join(f"{result[column]:>16.3f}" if isinstance(result[column], float) else f"{result[column]:>16}" for column in columns))
+
+
+if __name__ == "__main__":
+    main()
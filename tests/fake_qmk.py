@@ -0,0 +1,83 @@
+#! /usr/bin/env python3
+"""A stand-in for the `qmk` CLI, used by the orchestrator benchmarks.
+
+Mimics `qmk compile`: prints build steps, writes the firmware in the current directory and
+reports it with the same "Copying … to qmk_firmware folder" line as QMK.  The cost of each compile
+is configurable through the environment:
+
+- `FAKE_QMK_SLEEP`: seconds spent sleeping (I/O-bound, eg. waiting on the linker),
+- `FAKE_QMK_CPU`: seconds spent burning CPU,
+- `FAKE_QMK_LINES`: number of "Compiling: …" lines printed,
+- `FAKE_QMK_FAIL`: regular expression of keyboards whose compile fails.
+"""
+
+import argparse
+import os
+import re
+import sys
+import time
+
+
+def burn_cpu(seconds: float) -> None:
+    deadline = time.process_time() + seconds
+    while time.process_time() < deadline:
+        pass
+
+
+def compile_firmware(args: argparse.Namespace) -> int:
+    env = dict(env_var.split("=", 1) for env_var in args.env)
+    target = env.get("TARGET", f"{args.keyboard}_{args.keymap}".replace("/", "_"))
+    if env.get("BOOTLOADER") == "tinyuf2":
+        extension = "uf2"
+    elif args.keyboard.endswith("elitec"):
+        extension = "hex"
+    else:
+        extension = "bin"
+
+    lines = int(os.environ.get("FAKE_QMK_LINES", "20"))
+    sleep = float(os.environ.get("FAKE_QMK_SLEEP", "0"))
+    cpu = float(os.environ.get("FAKE_QMK_CPU", "0"))
+    print(f"Making {args.keyboard} with keymap {args.keymap}")
+    for index in range(lines):
+        print(f"Compiling: quantum/fake_{index}.c{' ' * 50}[OK]")
+        if index == lines // 2:
+            print(f"quantum/fake_{index}.c:1:1: warning: this is a fake warning")
+    time.sleep(sleep)
+    burn_cpu(cpu)
+
+    fail = os.environ.get("FAKE_QMK_FAIL")
+    if fail and re.search(fail, args.keyboard):
+        print(f"quantum/fake_{lines}.c:1:1: error: this is a fake error")
+        print("make: *** [builddefs/build_keyboard.mk:1: fake] Error 1")
+        return 1
+
+    print(f"Linking: .build/{target}.elf{' ' * 50}[OK]")
+    with open(f"{target}.{extension}", "w") as fd:
+        fd.write(f"{args.keyboard}:{args.keymap}:{','.join(args.env)}\n")
+    print(f"Copying {target}.{extension} to qmk_firmware folder{' ' * 30}[OK]")
+    return 0
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(prog="qmk")
+    parser.add_argument("--version", action="store_true")
+    subparsers = parser.add_subparsers(dest="command")
+    compile_parser = subparsers.add_parser("compile")
+    compile_parser.add_argument("-j", "--parallel", type=int, default=1)
+    compile_parser.add_argument("-kb", "--keyboard", required=True)
+    compile_parser.add_argument("-km", "--keymap", required=True)
+    compile_parser.add_argument("-e", "--env", action="append", default=[])
+    compile_parser.add_argument("-c", "--clean", action="store_true")
+    args = parser.parse_args()
+
+    if args.version:
+        print("1.1.5 (fake)")
+        return 0
+    if args.command == "compile":
+        return compile_firmware(args)
+    parser.print_usage()
+    return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
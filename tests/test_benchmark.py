@@ -0,0 +1,36 @@
+import json
+import os
+import subprocess
+import sys
+import unittest
+
+BENCHMARK = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmark_build.py")
+
+
+def has_build_dependencies() -> bool:
+    # The benchmark runs the real orchestrator, in a fresh interpreter.
+    return subprocess.run((sys.executable, "-c", "import pygit2, rich"), capture_output=True).returncode == 0
+
+
+@unittest.skipUnless(has_build_dependencies(), "pygit2 and rich are required to run the orchestrator benchmark")
+class TestBenchmark(unittest.TestCase):
+    def test_benchmark_builds_every_target_with_fake_qmk(self):
+        """Verify the benchmark runs build() end to end and reports its metrics."""
+        result = subprocess.run(
+            (sys.executable, BENCHMARK, "--sizes", "10", "--parallel", "4", "--cache", "--json"),
+            capture_output=True,
+            text=True,
+            timeout=300,
+        )
+        self.assertEqual(result.returncode, 0, result.stderr)
+        (metrics,) = json.loads(result.stdout)
+
+        self.assertEqual(metrics["size"], 10)
+        self.assertEqual(metrics["artifacts"], 10)
+        self.assertGreater(metrics["throughput"], 0)
+        self.assertGreaterEqual(metrics["overhead"], 0)
+        self.assertIn("cached_wall", metrics)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,6 +1,14 @@
 import unittest
 import sys
 import os
+import hashlib
+import shlex
+import socket
+import threading
+import tempfile
+import gzip
+import json
+import time
 from unittest.mock import MagicMock, patch
 from pathlib import Path
 
@@ -27,6 +35,49 @@ sys.modules["rich.text"] = MagicMock()
 
 import bastardkb_build_releases as bkb
 
+class FakeTree(object):
+    """A minimal stand-in for a pygit2 tree: nested dicts of blob ids."""
+
+    def __init__(self, entries, name=""):
+        self.name = name
+        self.type_str = "tree"
+        self._entries = entries
+
+    @property
+    def id(self):
+        return repr(sorted((name, getattr(entry, "id", entry)) for name, entry in self._entries.items()))
+
+    def _child(self, name):
+        value = self._entries[name]
+        if isinstance(value, dict):
+            return FakeTree(value, name)
+        blob = MagicMock(id=value, type_str="blob")
+        blob.name = name
+        return blob
+
+    def __getitem__(self, path):
+        head, _, rest = path.partition("/")
+        child = self._child(head)
+        return child[rest] if rest else child
+
+    def __iter__(self):
+        return iter(self._child(name) for name in self._entries)
+
+
+def fake_qmk_tree(skeletyl_config="a", scylla_config="b", quantum="q"):
+    return FakeTree(
+        {
+            "quantum": {"quantum.c": quantum},
+            "keyboards": {
+                "bastardkb": {
+                    "skeletyl": {"info.json": "s", "config.h": skeletyl_config, "v2": {"elitec": {"keyboard.json": "e"}}},
+                    "scylla": {"info.json": "s", "config.h": scylla_config, "v2": {"elitec": {"keyboard.json": "e"}}},
+                },
+            },
+        }
+    )
+
+
 class TestPerformance(unittest.TestCase):
     def test_git_submodule_update_uses_jobs(self):
         """Verify git submodule update uses --jobs argument."""
@@ -50,6 +101,9 @@ class TestPerformance(unittest.TestCase):
         success_process.returncode = 0
         executor._run.return_value = success_process
 
+        # The submodules could not be checked, so they all get updated.
+        executor._stale_submodules = MagicMock(return_value=None)
+
         # Run the method
         executor.git_ensure_worktree("test_branch", update_submodules=True)
 
@@ -118,5 +172,821 @@ class TestPerformance(unittest.TestCase):
         # Check that --clean is NOT present
         self.assertNotIn("--clean", args, "qmk compile should not use --clean flag to allow incremental builds")
 
+    def test_compile_scheduler_splits_job_budget(self):
+        """Verify the --parallel budget is split between concurrent compiles."""
+        executor = bkb.Executor(MagicMock(), MagicMock(), dry_run=False, parallel=32, concurrency=8)
+        executor.qmk_compile = MagicMock(return_value=MagicMock(returncode=0))
+        worktree = MagicMock()
+        worktree.path = Path("/tmp/test_worktree")
+
+        firmwares = [bkb.Firmware(keyboard=f"kb{i}/v2/elitec", keymap="default") for i in range(3)]
+        slots = bkb.compile_slots(executor.concurrency, len(firmwares))
+        with bkb.CompileScheduler(executor, slots) as scheduler:
+            for firmware in firmwares:
+                scheduler.submit(bkb.CompileJob(firmware, worktree))
+            completed = [job.firmware for job, _ in scheduler.completed()]
+
+        self.assertEqual(slots, 3)
+        self.assertCountEqual(completed, firmwares)
+        for call in executor.qmk_compile.call_args_list:
+            self.assertEqual(call[0][2], 10)
+
+    def test_compile_scheduler_serializes_shared_output_filename(self):
+        """Verify firmwares sharing a build directory are never compiled concurrently."""
+        import threading
+        import time
+
+        executor = bkb.Executor(MagicMock(), MagicMock(), dry_run=False, parallel=4, concurrency=4)
+        lock = threading.Lock()
+        active = set()
+        overlaps = []
+
+        def qmk_compile(firmware, worktree, parallel):
+            with lock:
+                if firmware.output_filename in active:
+                    overlaps.append(firmware)
+                active.add(firmware.output_filename)
+            time.sleep(0.05)
+            with lock:
+                active.discard(firmware.output_filename)
+            return MagicMock(returncode=0)
+
+        executor.qmk_compile = qmk_compile
+        worktree = MagicMock()
+        worktree.path = Path("/tmp/test_worktree")
+        firmwares = (
+            bkb.Firmware(keyboard="skeletyl/blackpill", keymap="default", keymap_alias="stock"),
+            bkb.Firmware(
+                keyboard="skeletyl/blackpill", keymap="default", keymap_alias="stock", env_vars=("BOOTLOADER=tinyuf2",)
+            ),
+            bkb.Firmware(keyboard="tbkmini/blackpill", keymap="default", keymap_alias="stock"),
+        )
+        with bkb.CompileScheduler(executor, 4) as scheduler:
+            for firmware in firmwares:
+                scheduler.submit(bkb.CompileJob(firmware, worktree))
+            self.assertEqual(len(list(scheduler.completed())), 3)
+        self.assertEqual(overlaps, [])
+
+    def test_build_directories_isolate_targets_and_slots(self):
+        """Verify each target (or slot) gets its own persistent BUILD_DIR, pruned least recently used first."""
+        with tempfile.TemporaryDirectory() as td:
+            root = Path(td, "build")
+            worktree = MagicMock()
+            worktree.name = "bkb-master"
+            worktree.path = Path(td, "bkb-master")
+            dfu = bkb.Firmware(keyboard="skeletyl/blackpill", keymap="default", keymap_alias="stock")
+            uf2 = dfu._replace(env_vars=("BOOTLOADER=tinyuf2",))
+
+            targets = bkb.BuildDirectories(MagicMock(), root, "target", max_bytes=1500)
+            dfu_dir = targets.acquire(dfu, worktree, slot=0)
+            self.assertEqual(dfu_dir, targets.acquire(dfu, worktree, slot=1))
+            self.assertNotEqual(dfu_dir, targets.acquire(uf2, worktree, slot=0))
+            self.assertNotEqual(targets.conflict_key(dfu, worktree), targets.conflict_key(uf2, worktree))
+            self.assertTrue(dfu_dir.is_dir())
+
+            slots = bkb.BuildDirectories(MagicMock(), root, "slot", max_bytes=1500)
+            self.assertEqual(slots.acquire(dfu, worktree, slot=1), slots.acquire(uf2, worktree, slot=1))
+            self.assertIsNone(slots.conflict_key(dfu, worktree))
+            self.assertIsNone(bkb.BuildDirectories(MagicMock(), root, "worktree", 0).acquire(dfu, worktree, 0))
+
+            for index, build_dir in enumerate(sorted(root.joinpath("bkb-master").iterdir())):
+                build_dir.joinpath("obj.o").write_bytes(b"x" * 1000)
+                os.utime(build_dir, (index, index))
+            targets.prune()
+            self.assertEqual(len(list(root.joinpath("bkb-master").iterdir())), 1)
+
+    def test_tmpfs_build_directories_fall_back_to_disk(self):
+        """Verify build directories go to tmpfs when the memory allows, and to disk otherwise."""
+        worktree = MagicMock()
+        worktree.name = "bkb-master"
+        avr = bkb.Firmware(keyboard="skeletyl/v2/elitec", keymap="default")
+        arm = bkb.Firmware(keyboard="skeletyl/v2/splinky_3", keymap="default")
+        firmwares = (bkb.FirmwareList("bkb-master", (avr, arm)),)
+        needed_kib = sum(bkb.TMPFS_BUILD_DIR_ESTIMATES.values()) // 1024
+        with tempfile.TemporaryDirectory() as td:
+            disk = bkb.BuildDirectories(MagicMock(), Path(td, "disk"), "target", max_bytes=1 << 30)
+
+            def open_tmpfs(available_memory_kib, persist=False):
+                with patch.object(bkb, "read_available_memory_kib", return_value=available_memory_kib):
+                    return bkb.TmpfsBuildDirectories.open(
+                        MagicMock(), disk, firmwares, 2, 1024, persist=persist, tmpfs_root=Path(td)
+                    )
+
+            self.assertIsNone(open_tmpfs(needed_kib))
+            tmpfs = open_tmpfs(needed_kib + 1024)
+            self.assertEqual(tmpfs.root, Path(td, f"bastardkb-qmk-{os.getuid()}", "build"))
+            self.assertEqual(tmpfs.acquire(avr, worktree, 0).parent.parent, tmpfs.root)
+            # Out of space for a new build directory: build on disk.
+            with patch.object(bkb.shutil, "disk_usage", return_value=MagicMock(free=0)):
+                self.assertEqual(tmpfs.acquire(avr, worktree, 0).parent.parent, tmpfs.root)
+                self.assertEqual(tmpfs.acquire(arm, worktree, 0).parent.parent, disk.root)
+
+            tmpfs.prune()
+            self.assertFalse(tmpfs.root.exists())
+            self.assertTrue(disk.path(arm, worktree, 0).is_dir())
+
+            tmpfs = open_tmpfs(needed_kib + 1024, persist=True)
+            tmpfs.acquire(avr, worktree, 0)
+            tmpfs.prune()
+            self.assertTrue(tmpfs.path(avr, worktree, 0).is_dir())
+            self.assertIsNone(
+                bkb.TmpfsBuildDirectories.open(
+                    MagicMock(), bkb.BuildDirectories(MagicMock(), Path(td), "worktree", 0), firmwares, 2, 0, False
+                )
+            )
+
+    def test_compile_scheduler_passes_build_dirs(self):
+        """Verify concurrent compiles get distinct build directories, and the argv carries them."""
+        executor = bkb.Executor(MagicMock(), MagicMock(), dry_run=False, parallel=4, concurrency=2)
+        executor._run = MagicMock(return_value=MagicMock(returncode=0))
+        worktree = MagicMock()
+        worktree.name = "bkb-master"
+        worktree.path = Path("/tmp/test_worktree")
+        firmwares = [bkb.Firmware(keyboard=f"kb{i}/v2/elitec", keymap="default") for i in range(4)]
+        with tempfile.TemporaryDirectory() as td:
+            build_dirs = bkb.BuildDirectories(MagicMock(), Path(td), "slot", max_bytes=0)
+            with bkb.CompileScheduler(executor, 2, build_dirs) as scheduler:
+                for firmware in firmwares:
+                    scheduler.submit(bkb.CompileJob(firmware, worktree))
+                self.assertEqual(len(list(scheduler.completed())), 4)
+
+        used_build_dirs = {
+            argv[argv.index("--env", argv.index("USE_CCACHE=yes")) + 1]
+            for argv in (call[0][0] for call in executor._run.call_args_list)
+        }
+        self.assertEqual(used_build_dirs, {f"BUILD_DIR={td}/bkb-master/slot-0", f"BUILD_DIR={td}/bkb-master/slot-1"})
+
+    def test_qmk_compile_collects_ccache_stats_per_target(self):
+        """Verify each compile uses the shared ccache directory, with its own stats log."""
+        with tempfile.TemporaryDirectory() as td:
+            reporter = MagicMock()
+            reporter.log_file.side_effect = lambda basename, compressed=True: Path(td, f"{basename}.log")
+            ccache = bkb.Ccache(reporter, Path(td, "ccache"), "1G")
+            executor = bkb.Executor(reporter, MagicMock(), dry_run=False, parallel=1, ccache=ccache)
+
+            def run(argv, log_file, scanner=None, **kwargs):
+                self.assertEqual(kwargs["env"]["CCACHE_DIR"], str(Path(td, "ccache")))
+                Path(kwargs["env"]["CCACHE_STATSLOG"]).write_text(
+                    "# quantum/quantum.c\ndirect_cache_hit\n# quantum/keymap.c\ncache_miss\n"
+                    "# quantum/matrix.c\npreprocessed_cache_hit\n# link\ncalled_for_link\n"
+                )
+                return MagicMock(returncode=0)
+
+            executor._run = run
+            worktree = MagicMock()
+            worktree.path = Path(td)
+            completed_process = executor.qmk_compile(bkb.Firmware(keyboard="skeletyl/v2/elitec", keymap="default"), worktree)
+
+        self.assertEqual(completed_process.ccache_stats, bkb.CcacheStats(hits=2, misses=1))
+        self.assertAlmostEqual(completed_process.ccache_stats.hit_rate, 2 / 3)
+        self.assertIsNone(bkb.CcacheStats().hit_rate)
+
+    def test_admission_controller_throttles_on_load_and_memory(self):
+        """Verify compiles are held back or given a smaller -j when the machine is busy."""
+        loads = []
+        gib = 1024 * 1024
+        admission = bkb.AdmissionController(MagicMock(), max_load=8, memory_reserve_kib=gib, read_load=lambda: loads[-1])
+
+        loads.append(bkb.SystemLoad(load_average=0.1, available_memory_kib=16 * gib, compiles_rss_kib=0))
+        self.assertEqual(admission.admit(running=0, running_jobs=0, make_jobs=4), 4)
+        loads.append(bkb.SystemLoad(load_average=9.0, available_memory_kib=16 * gib, compiles_rss_kib=gib))
+        self.assertEqual(admission.admit(running=1, running_jobs=4, make_jobs=4), None)
+        loads.append(bkb.SystemLoad(load_average=5.0, available_memory_kib=16 * gib, compiles_rss_kib=gib))
+        self.assertEqual(admission.admit(running=1, running_jobs=4, make_jobs=4), 3)
+        loads.append(bkb.SystemLoad(load_average=4.0, available_memory_kib=gib + gib // 2, compiles_rss_kib=2 * gib))
+        self.assertEqual(admission.admit(running=1, running_jobs=4, make_jobs=4), 1)
+        self.assertEqual(admission.admit(running=0, running_jobs=0, make_jobs=4), 1)
+        loads.append(bkb.SystemLoad(load_average=None, available_memory_kib=None, compiles_rss_kib=0))
+        self.assertEqual(admission.admit(running=3, running_jobs=12, make_jobs=4), 4)
+        self.assertEqual((admission.throttled, admission.reduced_jobs), (1, 3))
+
+    def test_compile_scheduler_polls_admission_while_throttled(self):
+        """Verify held back compiles start once the admission lets them, with the -j it grants."""
+        executor = bkb.Executor(MagicMock(), MagicMock(), dry_run=False, parallel=8, concurrency=2)
+        executor.qmk_compile = MagicMock(return_value=MagicMock(returncode=0))
+        admission = MagicMock(POLL_INTERVAL=0.01)
+        admission.admit.side_effect = [2, None, None, 1]
+        worktree = MagicMock()
+        worktree.path = Path("/tmp/test_worktree")
+        firmwares = [bkb.Firmware(keyboard=f"kb{i}/v2/elitec", keymap="default") for i in range(2)]
+        with bkb.CompileScheduler(executor, 2, admission=admission) as scheduler:
+            for firmware in firmwares:
+                scheduler.submit(bkb.CompileJob(firmware, worktree))
+            self.assertEqual(len(list(scheduler.completed())), 2)
+        self.assertEqual([call[0][2] for call in executor.qmk_compile.call_args_list], [2, 1])
+
+    def test_firmware_fingerprint_ignores_sibling_keyboards(self):
+        """Verify a change to one board only invalidates the cached artifacts of that board."""
+        firmware = bkb.Firmware(keyboard="skeletyl/v2/elitec", keymap="default")
+        fingerprint = bkb.firmware_fingerprint(fake_qmk_tree(), firmware, "gcc 1.0")
+
+        self.assertEqual(fingerprint, bkb.firmware_fingerprint(fake_qmk_tree(scylla_config="c"), firmware, "gcc 1.0"))
+        self.assertNotEqual(fingerprint, bkb.firmware_fingerprint(fake_qmk_tree(skeletyl_config="c"), firmware, "gcc 1.0"))
+        self.assertNotEqual(fingerprint, bkb.firmware_fingerprint(fake_qmk_tree(quantum="r"), firmware, "gcc 1.0"))
+        self.assertNotEqual(fingerprint, bkb.firmware_fingerprint(fake_qmk_tree(), firmware, "gcc 2.0"))
+        self.assertNotEqual(
+            fingerprint,
+            bkb.firmware_fingerprint(fake_qmk_tree(), firmware._replace(env_vars=("VIA_ENABLE=yes",)), "gcc 1.0"),
+        )
+
+    def test_qmk_shim_keeps_unchanged_generated_files(self):
+        """Verify generated files are served from the cache, and left untouched when unchanged."""
+        with tempfile.TemporaryDirectory() as td:
+            qmk = Path(td, "qmk")
+            qmk.write_text('#! /bin/sh\necho run >> "$FAKE_QMK_RUNS"\nprintf "$FAKE_QMK_CONTENT" > "$8"\n')
+            qmk.chmod(0o755)
+            runs = Path(td, "runs")
+            output = Path(td, "obj_target", "src", "info_config.h")
+            argv = ("generate-config-h", "--quiet", "--keyboard", "bastardkb/skeletyl/v2/elitec", "--keymap", "default", "--output", str(output))
+
+            def shim(fingerprint, content):
+                env = {
+                    bkb.QMK_SHIM_QMK: str(qmk),
+                    bkb.QMK_SHIM_CACHE_DIR: str(Path(td, "generated")),
+                    bkb.QMK_SHIM_FINGERPRINT: fingerprint,
+                    "FAKE_QMK_RUNS": str(runs),
+                    "FAKE_QMK_CONTENT": content,
+                }
+                with patch.dict(os.environ, env):
+                    self.assertEqual(bkb.qmk_shim(argv), 0)
+                return output.read_text(), output.stat().st_mtime_ns, len(runs.read_text().splitlines())
+
+            self.assertEqual(shim("a", "#define A 1\n")[::2], ("#define A 1\n", 1))
+            os.utime(output, ns=(1, 1))
+            # Same inputs: served from the cache, without running qmk nor touching the file.
+            self.assertEqual(shim("a", "#define A 1\n"), ("#define A 1\n", 1, 1))
+            # Other inputs, same output: the file is left untouched.
+            self.assertEqual(shim("b", "#define A 1\n"), ("#define A 1\n", 1, 2))
+            # Other output: the file is replaced.
+            content, mtime, runs_count = shim("c", "#define A 2\n")
+            self.assertEqual((content, runs_count), ("#define A 2\n", 3))
+            self.assertNotEqual(mtime, 1)
+
+    def test_qmk_compile_runs_generators_through_shim(self):
+        """Verify compiles run the qmk generators through the shim, keyed by their inputs."""
+        executor = bkb.Executor(MagicMock(), MagicMock(), dry_run=False, parallel=1, generated_cache=Path("/tmp/generated"))
+        executor._run = MagicMock(return_value=MagicMock(returncode=0))
+        executor._worktree_tree = MagicMock(return_value=fake_qmk_tree())
+        firmware = bkb.Firmware(keyboard="skeletyl/v2/elitec", keymap="default")
+
+        executor.qmk_compile(firmware, MagicMock(path=Path("/tmp/test_worktree")))
+
+        argv = executor._run.call_args[0][0]
+        env = executor._run.call_args[1]["env"]
+        self.assertIn(f"QMK_BIN={shlex.join(executor.qmk_shim_command)}", argv)
+        self.assertEqual(env[bkb.QMK_SHIM_CACHE_DIR], "/tmp/generated")
+        self.assertEqual(
+            env[bkb.QMK_SHIM_FINGERPRINT],
+            bkb.firmware_fingerprint(fake_qmk_tree(), firmware, "", core_paths=bkb.QMK_GENERATOR_PATHS),
+        )
+
+    def test_firmware_affected_by_changed_paths(self):
+        """Verify changed paths only select the firmwares whose inputs they belong to."""
+        trees = (fake_qmk_tree(),)
+        avr = bkb.Firmware(keyboard="skeletyl/v2/elitec", keymap="default")
+        arm = bkb.Firmware(keyboard="skeletyl/v2/splinky_3", keymap="via")
+
+        def affected(path):
+            return [firmware for firmware in (avr, arm) if bkb.firmware_affected_by(trees, firmware, path)]
+
+        self.assertEqual(affected("keyboards/bastardkb/skeletyl/v2/elitec/config.h"), [avr])
+        self.assertEqual(affected("keyboards/bastardkb/skeletyl/config.h"), [avr, arm])
+        self.assertEqual(affected("keyboards/bastardkb/skeletyl/keymaps/via/keymap.c"), [arm])
+        self.assertEqual(affected("keyboards/bastardkb/scylla/config.h"), [])
+        self.assertEqual(affected("keyboards/bastardkb/skeletyl/v2/elitec/keyboard.json"), [avr])
+        v1 = avr._replace(keyboard="skeletyl/v1/elitec")
+        self.assertFalse(bkb.firmware_affected_by(trees, v1, "keyboards/bastardkb/skeletyl/v2/elitec/config.h"))
+        self.assertEqual(affected("users/default/rules.mk"), [avr])
+        self.assertEqual(affected("quantum/quantum.c"), [avr, arm])
+        self.assertEqual(affected("platforms/avr/timer.c"), [avr])
+        self.assertEqual(affected("lib/chibios"), [arm])
+        self.assertEqual(affected("keyboards/crkbd/config.h"), [])
+        self.assertEqual(affected("docs/index.md"), [])
+
+    def test_build_cache_restores_and_evicts_least_recently_used(self):
+        """Verify cached artifacts are restored, and evicted least recently used first."""
+        with tempfile.TemporaryDirectory() as td:
+            td_path = Path(td)
+            cache = bkb.BuildCache(MagicMock(), td_path / "cache", max_bytes=2048)
+            for index, fingerprint in enumerate(("aa01", "bb02", "cc03")):
+                artifact = td_path / f"firmware_{index}.hex"
+                artifact.write_bytes(b"x" * 1000)
+                cache.store(fingerprint, artifact)
+                os.utime(td_path / "cache" / fingerprint[:2] / fingerprint, (index, index))
+            cache.evict()
+
+            self.assertIsNone(cache.restore("aa01", td_path))
+            restored = cache.restore("cc03", td_path)
+            self.assertEqual(restored, td_path / "firmware_2.hex")
+            self.assertEqual(restored.read_bytes(), b"x" * 1000)
+            self.assertIsNone(cache.restore("dd04", td_path))
+
+    def test_remote_build_cache_shares_artifacts_between_runners(self):
+        """Verify artifacts stored by one runner are restored by another, through a local cache server."""
+        fingerprint = "ab" * 32
+        with tempfile.TemporaryDirectory() as td:
+            server_cache = bkb.BuildCache(MagicMock(), Path(td, "server"), max_bytes=1 << 20)
+            server = bkb.make_cache_server(MagicMock(), ("127.0.0.1", 0), server_cache, token="secret")
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            self.addCleanup(server.server_close)
+            self.addCleanup(server.shutdown)
+            url = "http://127.0.0.1:%d" % server.server_address[1]
+
+            def runner(name, token="secret"):
+                local = bkb.BuildCache(MagicMock(), Path(td, name, "cache"), max_bytes=1 << 20)
+                Path(td, name, "worktree").mkdir()
+                return bkb.RemoteBuildCache(MagicMock(), local, url, timeout=5, token=token)
+
+            first = runner("first")
+            artifact = Path(td, "first", "worktree", "bastardkb_skeletyl.hex")
+            artifact.write_bytes(b":00000001FF\n")
+            first.store(fingerprint, artifact)
+            first.close()
+            self.assertEqual(first.stores, 1)
+
+            second = runner("second")
+            self.assertIsNone(second.restore("cd" * 32, Path(td, "second", "worktree")))
+            restored = second.restore(fingerprint, Path(td, "second", "worktree"))
+            self.assertEqual(restored, Path(td, "second", "worktree", "bastardkb_skeletyl.hex"))
+            self.assertEqual(restored.read_bytes(), b":00000001FF\n")
+            self.assertEqual(second.hits, 1)
+            self.assertTrue(second.available)
+            # Now served by the local cache of the runner.
+            self.assertIsNotNone(second.local.lookup(fingerprint))
+
+            # The artifact is checked against its digest.
+            response = MagicMock()
+            response.__enter__.return_value = response
+            response.headers = {
+                bkb.REMOTE_CACHE_NAME_HEADER: "bastardkb_skeletyl.hex",
+                bkb.REMOTE_CACHE_SHA256_HEADER: hashlib.sha256(b":00000001FF\n").hexdigest(),
+            }
+            response.read.return_value = b"tampered"
+            third = runner("third")
+            with patch("urllib.request.urlopen", return_value=response):
+                self.assertIsNone(third.restore(fingerprint, Path(td, "third", "worktree")))
+            self.assertTrue(third.available)
+            self.assertFalse(Path(td, "third", "worktree", "bastardkb_skeletyl.hex").exists())
+
+            # Without the token, the server refuses the runner, which then compiles locally.
+            intruder = runner("intruder", token=None)
+            self.assertIsNone(intruder.restore(fingerprint, Path(td, "intruder", "worktree")))
+            self.assertFalse(intruder.available)
+
+    def test_remote_build_cache_falls_back_on_timeout(self):
+        """Verify an unresponsive cache server is given up on after one timeout."""
+        with socket.socket() as listener, tempfile.TemporaryDirectory() as td:
+            # Accepts connections, never answers.
+            listener.bind(("127.0.0.1", 0))
+            listener.listen()
+            remote = bkb.RemoteBuildCache(
+                MagicMock(),
+                bkb.BuildCache(MagicMock(), Path(td, "cache"), max_bytes=1 << 20),
+                "http://127.0.0.1:%d" % listener.getsockname()[1],
+                timeout=0.2,
+            )
+            started = time.perf_counter()
+            self.assertIsNone(remote.restore("ab" * 32, Path(td)))
+            self.assertIsNone(remote.restore("cd" * 32, Path(td)))
+            self.assertLess(time.perf_counter() - started, 2)
+            self.assertFalse(remote.available)
+            remote.reporter.warn.assert_called_once()
+
+    def test_remote_build_cache_does_not_stall_scheduling(self):
+        """Verify a stalling cache server delays the scheduling by one timeout, not one per firmware."""
+        with socket.socket() as listener, tempfile.TemporaryDirectory() as td:
+            # Accepts connections, never answers.
+            listener.bind(("127.0.0.1", 0))
+            listener.listen(32)
+            remote = bkb.RemoteBuildCache(
+                MagicMock(),
+                bkb.BuildCache(MagicMock(), Path(td, "cache"), max_bytes=1 << 20),
+                "http://127.0.0.1:%d" % listener.getsockname()[1],
+                timeout=0.5,
+            )
+            artifact = Path(td, "bastardkb_skeletyl.hex")
+            artifact.write_bytes(b":00000001FF\n")
+            fingerprints = ["%064x" % index for index in range(12)]
+
+            started = time.perf_counter()
+            # Uploads run in the background.
+            remote.store("ef" * 32, artifact)
+            self.assertLess(time.perf_counter() - started, 0.25)
+            remote.prefetch(fingerprints)
+            for fingerprint in fingerprints:
+                self.assertIsNone(remote.restore(fingerprint, Path(td)))
+            self.assertLess(time.perf_counter() - started, 1.5)
+            self.assertFalse(remote.available)
+            remote.reporter.warn.assert_called_once()
+            self.assertIsNotNone(remote.local.lookup("ef" * 32))
+
+            # Disabled for the rest of the run.
+            with patch("urllib.request.urlopen") as urlopen:
+                remote.prefetch(["ff" * 32])
+                self.assertIsNone(remote.restore("ff" * 32, Path(td)))
+                remote.store("ff" * 32, artifact)
+                remote.close()
+            urlopen.assert_not_called()
+
+    def test_build_journal_resumes_unchanged_firmwares(self):
+        """Verify a resumed build only skips firmwares built from the same inputs, with intact artifacts."""
+        firmware = bkb.Firmware(keyboard="skeletyl/v2/elitec", keymap="default")
+        with tempfile.TemporaryDirectory() as td:
+            output_dir = Path(td)
+            artifact = output_dir / "bastardkb_skeletyl_v2_elitec_default.hex"
+            artifact.write_bytes(b"firmware")
+            bkb.BuildJournal(output_dir, resume=False).record(firmware, "f1", artifact.name)
+
+            journal = bkb.BuildJournal(output_dir, resume=True)
+            self.assertEqual(journal.lookup(firmware, "f1"), artifact)
+            self.assertIsNone(journal.lookup(firmware, "f2"))
+            self.assertIsNone(journal.lookup(firmware, None))
+            self.assertIsNone(journal.lookup(firmware._replace(keymap="via"), "f1"))
+            artifact.write_bytes(b"tampered")
+            self.assertIsNone(journal.lookup(firmware, "f1"))
+            artifact.write_bytes(b"firmware")
+            self.assertIsNone(bkb.BuildJournal(output_dir, resume=False).lookup(firmware, "f1"))
+
+    def test_shard_plan_balances_cost_and_merges(self):
+        """Verify shards partition the firmwares by cost, and merge back into one complete release."""
+        firmwares = bkb.ALL_FIRMWARES
+        estimate = lambda firmware: bkb.ARCHITECTURE_COMPILE_ESTIMATES[bkb.firmware_architecture(firmware)]
+        plan = bkb.shard_plan(firmwares, 3, estimate)
+        self.assertEqual(plan, bkb.shard_plan(tuple(reversed(firmwares)), 3, estimate))
+
+        shards = [bkb.apply_shard(firmwares, bkb.Shard(index, 3), plan) for index in (1, 2, 3)]
+        sharded = [firmware for shard in shards for _, configurations in shard for firmware in configurations]
+        self.assertCountEqual(sharded, [firmware for _, configurations in firmwares for firmware in configurations])
+        costs = [sum(estimate(f) for _, configurations in shard for f in configurations) for shard in shards]
+        self.assertLessEqual(max(costs) - min(costs), max(bkb.ARCHITECTURE_COMPILE_ESTIMATES.values()))
+
+        with tempfile.TemporaryDirectory() as td:
+            shard_dirs = []
+            for index, shard in enumerate(shards, start=1):
+                report = bkb.BuildReport()
+                shard_dir = Path(td, f"shard{index}")
+                shard_dir.mkdir()
+                for _, configurations in shard:
+                    for position, firmware in enumerate(configurations):
+                        artifact = f"{firmware.output_filename}_{position}.bin"
+                        shard_dir.joinpath(artifact).write_bytes(b"firmware")
+                        report.record_target(firmware, status="ok", artifact=artifact)
+                bkb.write_shard_manifest(report, shard_dir, bkb.Shard(index, 3), plan, shard)
+                shard_dirs.append(shard_dir)
+
+            reporter = MagicMock()
+            output_dir = Path(td, "release")
+            output_dir.mkdir()
+            self.assertTrue(bkb.merge_shards(reporter, shard_dirs, output_dir))
+            manifest = json.loads(output_dir.joinpath("manifest.json").read_text())
+            self.assertEqual(manifest["total"], len(sharded))
+            self.assertEqual(manifest["failed"], [])
+
+            with self.assertRaises(SystemExit):
+                bkb.merge_shards(reporter, shard_dirs[:2], output_dir)
+
+    def test_merge_shards_rejects_manifest_without_shard(self):
+        """Verify a malformed shard manifest is reported as such, instead of crashing the merge."""
+        with tempfile.TemporaryDirectory() as td:
+            shard_dir = Path(td, "shard1")
+            shard_dir.mkdir()
+            manifest_file = shard_dir / "shard-1-of-1.json"
+            manifest_file.write_text(json.dumps({"plan": "0" * 64, "count": 1, "total": 0, "firmwares": []}))
+
+            reporter = MagicMock()
+            with self.assertRaises(SystemExit):
+                bkb.merge_shards(reporter, [shard_dir], Path(td))
+            message = reporter.fatal.call_args[0][0]
+            self.assertIn(str(manifest_file), message)
+            self.assertIn("'shard' is missing or not an integer", message)
+
+    def test_build_prepares_next_branch_while_compiling(self):
+        """Verify the next branch's worktree is prepared while the previous branch compiles."""
+        import threading
+
+        compile_started = threading.Event()
+        events = []
+
+        def git_ensure_worktree(branch, update_submodules, firmwares=()):
+            if branch == "bkb-develop":
+                # Only gets ready once the bkb-master firmwares are compiling.
+                self.assertTrue(compile_started.wait(timeout=5))
+                events.append("prepared bkb-develop")
+            worktree = MagicMock()
+            worktree.name = branch
+            worktree.path = Path("/tmp") / branch
+            return worktree
+
+        def qmk_compile(firmware, worktree, parallel):
+            compile_started.set()
+            events.append(f"compiled {worktree.name}")
+            return MagicMock(returncode=1, log_file=Path("/tmp/log"))
+
+        executor = MagicMock(dry_run=False, concurrency=2)
+        executor.git_ensure_worktree = git_ensure_worktree
+        executor.qmk_compile = qmk_compile
+        executor.make_jobs.return_value = 1
+        firmwares = (
+            bkb.FirmwareList("bkb-master", (bkb.Firmware(keyboard="skeletyl/v2/elitec", keymap="default"),)),
+            bkb.FirmwareList("bkb-develop", (bkb.Firmware(keyboard="scylla/v2/elitec", keymap="default"),)),
+        )
+        bkb.build(executor, MagicMock(), firmwares, MagicMock())
+
+        self.assertEqual(events, ["compiled bkb-master", "prepared bkb-develop", "compiled bkb-develop"])
+
+    def test_build_drops_queued_branch_preparations_when_stopped(self):
+        """Verify the worktrees of the next branches are not prepared once the build stops."""
+        compile_failed = threading.Event()
+        prepared = []
+
+        def git_ensure_worktree(branch, update_submodules, firmwares=()):
+            if branch == "bkb-develop":
+                # Still preparing when the build stops.
+                self.assertTrue(compile_failed.wait(timeout=5))
+                time.sleep(0.2)
+            prepared.append(branch)
+            worktree = MagicMock()
+            worktree.name = branch
+            worktree.path = Path("/tmp") / branch
+            return worktree
+
+        def qmk_compile(firmware, worktree, parallel):
+            compile_failed.set()
+            raise RuntimeError("interrupted")
+
+        executor = MagicMock(dry_run=False, concurrency=1)
+        executor.git_ensure_worktree = git_ensure_worktree
+        executor.qmk_compile = qmk_compile
+        executor.make_jobs.return_value = 1
+        firmwares = tuple(
+            bkb.FirmwareList(branch, (bkb.Firmware(keyboard="skeletyl/v2/elitec", keymap="default"),))
+            for branch in ("bkb-master", "bkb-develop", "bkb-vial")
+        )
+        with self.assertRaises(RuntimeError):
+            bkb.build(executor, MagicMock(), firmwares, MagicMock())
+
+        self.assertEqual(prepared, ["bkb-master", "bkb-develop"])
+
+    def test_build_orders_compiles_longest_first_from_history(self):
+        """Verify compiles start longest first, using past durations or the architecture estimates."""
+        avr = bkb.Firmware(keyboard="skeletyl/v2/elitec", keymap="default")
+        arm = bkb.Firmware(keyboard="skeletyl/blackpill", keymap="default")
+        slow_avr = bkb.Firmware(keyboard="scylla/v2/elitec", keymap="default")
+        with tempfile.TemporaryDirectory() as td:
+            history = bkb.DurationHistory(Path(td, "durations.json"))
+            history.record(slow_avr, 100.0)
+            history.save()
+            history = bkb.DurationHistory(Path(td, "durations.json"))
+
+        self.assertEqual(history.estimate(slow_avr), 100.0)
+        self.assertEqual(history.estimate(avr), 100.0)  # Average of the known AVR firmwares.
+        self.assertEqual(history.estimate(arm), bkb.ARCHITECTURE_COMPILE_ESTIMATES["arm"])
+
+        compiled = []
+
+        def qmk_compile(firmware, worktree, parallel):
+            compiled.append(firmware)
+            return MagicMock(returncode=1, log_file=Path("/tmp/log"))
+
+        executor = MagicMock(dry_run=False, concurrency=1)
+        executor.qmk_compile = qmk_compile
+        executor.make_jobs.return_value = 1
+        history.record(avr, 10.0)
+        bkb.build(executor, MagicMock(), (bkb.FirmwareList("bkb-master", (avr, arm, slow_avr)),), MagicMock(), history=history)
+
+        self.assertEqual(compiled, [slow_avr, arm, avr])
+
+    def test_run_streams_output_through_scanner(self):
+        """Verify the executor writes the log and detects the artifact in a single pass."""
+        reporter = MagicMock()
+        executor = bkb.Executor(reporter, MagicMock(), dry_run=False, parallel=1)
+        firmware = bkb.Firmware(keyboard="skeletyl/v2/elitec", keymap="default", keymap_alias="stock")
+        steps = []
+        scanner = bkb.LogScanner(firmware, on_step=steps.append)
+        output = (
+            "Compiling: quantum/quantum.c    [OK]\n"
+            "quantum/quantum.c:12:5: warning: unused variable 'x'\n"
+            f"Copying {firmware.output_filename}.hex to qmk_firmware folder    [OK]\n"
+        )
+        with tempfile.TemporaryDirectory() as td:
+            log_file = Path(td, "compile.log.gz")
+            completed_process = executor._run(
+                (sys.executable, "-c", f"import sys; sys.stdout.write({output!r})"), log_file=log_file, scanner=scanner
+            )
+            self.assertEqual(gzip.decompress(log_file.read_bytes()).decode(), output)
+            self.assertEqual(
+                bkb.read_firmware_filename_from_logs(firmware, log_file), Path(f"{firmware.output_filename}.hex")
+            )
+
+        self.assertEqual(completed_process.returncode, 0)
+        self.assertGreater(completed_process.usage.max_rss_kib, 0)
+        self.assertEqual(scanner.firmware_filename, Path(f"{firmware.output_filename}.hex"))
+        self.assertEqual(len(scanner.warnings), 1)
+        self.assertEqual(scanner.errors, [])
+        self.assertEqual(steps[0], "Compiling: quantum/quantum.c")
+
+    def test_build_logs_are_kept_per_run_within_retention(self):
+        """Verify each run logs into its own directory, and old or excess runs are removed."""
+        with tempfile.TemporaryDirectory() as td, patch.dict(os.environ, {"XDG_STATE_HOME": td}):
+            build_logs_dir = Path(td, "bastardkb-qmk", "build-logs")
+            build_logs_dir.mkdir(parents=True)
+            for index, age_days in enumerate((30, 3, 2, 1)):
+                run_dir = build_logs_dir / f"run-{index}"
+                run_dir.mkdir()
+                run_dir.joinpath("qmk-compile.log.gz").write_bytes(b"x" * 1000)
+                mtime = time.time() - age_days * 24 * 3600
+                os.utime(run_dir, (mtime, mtime))
+
+            with patch("bastardkb_build_releases.SecureRotatingFileHandler") as mock_handler:
+                mock_handler.return_value.level = 0
+                reporter = bkb.Reporter(verbose=False, log_retention_days=14, log_retention_bytes=2048)
+            reporter.close()
+
+            self.assertEqual(Path(reporter.log_dir).parent, build_logs_dir)
+            self.assertEqual(reporter.log_file("qmk-compile-x").name, "qmk-compile-x.log.gz")
+            self.assertEqual(
+                sorted(run_dir.name for run_dir in build_logs_dir.iterdir()),
+                sorted(("run-2", "run-3", Path(reporter.log_dir).name)),
+            )
+
+    def test_build_report_records_phases_and_usage(self):
+        """Verify the build report aggregates per-target phases and child resource usage."""
+        report = bkb.BuildReport()
+        fast = bkb.Firmware(keyboard="skeletyl/v2/elitec", keymap="default")
+        slow = bkb.Firmware(keyboard="skeletyl/blackpill", keymap="default")
+        with report.phase("submodule_update", branch="bkb-master"):
+            pass
+        report.add_phase("qmk_compile", 1.0, fast)
+        report.add_phase("qmk_compile", 5.0, slow)
+        report.add_phase("log_parsing", 0.5, slow)
+        report.record_target(slow, usage=bkb.ChildUsage(3.0, 1.0, 2048), status="ok")
+
+        with tempfile.TemporaryDirectory() as td:
+            report_file = Path(td, "build-report.json")
+            report.write(report_file)
+            content = json.loads(report_file.read_text())
+
+        self.assertEqual(content["phases"][0]["name"], "submodule_update")
+        self.assertEqual(content["phases"][0]["branch"], "bkb-master")
+        self.assertEqual([target["firmware"] for target in content["targets"]], [str(slow), str(fast)])
+        self.assertEqual(content["targets"][0]["phases"], {"qmk_compile": 5.0, "log_parsing": 0.5})
+        self.assertEqual(content["targets"][0]["usage"]["max_rss_kib"], 2048)
+        self.assertEqual(content["targets"][0]["architecture"], "arm")
+        self.assertEqual(content["targets"][1]["architecture"], "avr")
+
+    def test_git_submodule_update_skipped_when_up_to_date(self):
+        """Verify submodules matching their recorded gitlinks are not updated."""
+        executor = bkb.Executor(MagicMock(), MagicMock(), dry_run=False, parallel=4)
+        worktree = MagicMock()
+        worktree.name = "test_branch"
+        worktree.path = "/tmp/test_worktree"
+        executor.repository.lookup_worktree.return_value = worktree
+        executor._run = MagicMock(return_value=MagicMock(returncode=0))
+
+        executor._stale_submodules = MagicMock(return_value=[])
+        executor.git_ensure_worktree("test_branch", update_submodules=True)
+        self.assertFalse(executor._run.called)
+
+        executor._stale_submodules = MagicMock(return_value=["lib/chibios", "lib/lufa"])
+        executor.git_ensure_worktree("test_branch", update_submodules=True)
+        argv = executor._run.call_args[0][0]
+        self.assertEqual(argv[:3], ("git", "submodule", "update"))
+        self.assertEqual(argv[argv.index("--") :], ("--", "lib/chibios", "lib/lufa"))
+
+    def test_git_submodule_update_shares_objects_between_worktrees(self):
+        """Verify submodules are cloned with the shared store as reference, and their objects fetched into it."""
+        with tempfile.TemporaryDirectory() as td:
+            repository = MagicMock(path=f"{td}/qmk_firmware.git/")
+            executor = bkb.Executor(MagicMock(), repository, dry_run=False, parallel=4)
+            worktree = MagicMock()
+            worktree.name = "bkb-master"
+            worktree.path = f"{td}/bkb-master"
+            repository.lookup_worktree.return_value = worktree
+            executor._run = MagicMock(return_value=MagicMock(returncode=0))
+            executor._stale_submodules = MagicMock(return_value=None)
+            # The module repositories of the worktree, nested ones included.
+            gitdir = Path(td, "qmk_firmware.git", "worktrees", "bkb-master")
+            for module in ("lib/chibios", "lib/chibios-contrib", "lib/chibios-contrib/modules/ext/pico-sdk"):
+                (gitdir / "modules" / module / "objects").mkdir(parents=True)
+                (gitdir / "modules" / module / "HEAD").write_text("0" * 40)
+            store = Path(td, "qmk_firmware.git", bkb.SUBMODULE_OBJECTS_STORE)
+
+            with patch("pygit2.Repository", return_value=MagicMock(path=f"{gitdir}/")), patch(
+                "pygit2.init_repository"
+            ) as init_repository:
+                executor.git_ensure_worktree("bkb-master", update_submodules=True)
+
+            init_repository.assert_called_once_with(str(store), bare=True)
+            update, *fetches = [call[0][0] for call in executor._run.call_args_list]
+            self.assertEqual(update[update.index("--reference") + 1], str(store))
+            self.assertEqual(
+                [argv[:4] + argv[7:8] for argv in fetches],
+                [
+                    ("git", "--git-dir", str(store), "fetch", str(gitdir / "modules" / module))
+                    for module in ("lib/chibios", "lib/chibios-contrib", "lib/chibios-contrib/modules/ext/pico-sdk")
+                ],
+            )
+            # Each module keeps its objects reachable under its own refs.
+            self.assertEqual(len({argv[8] for argv in fetches}), 3)
+
+    def test_run_timeout_kills_process_group(self):
+        """Verify a timed out child is terminated along with its own children."""
+        executor = bkb.Executor(MagicMock(), MagicMock(), dry_run=False, parallel=1)
+        with tempfile.TemporaryDirectory() as td:
+            started = time.perf_counter()
+            # The background sleep keeps the output pipe open unless the whole group is terminated.
+            completed_process = executor._run(("sh", "-c", "sleep 30 & sleep 30"), log_file=Path(td, "log"), timeout=0.2)
+            self.assertLess(time.perf_counter() - started, 5)
+            self.assertTrue(completed_process.timed_out)
+            self.assertNotEqual(completed_process.returncode, 0)
+
+            completed_process = executor._run(("true",), log_file=Path(td, "log"), timeout=5)
+            self.assertFalse(completed_process.timed_out)
+            self.assertEqual(completed_process.returncode, 0)
+
+    def test_cancel_terminates_running_children(self):
+        """Verify cancelling the executor terminates the running children, and starts no new ones."""
+        executor = bkb.Executor(MagicMock(), MagicMock(), dry_run=False, parallel=1)
+        with tempfile.TemporaryDirectory() as td:
+            results = []
+            thread = threading.Thread(
+                target=lambda: results.append(executor._run(("sh", "-c", "sleep 30 & sleep 30"), log_file=Path(td, "log")))
+            )
+            thread.start()
+            while not executor._processes:
+                time.sleep(0.01)
+            started = time.perf_counter()
+            executor.cancel()
+            thread.join(timeout=5)
+            self.assertLess(time.perf_counter() - started, 2)
+            self.assertEqual(results[0].returncode, -15)
+
+            with patch.object(bkb.subprocess, "Popen") as popen:
+                self.assertNotEqual(executor._run(("true",), log_file=Path(td, "log")).returncode, 0)
+            self.assertFalse(popen.called)
+
+            # The git commands terminated along the build fail without reporting errors of their own.
+            worktree = MagicMock()
+            worktree.name = "bkb-master"
+            executor._stale_submodules = MagicMock(return_value=None)
+            with patch.object(executor, "submodule_objects_store", return_value=None), self.assertRaises(SystemExit):
+                executor.git_update_submodules(worktree)
+            self.assertFalse(executor.reporter.fatal.called)
+
+    def test_run_reaps_children_only_once_they_cannot_be_signalled(self):
+        """Verify a child leaves the signalled processes before being reaped, so its process group id can't be reused."""
+        executor = bkb.Executor(MagicMock(), MagicMock(), dry_run=False, parallel=1)
+        wait4 = os.wait4
+        signalled_while_reaped = []
+
+        def checked_wait4(pid, options):
+            signalled_while_reaped.extend(process.pid for process in executor._processes if process.pid == pid)
+            return wait4(pid, options)
+
+        with tempfile.TemporaryDirectory() as td, patch.object(bkb.os, "wait4", checked_wait4):
+            self.assertEqual(executor._run(("true",), log_file=Path(td, "log")).returncode, 0)
+        self.assertEqual(signalled_while_reaped, [])
+        self.assertEqual(executor._processes, set())
+
+    def test_git_ensure_worktree_creates_sparse_checkout(self):
+        """Verify a missing worktree is created with only the core, the bastardkb keyboards and the userspace."""
+        import subprocess
+
+        with tempfile.TemporaryDirectory() as td:
+            source = Path(td, "source")
+            for path in ("Makefile", "quantum/quantum.c", "keyboards/bastardkb/rules.mk", "keyboards/other/rules.mk", "users/via/via.c", "users/other/other.c", "docs/index.md"):
+                (source / path).parent.mkdir(parents=True, exist_ok=True)
+                (source / path).write_text(path)
+            git = ("git", "-c", "user.name=test", "-c", "user.email=test@localhost")
+            subprocess.run((*git, "init", "--quiet", "--initial-branch=bkb-master", str(source)), check=True)
+            subprocess.run((*git, "-C", str(source), "add", "--all"), check=True)
+            subprocess.run((*git, "-C", str(source), "commit", "--quiet", "--message=Initial commit"), check=True)
+            subprocess.run((*git, "clone", "--quiet", "--bare", str(source), f"{td}/qmk_firmware.git"), check=True)
+
+            reporter = MagicMock()
+            reporter.log_file.side_effect = lambda name: Path(td, f"{name}.log")
+            repository = MagicMock(path=f"{td}/qmk_firmware.git/", workdir=None, is_bare=True)
+            created = MagicMock()
+            repository.lookup_worktree.side_effect = [None, created]
+            repository.branches.local.get.return_value.peel.return_value.tree = FakeTree({"quantum": {"quantum.c": "q"}, "Makefile": "m"})
+            executor = bkb.Executor(reporter, repository, dry_run=False, parallel=4)
+            firmwares = (bkb.Firmware(keyboard="skeletyl/v2/elitec", keymap="via"),)
+
+            self.assertIs(executor.git_ensure_worktree("bkb-master", update_submodules=False, firmwares=firmwares), created)
+
+            checkout = Path(td, "qmk_firmware.git", "bkb-master")
+            files = sorted(str(path.relative_to(checkout)) for path in checkout.rglob("*") if path.is_file() and ".git" not in path.parts)
+            self.assertEqual(files, ["Makefile", "keyboards/bastardkb/rules.mk", "quantum/quantum.c", "users/via/via.c"])
+
+            # libgit2 reports the files left out as deleted: they are not uncommitted changes.
+            worktree_repository = MagicMock(path=f"{td}/qmk_firmware.git/worktrees/bkb-master/")
+            worktree_repository.config.get_bool.return_value = True
+            worktree_repository.status.return_value = {
+                "docs/index.md": sys.modules["pygit2"].GIT_STATUS_WT_DELETED,
+                "keyboards/other/rules.mk": sys.modules["pygit2"].GIT_STATUS_WT_DELETED,
+                "quantum/quantum.c": sys.modules["pygit2"].GIT_STATUS_WT_DELETED,
+            }
+            self.assertEqual(bkb.worktree_changes(worktree_repository), {"quantum/quantum.c"})
+
 if __name__ == '__main__':
     unittest.main()
@@ -2,6 +2,7 @@ import sys
 import os
 import unittest
 import tempfile
+import json
 import stat
 from unittest.mock import MagicMock, patch
 from pathlib import Path
@@ -42,6 +43,9 @@ class TestSecurity(unittest.TestCase):
         failure_process.returncode = 1
         self.executor._run.return_value = failure_process
 
+        # The submodules could not be checked, so they all get updated.
+        self.executor._stale_submodules = MagicMock(return_value=None)
+
         # We expect the code to exit or raise an error when submodule update fails.
         with self.assertRaises(SystemExit):
             self.executor.git_ensure_worktree("test_branch", update_submodules=True)
@@ -141,9 +145,65 @@ class TestSecurity(unittest.TestCase):
         malicious_basename = "../../../etc/passwd"
         log_path = reporter.log_file(malicious_basename)
 
-        self.assertEqual(log_path.name, ".._.._.._etc_passwd.log")
+        self.assertEqual(log_path.name, ".._.._.._etc_passwd.log.gz")
         self.assertEqual(log_path.parent, Path(reporter.log_dir))
 
+    def test_write_manifest_does_not_follow_staging_symlink(self):
+        with tempfile.TemporaryDirectory() as td:
+            victim = Path(td, "victim")
+            victim.write_text("untouched")
+            Path(td, ".manifest.json.tmp").symlink_to(victim)
+
+            bkb.write_manifest(Path(td, "manifest.json"), {"version": 1})
+
+            self.assertEqual(victim.read_text(), "untouched")
+            self.assertEqual(json.loads(Path(td, "manifest.json").read_text()), {"version": 1})
+            self.assertFalse(Path(td, ".manifest.json.tmp").exists())
+
+    def test_cache_server_requires_token_off_loopback(self):
+        with tempfile.TemporaryDirectory() as td:
+            cache = bkb.BuildCache(MagicMock(), Path(td, "cache"), max_bytes=1 << 20)
+            for host in ("0.0.0.0", "", "192.0.2.1", "cache.example.com"):
+                with self.assertRaises(ValueError):
+                    bkb.make_cache_server(MagicMock(), (host, 0), cache)
+            bkb.make_cache_server(MagicMock(), ("localhost", 0), cache).server_close()
+            bkb.make_cache_server(MagicMock(), ("0.0.0.0", 0), cache, token="secret").server_close()
+
+    def test_cache_server_rejects_path_traversal_in_artifact_name(self):
+        import hashlib
+        import http.client
+        import threading
+
+        with tempfile.TemporaryDirectory() as td:
+            cache = bkb.BuildCache(MagicMock(), Path(td, "cache"), max_bytes=1 << 20)
+            server = bkb.make_cache_server(MagicMock(), ("127.0.0.1", 0), cache)
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            try:
+                data = b"malicious"
+                for name in ("../../escaped.hex", ".hidden", "..\\escaped.hex"):
+                    connection = http.client.HTTPConnection("127.0.0.1", server.server_address[1], timeout=5)
+                    connection.request(
+                        "PUT",
+                        "/artifacts/" + "ab" * 32,
+                        body=data,
+                        headers={
+                            bkb.REMOTE_CACHE_NAME_HEADER: name,
+                            bkb.REMOTE_CACHE_SHA256_HEADER: hashlib.sha256(data).hexdigest(),
+                        },
+                    )
+                    self.assertEqual(connection.getresponse().status, 400)
+                    connection.close()
+                # Fingerprints are hex digests: no path traversal through the URL either.
+                connection = http.client.HTTPConnection("127.0.0.1", server.server_address[1], timeout=5)
+                connection.request("GET", "/artifacts/../../etc/passwd")
+                self.assertEqual(connection.getresponse().status, 404)
+                connection.close()
+            finally:
+                server.shutdown()
+                server.server_close()
+            self.assertIsNone(cache.lookup("ab" * 32))
+            self.assertEqual(sorted(os.listdir(td)), ["cache"])
+
     @patch("bastardkb_build_releases.SecureRotatingFileHandler")
     def test_app_log_dir_chmod_prevents_symlink_following(self, mock_handler):
         mock_handler.return_value.level = 0
@@ -0,0 +1,102 @@
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCRIPT = os.path.join(ROOT_DIR, "bastardkb_build_releases.py")
+
+# Importing the module, without its heavy dependencies, must stay within this budget, in seconds.
+IMPORT_TIME_BUDGET = 0.5
+
+HEAVY_MODULES = ("rich", "pygit2")
+
+
+def imported_modules(stderr: str) -> set[str]:
+    """The modules listed by `python -X importtime`."""
+    return {line.rsplit("|", 1)[-1].strip() for line in stderr.splitlines() if line.startswith("import time:")}
+
+
+class TestStartup(unittest.TestCase):
+    def setUp(self):
+        self.state_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.state_dir.cleanup)
+        self.env = dict(os.environ, XDG_STATE_HOME=self.state_dir.name, XDG_CACHE_HOME=self.state_dir.name)
+
+    def run_python(self, *argv: str) -> subprocess.CompletedProcess:
+        return subprocess.run(
+            (sys.executable, "-X", "importtime", *argv),
+            cwd=ROOT_DIR,
+            env=self.env,
+            capture_output=True,
+            text=True,
+            timeout=60,
+        )
+
+    def test_import_defers_heavy_dependencies(self):
+        """Verify importing the module neither imports rich nor pygit2, and stays within its budget."""
+        result = self.run_python(
+            "-c",
+            "import time; started = time.perf_counter(); import bastardkb_build_releases;"
+            " print(time.perf_counter() - started)",
+        )
+        self.assertEqual(result.returncode, 0, result.stderr)
+
+        modules = imported_modules(result.stderr)
+        self.assertIn("bastardkb_build_releases", modules)
+        for module in HEAVY_MODULES:
+            self.assertNotIn(module, modules)
+        self.assertLess(float(result.stdout), IMPORT_TIME_BUDGET)
+
+    def test_list_prints_filtered_matrix_without_heavy_dependencies(self):
+        """Verify --list --json prints the filtered matrix, without a reporter nor heavy imports."""
+        result = self.run_python(SCRIPT, "--list", "--json", "--filter", "skeletyl/blackpill")
+        self.assertEqual(result.returncode, 0, result.stderr)
+
+        firmwares = json.loads(result.stdout)
+        self.assertIn(
+            {
+                "branch": "bkb-master",
+                "keyboard": "skeletyl/blackpill",
+                "keymap": "default",
+                "keymap_alias": "stock",
+                "env_vars": ["BOOTLOADER=tinyuf2", "VIA_ENABLE=yes"],
+                "output_filename": "bastardkb_skeletyl_blackpill_stock",
+            },
+            firmwares,
+        )
+        self.assertTrue(all(firmware["keyboard"] == "skeletyl/blackpill" for firmware in firmwares))
+        for module in HEAVY_MODULES:
+            self.assertNotIn(module, imported_modules(result.stderr))
+        # No build logs were set up.
+        self.assertEqual(os.listdir(self.state_dir.name), [])
+
+    def test_list_rejects_invalid_filter(self):
+        result = self.run_python(SCRIPT, "--list", "--filter", "(")
+        self.assertEqual(result.returncode, 2)
+        self.assertIn("invalid filter regular expression", result.stderr)
+
+    def test_json_requires_list(self):
+        result = self.run_python(SCRIPT, "--json")
+        self.assertEqual(result.returncode, 2)
+        self.assertIn("--json can only be used with --list", result.stderr)
+        self.assertEqual(result.stdout, "")
+
+    def test_list_into_closed_pipe(self):
+        """Verify `--list | head` exits quietly once the reader is gone."""
+        read_fd, write_fd = os.pipe()
+        os.close(read_fd)
+        try:
+            result = subprocess.run(
+                (sys.executable, SCRIPT, "--list"), cwd=ROOT_DIR, env=self.env, stdout=write_fd, stderr=subprocess.PIPE, text=True, timeout=60
+            )
+        finally:
+            os.close(write_fd)
+        self.assertEqual(result.returncode, 0)
+        self.assertNotIn("Traceback", result.stderr)
+
+
+if __name__ == "__main__":
+    unittest.main()
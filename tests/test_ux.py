@@ -119,6 +119,44 @@ class TestUX(unittest.TestCase):
             self.assertIn("kb1:keymap1", renderable_str)
             self.assertIn("kb2:keymap2", renderable_str)
 
+    @patch("bastardkb_build_releases.RotatingFileHandler")
+    def test_console_output_is_queued_in_order(self, mock_handler):
+        """Verify console messages are printed by the writer thread, in order, and flushed on demand."""
+        mock_handler.return_value.level = 0
+        reporter = bkb.Reporter(verbose=False)
+        reporter.console = MagicMock()
+
+        reporter.info("first")
+        reporter.info("second")
+        reporter.warn("third", style="yellow")
+        reporter.error("fourth")
+        reporter.flush()
+
+        printed = [call[0] for call in reporter.console.print.call_args_list]
+        self.assertEqual([message for call in printed for message in call], ["first", "second", "third", "fourth"])
+        self.assertIn((("third",), {"style": "yellow"}), [tuple(call) for call in reporter.console.print.call_args_list])
+
+        reporter.close()
+        reporter.info("after close")
+        self.assertEqual(reporter.console.print.call_args[0], ("after close",))
+
+    @patch("bastardkb_build_releases.RotatingFileHandler")
+    def test_target_status_updates_are_coalesced(self, mock_handler):
+        """Verify bursts of live status updates are coalesced, but clearing a status never is."""
+        mock_handler.return_value.level = 0
+        reporter = bkb.Reporter(verbose=False)
+        target_status = MagicMock()
+        reporter.set_target_status(target_status)
+        firmware = bkb.Firmware(keyboard="skeletyl/v2/elitec", keymap="default")
+
+        for index in range(100):
+            reporter.target_status(firmware, f"Compiling: quantum/file{index}.c")
+        reporter.target_status(firmware, None)
+
+        self.assertEqual(target_status.call_count, 2)
+        self.assertEqual(target_status.call_args[0], (firmware, None))
+        reporter.close()
+
     @patch("bastardkb_build_releases.RotatingFileHandler")
     def test_log_location_xdg(self, mock_handler):
         # Configure the mock handler instance to have a proper level
@@ -171,7 +209,7 @@ class TestUX(unittest.TestCase):
             # verify exit was called
             mock_exit.assert_called_once_with(1)
 
-    @patch("bastardkb_build_releases.Progress")
+    @patch("rich.progress.Progress")
     def test_progress_bar_includes_time_remaining(self, mock_progress):
         mock_reporter = MagicMock()
         mock_reporter.console = MagicMock()